@@ -0,0 +1,66 @@
+# ------------------------------------------------------------------
+#                 Command line of the air quality scripts
+# ------------------------------------------------------------------
+# One entry point for the scripts of the Raspberry Pi and the server:
+#
+#   python air_quality.py sample      read the sensors and store the samples
+#   python air_quality.py calibrate   measure the R0 values of the MQ sensors
+#   python air_quality.py alert       send alerts and control the ventilation
+#   python air_quality.py dashboard   serve the Dash dashboard
+#   python air_quality.py collector   receive the samples of several rooms
+#   python air_quality.py backfill    recompute the ppm values of the stored samples
+#
+# The arguments after the command are passed on to its script, e.g.
+# python air_quality.py backfill --start 2026-01-01 --dry-run
+#
+# Only the script of the command is imported, so every command only
+# loads the libraries it needs (e.g. the sampler never imports Dash,
+# the dashboard never imports the GrovePi library). Within the scripts,
+# optional libraries and clients are loaded when they are used.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import argparse
+import runpy
+import sys
+
+# Script run by every command, with its description
+COMMANDS = {
+    'sample': ('get_sensor_values', 'read the sensors and store the samples'),
+    'calibrate': ('get_R0_values', 'measure the R0 values of the MQ sensors in clean air'),
+    'alert': ('improve_air_quality', 'send alerts and control the ventilation'),
+    'dashboard': ('plot_sensor_values', 'serve the Dash dashboard'),
+    'collector': ('collector', 'receive the samples of several rooms and store them'),
+    'backfill': ('backfill', 'recompute the ppm values of the stored samples after a correction')
+}
+
+# Commands of which the script has its own arguments
+SCRIPT_ARGUMENTS = {'backfill'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Air quality monitoring')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for command, (_, description) in COMMANDS.items():
+        # The scripts with their own arguments print their own help
+        subparsers.add_parser(command, help=description, description=description,
+                              add_help=command not in SCRIPT_ARGUMENTS)
+    args, script_args = parser.parse_known_args(argv)
+    if script_args and args.command not in SCRIPT_ARGUMENTS:
+        parser.error('unrecognized arguments: ' + ' '.join(script_args))
+
+    module, _ = COMMANDS[args.command]
+    # run_module replaces sys.argv[0] with the path of the script
+    sys.argv = [module] + script_args
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# ------------------------------------------------------------------
+#                 Streaming evaluation of alert rules
+# ------------------------------------------------------------------
+# Evaluates every new sample against the alert rules of the gases
+# as soon as it arrives, instead of re-reading the samples of the
+# last alert interval and scanning them.
+#
+# Rules look at a sliding window of samples: the time-weighted
+# average over N minutes, the rate of change over N minutes, or M of
+# the last N samples above the upper bound. Every window is updated
+# with running sums in constant time per sample, so the cost doesn't
+# grow with the size of the windows, and a single noisy spike no
+# longer triggers an alert.
+#
+# New samples are pushed by a subscription on the storage backend, or by a
+# thread following the local archive on the Pi, onto a local queue.
+# The monitoring loop blocks on this queue, so it uses no CPU while
+# waiting for the next sample.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import math
+import threading
+from collections import deque
+from datetime import datetime
+
+
+def sample_key(mq_sensor, gas):
+    """Name of the field with the ppm value of a gas on a sensor"""
+    return mq_sensor + '_' + gas + '_ppm'
+
+
+class TimeWeightedAverage:
+    """Time-weighted average of the values over the last window seconds
+
+    Every value holds for the period since the previous value. The
+    integral over the window is kept as a running sum. The average is
+    None as long as the values don't cover the whole window.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.segments = deque()  # (start, end, value)
+        self.total = 0.0
+        self.last_time = None
+
+    def add(self, t, value):
+        if self.last_time is not None and t > self.last_time:
+            self.segments.append((self.last_time, t, value))
+            self.total += value * (t - self.last_time)
+        self.last_time = t
+        cutoff = t - self.window
+        while self.segments and self.segments[0][1] <= cutoff:
+            start, end, old_value = self.segments.popleft()
+            self.total -= old_value * (end - start)
+        # No average until the values cover the whole window, e.g. right after a restart
+        if not self.segments or self.segments[0][0] > cutoff:
+            return None
+        # Only the part of the oldest period inside the window counts
+        start, _, first_value = self.segments[0]
+        return (self.total - first_value * (cutoff - start))/self.window
+
+
+class Slope:
+    """Slope of the least squares line through the values of the last window seconds, per minute
+
+    The sums of the regression are kept as running sums.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.points = deque()
+        self.origin = None
+        self.n = self.sum_t = self.sum_v = self.sum_tv = self.sum_tt = 0.0
+
+    def _update(self, t, value, sign):
+        self.n += sign
+        self.sum_t += sign * t
+        self.sum_v += sign * value
+        self.sum_tv += sign * t * value
+        self.sum_tt += sign * t * t
+
+    def add(self, t, value):
+        if self.origin is None:
+            self.origin = t
+        # Times in minutes since the first value, to keep the sums small
+        t = (t - self.origin)/60
+        self.points.append((t, value))
+        self._update(t, value, 1)
+        while self.points[0][0] <= t - self.window/60:
+            self._update(*self.points.popleft(), -1)
+        denominator = self.n * self.sum_tt - self.sum_t ** 2
+        if self.n < 2 or denominator <= 0:
+            return 0.0
+        return (self.n * self.sum_tv - self.sum_t * self.sum_v)/denominator
+
+
+class MOfN:
+    """Number of the last n values above a bound"""
+
+    def __init__(self, n, upperbound):
+        self.upperbound = upperbound
+        self.flags = deque(maxlen=n)
+        self.count = 0
+
+    def add(self, t, value):
+        if len(self.flags) == self.flags.maxlen:
+            self.count -= self.flags[0]
+        above = value > self.upperbound
+        self.flags.append(above)
+        self.count += above
+        return self.count
+
+
+class AlertRule:
+    """Rule on the values of one gas, see cfg.ALERT_RULES
+
+    Parameters
+    ----------
+    gas : str
+    rule : dict
+        'type' is 'twa' (time-weighted average over 'window' minutes above 'threshold'),
+        'slope' (increase over 'window' minutes above 'threshold' ppm per minute) or
+        'm_of_n' (at least 'm' of the last 'n' values above 'threshold')
+    upperbound : float
+        default threshold
+    """
+
+    def __init__(self, gas, rule, upperbound):
+        self.gas = gas
+        self.type = rule['type']
+        self.threshold = rule.get('threshold', upperbound)
+        self.window = rule.get('window', 0)
+        if self.type == 'twa':
+            self.description = 'time-weighted average over {} min'.format(rule['window'])
+            self.make_operator = lambda: TimeWeightedAverage(rule['window'] * 60)
+        elif self.type == 'slope':
+            self.description = 'increase per minute over {} min'.format(rule['window'])
+            self.make_operator = lambda: Slope(rule['window'] * 60)
+        elif self.type == 'm_of_n':
+            self.description = 'value ({} of the last {} samples above {})'.format(rule['m'], rule['n'],
+                                                                                  self.threshold)
+            self.m = rule['m']
+            self.make_operator = lambda: MOfN(rule['n'], self.threshold)
+        else:
+            raise ValueError('Unknown alert rule: {}'.format(self.type))
+
+    def triggered(self, statistic):
+        if self.type == 'm_of_n':
+            return statistic >= self.m
+        return statistic > self.threshold
+
+
+class RuleEvaluator:
+    """Evaluate windowed alert rules on the gas concentrations of a stream of samples
+
+    The windows of every rule are kept per room and updated in constant
+    time per sample.
+
+    Parameters
+    ----------
+    mq_sensor : str
+        sensor of which the values are checked
+    gases : list
+        gases to check
+    upperbounds : dict
+        upper bound of the ppm value per gas, the default threshold of the rules
+    rules : dict
+        list of rules per gas (see AlertRule)
+    default_rules : list
+        rules of the gases without rules
+    """
+
+    def __init__(self, mq_sensor, gases, upperbounds, rules, default_rules):
+        self.bounds = [(gas, sample_key(mq_sensor, gas), upperbounds[gas]) for gas in gases]
+        self.rules = [(key, AlertRule(gas, rule, ubound))
+                      for gas, key, ubound in self.bounds
+                      for rule in rules.get(gas, default_rules)]
+        self.operators = {}  # device -> list of operators, one per rule
+        self.last_times = {}  # device -> timestamp of the last sample
+
+    @property
+    def history(self):
+        """Number of minutes of samples the time windows of the rules look back on"""
+        return max([rule.window for _, rule in self.rules], default=0)
+
+    def critical_values(self, sample, device=None):
+        """Find the gases of which a rule is triggered by a sample
+        Parameters
+        ----------
+        sample : dict
+            sensor values of one sample, with a 'date' key
+        device : str or None
+            room of the sample, every room has its own windows
+        Returns
+        -------
+        dict
+            (rule description, value) per gas, empty when no rule is triggered
+        """
+        t = sample['date'].timestamp()
+        if device in self.last_times and t < self.last_times[device]:
+            # Samples older than the last one were already taken into account
+            return {}
+        self.last_times[device] = t
+
+        operators = self.operators.get(device)
+        if operators is None:
+            operators = [rule.make_operator() for _, rule in self.rules]
+            self.operators[device] = operators
+
+        critical = {}
+        for (key, rule), operator in zip(self.rules, operators):
+            value = sample.get(key)
+            if value is None or not math.isfinite(value):
+                continue
+            statistic = operator.add(t, value)
+            if statistic is not None and rule.triggered(statistic) and rule.gas not in critical:
+                critical[rule.gas] = (rule.description, value if rule.type == 'm_of_n' else statistic)
+        return critical
+
+
+def listen_new_samples(storage, collection_name, sample_queue, start):
+    """Push the samples added to a collection onto a queue
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+    sample_queue : queue.Queue
+        queue receiving the sample dicts
+    start : datetime
+        only samples from this date onwards are pushed
+    Returns
+    -------
+    subscription
+        call subscription.unsubscribe() to stop listening
+    """
+    return storage.subscribe(collection_name, start, sample_queue.put)
+
+
+class ArchiveFollower(threading.Thread):
+    """Thread pushing the samples appended to a local SampleArchive onto a queue
+
+    Parameters
+    ----------
+    archive : SampleArchive
+    sample_queue : queue.Queue
+        queue receiving the sample dicts
+    start : datetime
+        only samples after this date are pushed
+    interval : float
+        number of seconds between two checks for new samples
+    fields : list or None
+        fields to read, None for all fields of the archive
+    """
+
+    def __init__(self, archive, sample_queue, start, interval, fields=None):
+        super().__init__(name='archive-follower', daemon=True)
+        self.archive = archive
+        self.sample_queue = sample_queue
+        self.last_timestamp = start.timestamp()
+        self.interval = interval
+        self.fields = fields
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            timestamps, values = self.archive.since(self.last_timestamp, self.fields)
+            for i, timestamp in enumerate(timestamps.tolist()):
+                sample = {field: float(column[i]) for field, column in values.items()}
+                sample['date'] = datetime.fromtimestamp(timestamp)
+                self.sample_queue.put(sample)
+            if len(timestamps) > 0:
+                self.last_timestamp = float(timestamps[-1])
+
+    def unsubscribe(self):
+        self.stop_event.set()
@@ -0,0 +1,206 @@
+# ------------------------------------------------------------------
+#                 Local columnar archive of samples
+# ------------------------------------------------------------------
+# Stores all samples on the local disk in a columnar format, so the
+# history can be analysed without downloading every document from
+# Firebase.
+#
+# The archive is partitioned per day. Every partition is a folder
+# with one file per field (date, temperature, mq2_co_ppm, ...)
+# holding fixed-width float64 values. Dates are stored as seconds
+# since the epoch and are sorted, so a range query is a binary search
+# on the dates followed by a slice of memory-mapped arrays. Within a
+# partition, the returned arrays are views on the files (no copy).
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import shutil
+import threading
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+
+DTYPE = np.dtype('<f8')
+DATE_FIELD = 'date'
+
+
+def to_datetimes(timestamps):
+    """Convert an array of seconds since the epoch into a list of datetimes"""
+    return [datetime.fromtimestamp(t) for t in timestamps.tolist()]
+
+
+class SampleArchive:
+    """Day-partitioned columnar archive of samples
+
+    Parameters
+    ----------
+    root : str or Path
+        folder of the archive
+    fields : list
+        names of the fields to archive, besides 'date'
+    """
+
+    def __init__(self, root, fields):
+        self.root = Path(root)
+        self.fields = list(fields)
+        self.lock = threading.Lock()
+        self.last_timestamps = {}  # day -> date of its last archived sample
+
+    def _partition(self, day):
+        return self.root / day.strftime('%Y-%m-%d')
+
+    def _column_path(self, partition, field):
+        return partition / (field + '.f8')
+
+    def _read_column(self, partition, field, nb_rows):
+        """Memory-map a column of a partition, NaN when the field wasn't archived that day"""
+        path = self._column_path(partition, field)
+        size = path.stat().st_size // DTYPE.itemsize if path.exists() else 0
+        if size < nb_rows:
+            return np.full(nb_rows, np.nan)
+        return np.memmap(path, dtype=DTYPE, mode='r', shape=(nb_rows,))
+
+    def _nb_rows(self, partition):
+        path = self._column_path(partition, DATE_FIELD)
+        return path.stat().st_size // DTYPE.itemsize if path.exists() else 0
+
+    def _archived_last_timestamp(self, day):
+        """Date of the last archived sample of a day, None when the day is empty"""
+        partition = self._partition(day)
+        nb_rows = self._nb_rows(partition)
+        if nb_rows > 0:
+            return float(self._read_column(partition, DATE_FIELD, nb_rows)[-1])
+        return None
+
+    def append(self, sample):
+        """Append a sample to the partition of its day
+        Samples have to be appended in chronological order within a day.
+        Parameters
+        ----------
+        sample : dict
+            sensor values with a 'date' key
+        """
+        self.append_many([sample])
+
+    def append_many(self, samples):
+        """Append samples in chronological order, the days can be appended in any order
+        Parameters
+        ----------
+        samples : list
+            list of sample dicts with a 'date' key
+        """
+        with self.lock:
+            # Group the samples per day to write every column once per partition
+            partitions = {}
+            for sample in samples:
+                timestamp = sample['date'].timestamp()
+                day = sample['date'].date()
+                if day not in self.last_timestamps:
+                    self.last_timestamps[day] = self._archived_last_timestamp(day)
+                if self.last_timestamps[day] is not None and timestamp < self.last_timestamps[day]:
+                    raise ValueError('Samples have to be archived in chronological order')
+                self.last_timestamps[day] = timestamp
+                partitions.setdefault(day, []).append(sample)
+
+            for day, day_samples in partitions.items():
+                partition = self._partition(day)
+                partition.mkdir(parents=True, exist_ok=True)
+                nb_rows = self._nb_rows(partition)
+
+                columns = {DATE_FIELD: [s['date'].timestamp() for s in day_samples]}
+                for field in self.fields:
+                    columns[field] = [s.get(field) for s in day_samples]
+
+                for field, values in columns.items():
+                    path = self._column_path(partition, field)
+                    with open(path, 'ab') as f:
+                        # Columns added after the start of the day are padded with NaN
+                        missing = nb_rows - f.tell() // DTYPE.itemsize
+                        if missing > 0:
+                            f.write(np.full(missing, np.nan, dtype=DTYPE).tobytes())
+                        f.write(np.array(values, dtype=DTYPE).tobytes())
+
+    def remove(self, day):
+        """Delete the partition of a day, e.g. before archiving the day again"""
+        with self.lock:
+            shutil.rmtree(self._partition(day), ignore_errors=True)
+            self.last_timestamps.pop(day, None)
+
+    def days(self):
+        """Sorted list of the days in the archive"""
+        return sorted(datetime.strptime(p.name, '%Y-%m-%d').date()
+                      for p in self.root.glob('????-??-??') if p.is_dir())
+
+    def range(self, start, end=None, fields=None):
+        """Read the samples in a time range
+        Parameters
+        ----------
+        start : datetime
+        end : datetime or None
+            end of the range (exclusive), None for all samples from start onwards
+        fields : list or None
+            fields to read, None for all fields
+        Returns
+        -------
+        (timestamps, values)
+            numpy array with seconds since the epoch and dict with a numpy
+            array per field
+        """
+        fields = self.fields if fields is None else list(fields)
+        start_ts = start.timestamp()
+        end_ts = np.inf if end is None else end.timestamp()
+        if end is None:
+            days = self.days()
+            last_day = days[-1] if days else start.date()
+        else:
+            last_day = end.date()
+
+        parts_ts = []
+        parts_values = {field: [] for field in fields}
+        day = start.date()
+        while day <= last_day:
+            partition = self._partition(day)
+            nb_rows = self._nb_rows(partition)
+            day += timedelta(days=1)
+            if nb_rows == 0:
+                continue
+
+            timestamps = self._read_column(partition, DATE_FIELD, nb_rows)
+            # Binary search on the sorted dates
+            i_start = np.searchsorted(timestamps, start_ts, side='left')
+            i_end = np.searchsorted(timestamps, end_ts, side='left')
+            if i_start == i_end:
+                continue
+            parts_ts.append(timestamps[i_start:i_end])
+            for field in fields:
+                parts_values[field].append(self._read_column(partition, field, nb_rows)[i_start:i_end])
+
+        if len(parts_ts) == 1:
+            return parts_ts[0], {field: parts[0] for field, parts in parts_values.items()}
+        if not parts_ts:
+            return np.empty(0, dtype=DTYPE), {field: np.empty(0, dtype=DTYPE) for field in fields}
+        return (np.concatenate(parts_ts),
+                {field: np.concatenate(parts) for field, parts in parts_values.items()})
+
+    def since(self, timestamp, fields=None):
+        """Read the samples archived after a timestamp
+        Parameters
+        ----------
+        timestamp : float
+            seconds since the epoch, samples at this exact time are excluded
+        fields : list or None
+        Returns
+        -------
+        (timestamps, values)
+        """
+        timestamps, values = self.range(datetime.fromtimestamp(timestamp), fields=fields)
+        i_start = np.searchsorted(timestamps, timestamp, side='right')
+        return timestamps[i_start:], {field: v[i_start:] for field, v in values.items()}
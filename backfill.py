@@ -0,0 +1,470 @@
+# ------------------------------------------------------------------
+#              Bulk reprocessing of the stored samples
+# ------------------------------------------------------------------
+# Recomputes the ppm values of the stored samples after a correction
+# of the R0 values or of the curves in the config, and writes the
+# corrected documents back.
+#
+# Usage: python air_quality.py backfill --start 2026-01-01 --end 2026-07-01
+#
+# The time range is split into partitions of whole days, which are
+# read in parallel by worker threads. Every worker pages through its
+# partition with cursor queries ordered by date and document ID, and
+# handles a page at once:
+# - samples stored with ppm values: the Rs/R0 ratios are recovered
+#   from the stored values with the curves and R0 values they were
+#   computed with (--old-curves, --old-calibration), and converted
+#   again with the current ones
+# - samples stored with raw readings (INGEST_MODE 'raw'): the ppm
+#   values are derived with the calibration of the sample, they are
+#   not written back as they are derived when reading
+# The documents of which a value changed are written back in one
+# batched write per page, with the same document IDs.
+#
+# The progress is saved in a checkpoint file after every page, so an
+# interrupted run resumes where it stopped. With --rollups, the rollups
+# of the partitions are recomputed, and with --export the samples are
+# exported to a local columnar archive per device (see archive.py).
+# Those partitions are resumed from their start.
+#
+# The dates of the command line are in the time zone of the stored
+# dates, i.e. UTC on Firestore.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+
+import config as cfg
+from alert_engine import sample_key
+from calibration import load_calibrations, apply_calibration, usable_calibration
+from conversion import ConversionTable
+from derivation import CALIBRATION_FIELD, Deriver
+from encoding import ENVIRONMENT_FIELDS, VALUES_FIELD, SampleSchema, SchemaRegistry, sample_fields, schema_collection
+from loader import to_column
+from rollups import RollupAggregator, rollup_collection, rollup_doc_id
+from sample_buffer import FIRESTORE_MAX_BATCH_SIZE
+
+# Relative difference below which a recomputed value is unchanged, the compact samples are float32
+RTOL = 1e-4
+
+
+def partitions(start, end, days=1):
+    """Split a time range on midnights into partitions of whole days
+    Returns
+    -------
+    list
+        list of (start, end) tuples
+    """
+    bounds = [start]
+    midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    boundary = midnight + timedelta(days=days)
+    while boundary < end:
+        bounds.append(boundary)
+        boundary += timedelta(days=days)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class Checkpoint:
+    """Progress of every partition, saved in a JSON file after every page
+
+    Parameters
+    ----------
+    path : str or None
+        checkpoint file, None to keep the progress in memory only
+    params : dict
+        parameters of the run, a checkpoint of other parameters is ignored
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.lock = threading.Lock()
+        self.partitions = {}
+        if path is not None and Path(path).exists():
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['params'] == params:
+                self.partitions = saved['partitions']
+            else:
+                print('Checkpoint {} is of other parameters, starting from the beginning'.format(path))
+
+    def state(self, key):
+        """Progress of a partition: cursor after the last page, whether it's done and the counts"""
+        with self.lock:
+            return dict(self.partitions.get(key, {'after': None, 'done': False, 'read': 0, 'written': 0}))
+
+    def update(self, key, state):
+        with self.lock:
+            self.partitions[key] = state
+            if self.path is None:
+                return
+            # Written to a temporary file first, so an interruption never leaves a broken checkpoint
+            tmp_path = str(self.path) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'params': self.params, 'partitions': self.partitions}, f)
+            os.replace(tmp_path, self.path)
+
+
+class Reprocessor:
+    """Recompute the ppm values of pages of stored samples
+
+    Parameters
+    ----------
+    table : ConversionTable
+        current R0 values and curves
+    old_table : ConversionTable
+        R0 values and curves the stored ppm values were computed with
+    deriver : Deriver
+        calibrations of the samples stored with raw readings
+    schemas : SchemaRegistry
+        schemas of the compact samples that are read
+    """
+
+    def __init__(self, table, old_table, deriver, schemas):
+        self.table = table
+        self.old_table = old_table
+        self.deriver = deriver
+        self.schemas = schemas
+        # Corrected compact samples are written with the schema of the current config,
+        # only the samples with ppm values are corrected
+        self.schema = SampleSchema(sample_fields(table, 'ppm'))
+        self.ppm_keys = set(table.keys) | set(old_table.keys)
+        # Rs/R0 ratios of the stored values are rescaled to the current R0 values
+        self.r0_scale = old_table.r0/table.r0
+        self.fields = sorted(self.ppm_keys | set(table.raw_keys) | {'temperature', 'humidity', CALIBRATION_FIELD})
+
+    def recompute(self, page):
+        """Recompute the ppm values of a page of samples
+        Parameters
+        ----------
+        page : list
+            list of (document ID, stored sample) tuples
+        Returns
+        -------
+        (samples, ppm_vals, stored, changed)
+            keyed samples, recomputed values with shape (n_samples, n_keys),
+            stored values of the same keys and a boolean per sample that is
+            True when the stored document has to be corrected
+        """
+        samples = [self.schemas.expand(sample) for _, sample in page]
+        values = {field: to_column([sample.get(field) for sample in samples]) for field in self.fields}
+        stored = np.column_stack([values[key] for key in self.table.keys])
+
+        # Samples with raw readings, with the calibration of their device
+        derived = self.deriver.derive_columns(values, self.table.keys)
+        ppm_vals = np.column_stack([derived[key] for key in self.table.keys])
+        versions = values[CALIBRATION_FIELD]
+        raw = np.array([v is not None and v == v for v in versions.tolist()], dtype=bool)
+        # Raw samples are read with the derived values, as they aren't stored
+        stored[raw] = ppm_vals[raw]
+
+        # Samples with ppm values, back to Rs/R0 ratios and converted with the current curves
+        old_vals = np.column_stack([values[key] for key in self.old_table.keys])
+        ratios = self.old_table.ratios_from_ppm(old_vals[~raw]) * self.r0_scale
+        ppm_vals[~raw] = self.table.ppm_from_ratios(ratios)
+
+        changed = (~np.isclose(ppm_vals, stored, rtol=RTOL, equal_nan=True)).any(axis=1)
+        removed = [key for key in self.old_table.keys if key not in self.table.keys]
+        if removed:
+            changed |= np.isfinite(np.column_stack([values[key] for key in removed])).any(axis=1)
+        return samples, ppm_vals, stored, changed & ~raw
+
+    def corrected(self, stored_sample, sample, ppm_row):
+        """Document replacing a stored sample, in the same encoding
+        Values that aren't finite are left out, like the sampler does.
+        """
+        doc = {key: value for key, value in sample.items() if key not in self.ppm_keys}
+        doc.update((key, value) for key, value in zip(self.table.keys, ppm_row.tolist()) if np.isfinite(value))
+        return self.schema.compact(doc) if VALUES_FIELD in stored_sample else doc
+
+
+class Backfill:
+    """Reprocess the partitions of a time range in worker threads
+
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+    reprocessor : Reprocessor
+    checkpoint : Checkpoint
+    page_size : int
+        number of documents per query and per batched write
+    device : str or None
+        only reprocess the samples of this device
+    rollups : bool
+        recompute the rollups of the partitions
+    export_path : str or None
+        folder of the columnar export, one archive per device
+    dry_run : bool
+        count the corrections without writing them
+    """
+
+    def __init__(self, storage, collection_name, reprocessor, checkpoint, page_size=FIRESTORE_MAX_BATCH_SIZE,
+                 device=None, rollups=False, export_path=None, dry_run=False):
+        self.storage = storage
+        self.collection_name = collection_name
+        self.reprocessor = reprocessor
+        self.checkpoint = checkpoint
+        self.page_size = min(page_size, FIRESTORE_MAX_BATCH_SIZE)
+        self.device = device
+        self.rollups = rollups
+        self.export_path = export_path
+        self.dry_run = dry_run
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.archives = {}
+
+        # Number of samples above the upper bounds of the alert gases, stored and recomputed
+        self.bounds = [(gas, self.reprocessor.table.keys.index(sample_key(cfg.ALERT_SENSOR, gas)),
+                        cfg.UPPERBOUNDS[gas])
+                       for gas in cfg.ALERT_GASES if sample_key(cfg.ALERT_SENSOR, gas) in self.reprocessor.table.keys]
+        self.above = {gas: [0, 0] for gas, _, _ in self.bounds}
+
+    def archive(self, device):
+        """Columnar archive of the export of a device"""
+        from archive import SampleArchive
+
+        with self.lock:
+            if device not in self.archives:
+                table = self.reprocessor.table
+                self.archives[device] = SampleArchive(Path(self.export_path) / device,
+                                                      table.raw_keys + table.keys + ENVIRONMENT_FIELDS)
+            return self.archives[device]
+
+    def write(self, docs):
+        for i in range(0, len(docs), FIRESTORE_MAX_BATCH_SIZE):
+            self.storage.append(docs[i:i + FIRESTORE_MAX_BATCH_SIZE])
+
+    def process_partition(self, start, end):
+        """Reprocess the samples of a partition page by page
+        Returns
+        -------
+        dict
+            state of the partition, see Checkpoint
+        """
+        key = start.isoformat()
+        state = self.checkpoint.state(key)
+        if state['done']:
+            return state
+        whole = self.rollups or self.export_path is not None
+        if whole:
+            # The rollups and the export need all samples of the partition
+            state = {'after': None, 'done': False, 'read': 0, 'written': 0}
+        after = None if state['after'] is None else (datetime.fromisoformat(state['after'][0]), state['after'][1])
+
+        aggregators = {}
+        exported = {}
+        rollup_docs = []
+        while not self.stop_event.is_set():
+            page = self.storage.page(self.collection_name, start, end, after, self.page_size, self.device)
+            if not page:
+                break
+            samples, ppm_vals, stored, changed = self.reprocessor.recompute(page)
+            docs = [(self.collection_name, doc_id, self.reprocessor.corrected(stored_sample, samples[i], ppm_vals[i]))
+                    for i, (doc_id, stored_sample) in enumerate(page) if changed[i]]
+            if docs and not self.dry_run:
+                self.write(docs)
+
+            with self.lock:
+                for gas, index, bound in self.bounds:
+                    self.above[gas][0] += int(np.sum(stored[:, index] > bound))
+                    self.above[gas][1] += int(np.sum(ppm_vals[:, index] > bound))
+
+            if whole:
+                for sample, ppm_row in zip(samples, ppm_vals.tolist()):
+                    sample.update(zip(self.reprocessor.table.keys, ppm_row))
+                    device = sample.get('device', cfg.DEVICE_ID)
+                    if self.rollups:
+                        aggregator = aggregators.get(device)
+                        if aggregator is None:
+                            aggregator = aggregators[device] = RollupAggregator(
+                                self.reprocessor.table.keys + ENVIRONMENT_FIELDS, cfg.ROLLUP_RESOLUTIONS)
+                        rollup_docs.extend((device, resolution, rollup) for resolution, rollup in aggregator.add(sample))
+                    if self.export_path is not None:
+                        exported.setdefault(device, []).append(sample)
+
+            last_id, last_sample = page[-1]
+            after = (last_sample['date'], last_id)
+            state['after'] = [after[0].isoformat(), last_id]
+            state['read'] += len(page)
+            state['written'] += len(docs)
+            self.checkpoint.update(key, state)
+            if len(page) < self.page_size:
+                break
+
+        if self.stop_event.is_set():
+            return state
+
+        for device, aggregator in aggregators.items():
+            rollup_docs.extend((device, resolution, rollup) for resolution, rollup in aggregator.current())
+        if rollup_docs and not self.dry_run:
+            docs = []
+            for device, resolution, rollup in rollup_docs:
+                rollup['device'] = device
+                docs.append((rollup_collection(self.collection_name, resolution),
+                             rollup_doc_id(resolution, rollup['date'], device), rollup))
+            self.write(docs)
+
+        for device, device_samples in exported.items():
+            archive = self.archive(device)
+            # The days of the partition are archived again as a whole
+            day = start.date()
+            while day <= (end - timedelta(microseconds=1)).date():
+                archive.remove(day)
+                day += timedelta(days=1)
+            archive.append_many(device_samples)
+
+        state['done'] = True
+        self.checkpoint.update(key, state)
+        return state
+
+    def run(self, start, end, workers, partition_days=1):
+        """Reprocess a time range
+        Returns
+        -------
+        (nb_read, nb_written)
+        """
+        ranges = partitions(start, end, partition_days)
+        nb_read, nb_written, nb_done = 0, 0, 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+            futures = {executor.submit(self.process_partition, p_start, p_end): p_start for p_start, p_end in ranges}
+            try:
+                for future in as_completed(futures):
+                    state = future.result()
+                    nb_read += state['read']
+                    nb_written += state['written']
+                    nb_done += state['done']
+                    print('{} partition {} of {}: {} samples read, {} corrected'.format(
+                        datetime.now().strftime('%H:%M:%S'), nb_done, len(ranges), state['read'], state['written']))
+            except KeyboardInterrupt:
+                print('Stopping after the current pages, run the same command again to resume')
+                self.stop_event.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        return nb_read, nb_written
+
+
+def old_conversion_table(mq_sensors, calibration_index=None, curves_path=None, compensation=None):
+    """Conversion table of the R0 values and curves the stored ppm values were computed with
+    Parameters
+    ----------
+    mq_sensors : dict
+        current sensor settings, with the current R0 values
+    calibration_index : int or None
+        index of the calibration in CALIBRATION_PATH, None for the current R0 values
+    curves_path : str or None
+        JSON file with the curves, None for the curves of the config
+    compensation : CompensationTable or None
+        converts the R0 values of the calibration to the reference conditions
+    Returns
+    -------
+    ConversionTable
+    """
+    if calibration_index is not None:
+        mq_sensors = apply_calibration(mq_sensors, load_calibrations(cfg.CALIBRATION_PATH)[calibration_index],
+                                       compensation)
+    curves = cfg.CURVES
+    if curves_path is not None:
+        with open(curves_path) as f:
+            curves = json.load(f)
+    return ConversionTable(mq_sensors, curves)
+
+
+def parse_date(text):
+    return datetime.fromisoformat(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute the ppm values of the stored samples')
+    parser.add_argument('--start', type=parse_date, required=True, help='first date to reprocess, e.g. 2026-01-01')
+    parser.add_argument('--end', type=parse_date, default=None, help='end of the range (exclusive), default now')
+    parser.add_argument('--device', default=None, help='only reprocess the samples of this device')
+    parser.add_argument('--old-calibration', type=int, default=None,
+                        help='index in CALIBRATION_PATH of the R0 values of the stored ppm values, e.g. -2')
+    parser.add_argument('--old-curves', default=None, help='JSON file with the curves of the stored ppm values')
+    parser.add_argument('--workers', type=int, default=cfg.BACKFILL_WORKERS, help='number of worker threads')
+    parser.add_argument('--page-size', type=int, default=cfg.BACKFILL_PAGE_SIZE, help='documents per page')
+    parser.add_argument('--partition-days', type=int, default=cfg.BACKFILL_PARTITION_DAYS,
+                        help='number of days per partition')
+    parser.add_argument('--checkpoint', default=cfg.BACKFILL_CHECKPOINT_PATH, help='checkpoint file')
+    parser.add_argument('--rollups', action='store_true', help='recompute the rollups')
+    parser.add_argument('--export', default=None, help='folder of a columnar export per device')
+    parser.add_argument('--dry-run', action='store_true', help='count the corrections without writing them')
+    args = parser.parse_args()
+    end = args.end or datetime.now()
+
+    from storage import create_storage
+
+    storage = create_storage(cfg.STORAGE_BACKEND,
+                             firebase_path=Path.cwd() / cfg.FIREBASE_CREDS_JSON,
+                             sqlite_path=cfg.STORAGE_SQLITE_PATH)
+
+    # Current R0 values and curves, as used by get_sensor_values.py
+    compensation = None
+    if cfg.COMPENSATION:
+        from compensation import CompensationTable
+        compensation = CompensationTable(cfg.COMPENSATION, list(cfg.MQ_SENSORS.keys()))
+    calibrations = load_calibrations(cfg.CALIBRATION_PATH)
+    mq_sensors = apply_calibration(cfg.MQ_SENSORS, usable_calibration(calibrations), compensation)
+    table = ConversionTable(mq_sensors, cfg.CURVES, compensation=compensation)
+    old_table = old_conversion_table(mq_sensors, args.old_calibration, args.old_curves, compensation)
+
+    reprocessor = Reprocessor(table, old_table,
+                              Deriver(storage, cfg.FIREBASE_DB_NAME, cfg.MQ_SENSORS, cfg.CURVES, compensation),
+                              SchemaRegistry(storage, cfg.FIREBASE_DB_NAME))
+    if not args.dry_run:
+        doc_id, doc = reprocessor.schema.doc()
+        storage.append([(schema_collection(cfg.FIREBASE_DB_NAME), doc_id, doc)])
+
+    params = {
+        'collection': cfg.FIREBASE_DB_NAME,
+        'start': args.start.isoformat(),
+        'end': end.isoformat(),
+        'device': args.device,
+        'partition_days': args.partition_days,
+        'r0': table.r0.tolist(),
+        'old_r0': old_table.r0.tolist(),
+        'curves': cfg.CURVES,
+        'old_curves': args.old_curves,
+        'rollups': args.rollups,
+        'export': args.export
+    }
+    checkpoint = Checkpoint(args.checkpoint if not args.dry_run else None, params)
+    backfill = Backfill(storage, cfg.FIREBASE_DB_NAME, reprocessor, checkpoint,
+                        page_size=args.page_size,
+                        device=args.device,
+                        rollups=args.rollups,
+                        export_path=args.export,
+                        dry_run=args.dry_run)
+
+    started = time.perf_counter()
+    try:
+        nb_read, nb_written = backfill.run(args.start, end, args.workers, args.partition_days)
+    except KeyboardInterrupt:
+        print('Program stopped')
+    else:
+        elapsed = time.perf_counter() - started
+        print('{} samples read and {} corrected{} in {:.1f}s ({:.0f} samples/sec)'.format(
+            nb_read, nb_written, ' (dry run)' if args.dry_run else '', elapsed, nb_read / max(elapsed, 1e-9)))
+        for gas, (nb_stored, nb_new) in backfill.above.items():
+            print('{} above the upper bound of {}: {} stored, {} recomputed'.format(
+                cfg.ALERT_SENSOR, gas, nb_stored, nb_new))
@@ -0,0 +1,286 @@
+# ------------------------------------------------------------------
+#                  Benchmark of the sensor pipeline
+# ------------------------------------------------------------------
+# Drives the full ingest pipeline (analog readings -> health check ->
+# Rs/R0 -> ppm -> local buffer, rollups, archive and in-memory storage)
+# with the simulated sensors, at a multiple of real time. The samples
+# are stored by the same code as get_sensor_values.py (see ingest.py),
+# with the INGEST_MODE and SAMPLE_ENCODING of the config. For every speedup,
+# the throughput in samples/sec, the latency percentiles per stage
+# and the memory usage are reported. Use it as a baseline before
+# raising sampling rates.
+#
+# Usage: python benchmark.py --speedups 10 100 1000 --samples 500
+#
+# With --startup, the cold start of `python air_quality.py sample` is
+# measured instead: the time until the first sample is stored, and
+# the slowest imports reported by python -X importtime.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import argparse
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+import config as cfg
+from archive import SampleArchive
+from compensation import CompensationTable
+from conversion import ConversionTable
+from ingest import SampleStore
+from rollups import RollupAggregator
+from sample_buffer import SampleBuffer, BufferFlusher, storage_batch_writer
+from sampler import Sampler
+from sensors import SimulatedADC, SimulatedBME680, load_trace, read_analog_average, synthetic_trace
+from storage import MemoryStorage
+
+
+class StageTimer:
+    """Collect the durations of the stages of the pipeline"""
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timer(self, stage):
+        """Timer of one stage, like registry.timer, use as `with timer(stage).time():`"""
+        return StageTiming(self, stage)
+
+    def record(self, stage, duration):
+        self.durations.setdefault(stage, []).append(duration)
+
+    def percentiles(self, stage, q=(50, 95, 99)):
+        """Percentiles of the durations of a stage, in milliseconds"""
+        return np.percentile(np.array(self.durations[stage]) * 1000, q)
+
+
+class StageTiming:
+    """Durations of one stage of a StageTimer"""
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def time(self):
+        return self.timer.time(self.stage)
+
+
+def run_pipeline(speedup, nb_samples, trace, adc_delay, workdir):
+    """Run the pipeline with simulated sensors until nb_samples samples are stored
+    Parameters
+    ----------
+    speedup : float
+        multiple of real time, the sampling intervals are divided by it
+    nb_samples : int
+        number of samples to store
+    trace : numpy array
+        analog readings replayed by the simulator
+    adc_delay : float
+        number of seconds an analog reading takes
+    workdir : Path
+        folder for the buffer and the archive
+    Returns
+    -------
+    (timer, elapsed)
+        StageTimer and number of seconds the run took
+    """
+    timer = StageTimer()
+    # The R0 values don't change the timings, sensors that aren't calibrated get R0 = 1
+    mq_sensors = {sensor: dict(settings, r0=settings.get('r0') or 1) for sensor, settings in cfg.MQ_SENSORS.items()}
+    compensation = CompensationTable(cfg.COMPENSATION, list(mq_sensors.keys())) if cfg.COMPENSATION else None
+    table = ConversionTable(mq_sensors, cfg.CURVES, compensation=compensation)
+    adc = SimulatedADC(trace, delay=adc_delay)
+    bme680_sensor = SimulatedBME680()
+
+    def read_mq():
+        with timer.time('adc'):
+            raw = read_analog_average(adc, table.pins, cfg.NB_RS_READ, cfg.RS_INTERVAL / speedup)
+            return dict(zip(table.raw_keys, raw.tolist()))
+
+    def read_bme680():
+        with timer.time('bme680'):
+            return bme680_sensor.read()
+
+    sample_buffer = SampleBuffer(workdir / 'benchmark_{}.db'.format(speedup))
+    rollup_aggregator = RollupAggregator(table.keys + ['temperature', 'pressure', 'humidity'],
+                                         cfg.ROLLUP_RESOLUTIONS)
+    archive = SampleArchive(workdir / 'archive_{}'.format(speedup), table.raw_keys + rollup_aggregator.fields)
+    store = SampleStore(table, sample_buffer, rollup_aggregator, archive, timer=timer.timer)
+    store.store_metadata()
+    # Firestore is replaced by the in-memory storage backend
+    flusher = BufferFlusher(sample_buffer, storage_batch_writer(MemoryStorage(), cfg.FIREBASE_DB_NAME),
+                            interval=cfg.FIREBASE_FLUSH_INTERVAL / speedup)
+
+    sampler = Sampler(read_mq, read_bme680,
+                      mq_interval=cfg.FIREBASE_INTERVAL / speedup,
+                      bme680_interval=cfg.BME680_INTERVAL / speedup,
+                      queue_size=cfg.SAMPLE_QUEUE_SIZE)
+
+    start = time.perf_counter()
+    sampler.start()
+    flusher.start()
+    nb_stored = 0
+    for sample in sampler.samples():
+        store.store(sample)
+        nb_stored += 1
+        if nb_stored >= nb_samples:
+            break
+    elapsed = time.perf_counter() - start
+
+    sampler.stop()
+    flusher.stop()
+    sample_buffer.close()
+    return timer, elapsed
+
+
+# Settings of the startup benchmark, appended to a copy of the config
+STARTUP_CONFIG = '''
+SENSOR_BACKEND = 'simulated'
+SIMULATED_TRACE = None
+STORAGE_BACKEND = 'memory'
+COLLECTOR_URL = None
+OVERSAMPLING = False
+NB_RS_READ = 1
+METRICS_PORTS = {}
+PROFILE_PATH = None
+MQ_SENSORS = {sensor: dict(settings, r0=settings.get('r0') or 1) for sensor, settings in MQ_SENSORS.items()}
+'''
+
+
+def parse_importtime(path):
+    """Cumulative import time per top-level module of a python -X importtime log
+    Returns
+    -------
+    dict
+        number of seconds per module
+    """
+    imports = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.startswith('  '):
+                imports[name.strip()] = int(cumulative) / 1e6
+    return imports
+
+
+def run_startup(workdir, timeout=60):
+    """Start the sample command with simulated sensors and wait for its first sample
+    Parameters
+    ----------
+    workdir : Path
+        working directory of the command, with its config, buffer and archive
+    timeout : float
+        maximum number of seconds to wait for the first sample
+    Returns
+    -------
+    (elapsed, imports)
+        seconds until the first sample was stored and import time per top-level module
+    """
+    config_source = Path(cfg.__file__).read_text()
+    (workdir / 'config.py').write_text(config_source + '\n' + STARTUP_CONFIG)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(workdir), str(Path(__file__).resolve().parent)]))
+    log_path = workdir / 'importtime.log'
+
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-X', 'importtime',
+                                    str(Path(__file__).resolve().parent / 'air_quality.py'), 'sample'],
+                                   cwd=str(workdir), env=env, stdout=subprocess.PIPE, stderr=log,
+                                   universal_newlines=True)
+        elapsed = None
+        try:
+            for line in process.stdout:
+                if line.startswith('First sample stored'):
+                    elapsed = time.perf_counter() - start
+                    break
+                if time.perf_counter() - start > timeout:
+                    break
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+    if elapsed is None:
+        raise RuntimeError('The sample command stored no sample, see ' + str(log_path))
+    return elapsed, parse_importtime(log_path)
+
+
+def print_startup_report(durations, imports, nb_imports=10):
+    print('\nTime to first sample over {} runs: median {:.3f}s, min {:.3f}s, max {:.3f}s'.format(
+        len(durations), np.median(durations), min(durations), max(durations)))
+    print('Total import time: {:.3f}s'.format(sum(imports.values())))
+    print('{:<30} {:>10}'.format('slowest imports', 'time (s)'))
+    for name, duration in sorted(imports.items(), key=lambda item: -item[1])[:nb_imports]:
+        print('{:<30} {:>10.3f}'.format(name, duration))
+
+
+def print_report(speedup, nb_samples, timer, elapsed, peak_memory):
+    print('\nSpeedup {}x: {} samples in {:.2f}s, {:.1f} samples/sec'.format(
+        speedup, nb_samples, elapsed, nb_samples / elapsed))
+    print('{:<10} {:>10} {:>10} {:>10}'.format('stage', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for stage in timer.durations.keys():
+        p50, p95, p99 = timer.percentiles(stage)
+        print('{:<10} {:>10.3f} {:>10.3f} {:>10.3f}'.format(stage, p50, p95, p99))
+    print('Peak traced memory: {:.1f} MB'.format(peak_memory / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the sensor pipeline with simulated sensors')
+    parser.add_argument('--speedups', type=float, nargs='+', default=[10, 100, 1000],
+                        help='multiples of real time to run the pipeline at')
+    parser.add_argument('--samples', type=int, default=200, help='number of samples per run')
+    parser.add_argument('--trace', default=None, help='CSV or .npy file with recorded analog readings')
+    parser.add_argument('--adc-delay', type=float, default=0, help='seconds per analog reading')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the time to the first sample of air_quality.py sample instead')
+    parser.add_argument('--runs', type=int, default=5, help='number of cold starts with --startup')
+    args = parser.parse_args()
+
+    if args.startup:
+        durations = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as workdir:
+                elapsed, imports = run_startup(Path(workdir))
+                durations.append(elapsed)
+        print_startup_report(durations, imports)
+        sys.exit()
+
+    pins = [data['pin'] for data in cfg.MQ_SENSORS.values()]
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(100000, pins)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for speedup in args.speedups:
+            tracemalloc.start()
+            timer, elapsed = run_pipeline(speedup, args.samples, trace, args.adc_delay, Path(workdir))
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print_report(speedup, args.samples, timer, elapsed, peak_memory)
+
+    # ru_maxrss is in kilobytes on Linux
+    print('\nMax resident set size: {:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
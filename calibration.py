@@ -0,0 +1,315 @@
+# ------------------------------------------------------------------
+#                    Calibration of the MQ sensors
+# ------------------------------------------------------------------
+# Robust estimate of the R0 values of the MQ sensors in clean air.
+#
+# All analog pins are read in every pass and the R0 values of the
+# readings are kept in one preallocated array. The readings taken
+# while a sensor is still warming up (a drifting trend) are left out,
+# as are outliers. The calibration stops as soon as the 95%
+# confidence interval of every sensor is narrow enough, instead of
+# after a fixed number of readings. Consecutive readings are
+# correlated, so the confidence interval is computed on the means of
+# blocks of readings rather than on the readings themselves.
+#
+# The results are stored in a calibration file (JSON) together with
+# the temperature and humidity at calibration time. The latest
+# calibration that converged is loaded by get_sensor_values.py at
+# startup, the other ones are only kept as a record.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import json
+import math
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+# Two-sided 95% quantile of the normal distribution
+Z_95 = 1.96
+
+
+def r0_from_raw(raw_values, r0_rs_air, vc, ar_max):
+    """Compute R0 values from analog readings in clean air
+    Parameters
+    ----------
+    raw_values : array-like
+        analogRead values, the last axis has one entry per sensor
+    r0_rs_air : array-like
+        R0/Rs ratio in clean air per sensor
+    vc : float
+        circuit voltage
+    ar_max : int
+        maximum output value of the analogRead method
+    Returns
+    -------
+    numpy array
+        R0 values with the same shape as raw_values
+    """
+    # sensor voltage
+    voltages = np.asarray(raw_values, dtype=float)/ar_max * vc
+    # sensor resistance
+    with np.errstate(divide='ignore'):
+        resistances = (vc - voltages)/voltages
+    return resistances/np.asarray(r0_rs_air, dtype=float)
+
+
+def outlier_mask(values, threshold=3.5):
+    """Mark the values that are not outliers, using the modified z-score
+    Parameters
+    ----------
+    values : numpy array
+    threshold : float
+        values with a modified z-score above the threshold are outliers
+    Returns
+    -------
+    numpy array
+        boolean array, True for the values to keep
+    """
+    deviations = np.abs(values - np.median(values))
+    mad = np.median(deviations)
+    if mad > 0:
+        return 0.6745 * deviations/mad <= threshold
+    # More than half of the values are equal, fall back on the mean absolute deviation
+    mean_ad = deviations.mean()
+    if mean_ad > 0:
+        return deviations/(1.253314 * mean_ad) <= threshold
+    return np.ones(len(values), dtype=bool)
+
+
+def relative_drift(values):
+    """Change of the linear trend over the values, relative to their mean, per column"""
+    nb_values = len(values)
+    x = np.arange(nb_values) - (nb_values - 1)/2
+    means = values.mean(axis=0)
+    slopes = x @ (values - means)/(x @ x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(slopes * nb_values/means)
+
+
+class R0Calibrator:
+    """Running calibration of the R0 values of several sensors
+
+    Parameters
+    ----------
+    r0_rs_air : list
+        R0/Rs ratio in clean air per sensor
+    max_reads : int
+        maximum number of readings per sensor
+    min_reads : int
+        minimum number of readings per sensor after the warm-up
+    ci_tolerance : float
+        half-width of the 95% confidence interval, relative to R0, at which a sensor is calibrated
+    drift_window : int
+        number of last readings on which the warm-up drift is measured
+    drift_tolerance : float
+        change of R0 over the drift window, relative to R0, below which a sensor is warmed up
+    block_size : int
+        number of consecutive readings averaged into one value for the confidence interval
+    outlier_threshold : float
+        modified z-score above which a reading is an outlier
+    vc : float
+        circuit voltage
+    ar_max : int
+        maximum output value of the analogRead method
+    """
+
+    def __init__(self, r0_rs_air, max_reads, min_reads=30, ci_tolerance=0.01, drift_window=20,
+                 drift_tolerance=0.02, block_size=1, outlier_threshold=3.5, vc=5, ar_max=1023):
+        self.r0_rs_air = np.asarray(r0_rs_air, dtype=float)
+        self.max_reads = max_reads
+        self.min_reads = min_reads
+        self.ci_tolerance = ci_tolerance
+        self.drift_window = drift_window
+        self.drift_tolerance = drift_tolerance
+        self.block_size = max(int(block_size), 1)
+        self.outlier_threshold = outlier_threshold
+        self.vc = vc
+        self.ar_max = ar_max
+
+        self.values = np.empty((max_reads, len(self.r0_rs_air)))
+        self.nb_reads = 0
+        # Index of the first reading after the warm-up per sensor, -1 while warming up
+        self.warm_from = np.full(len(self.r0_rs_air), -1)
+
+    @property
+    def full(self):
+        return self.nb_reads >= self.max_reads
+
+    def add(self, raw_values):
+        """Add one reading of every sensor"""
+        self.values[self.nb_reads] = r0_from_raw(raw_values, self.r0_rs_air, self.vc, self.ar_max)
+        self.nb_reads += 1
+
+        warming_up = self.warm_from < 0
+        if warming_up.any() and self.nb_reads >= self.drift_window:
+            window = self.values[self.nb_reads - self.drift_window:self.nb_reads]
+            warm = warming_up & (relative_drift(window) <= self.drift_tolerance)
+            self.warm_from[warm] = self.nb_reads - self.drift_window
+
+    def estimate(self):
+        """Current estimate of the R0 values
+        Sensors that are still warming up use all their readings.
+        Returns
+        -------
+        (r0, ci, nb_used)
+            numpy arrays with per sensor the mean R0 value, the half-width of the
+            95% confidence interval and the number of readings used
+        """
+        nb_sensors = len(self.r0_rs_air)
+        r0, ci, nb_used = np.full(nb_sensors, np.nan), np.full(nb_sensors, np.inf), np.zeros(nb_sensors, dtype=int)
+        for i in range(nb_sensors):
+            values = self.values[max(self.warm_from[i], 0):self.nb_reads, i]
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                continue
+            values = values[outlier_mask(values, self.outlier_threshold)]
+            r0[i] = values.mean()
+            nb_used[i] = len(values)
+            # Means of the complete blocks, which are close to independent
+            nb_blocks = len(values) // self.block_size
+            if nb_blocks > 1:
+                blocks = values[:nb_blocks * self.block_size].reshape(nb_blocks, self.block_size).mean(axis=1)
+                ci[i] = Z_95 * blocks.std(ddof=1)/np.sqrt(nb_blocks)
+        return r0, ci, nb_used
+
+    def converged(self):
+        """Whether all sensors are warmed up and have a narrow enough confidence interval"""
+        if (self.warm_from < 0).any():
+            return False
+        r0, ci, nb_used = self.estimate()
+        return bool(np.all((nb_used >= self.min_reads) & (ci <= self.ci_tolerance * np.abs(r0))))
+
+
+def nb_readings(seconds, interval):
+    """Number of readings taken in a number of seconds, at least 1"""
+    return max(int(round(seconds/interval)), 1) if interval else 1
+
+
+def calibrate(adc, pins, calibrator, interval, check_every=10):
+    """Read all pins until the calibration converges or the maximum number of readings is reached
+    Parameters
+    ----------
+    adc : analog backend
+        see sensors.py
+    pins : list
+        analog pins, in the order of the sensors of the calibrator
+    calibrator : R0Calibrator
+    interval : float
+        number of seconds between two readings
+    check_every : int
+        number of readings between two convergence checks
+    Returns
+    -------
+    bool
+        True if the calibration converged
+    """
+    raw_values = np.zeros(len(pins))
+    while not calibrator.full:
+        for idx, pin in enumerate(pins):
+            raw_values[idx] = adc.read_analog(pin)
+        calibrator.add(raw_values)
+        if calibrator.nb_reads % check_every == 0 and calibrator.converged():
+            return True
+        if interval:
+            time.sleep(interval)
+    return calibrator.converged()
+
+
+def load_calibrations(path):
+    """Read all calibrations of a calibration file, oldest first, empty if the file doesn't exist"""
+    path = Path(path)
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return json.load(f)['calibrations']
+
+
+def usable_calibration(calibrations):
+    """Latest calibration that converged, with a finite and positive R0 value for every sensor
+    Parameters
+    ----------
+    calibrations : list
+        calibrations, oldest first (see load_calibrations)
+    Returns
+    -------
+    dict or None
+    """
+    for calibration in reversed(calibrations):
+        r0_values = list(calibration['r0'].values())
+        if calibration.get('converged') and all(r0 is not None and math.isfinite(r0) and r0 > 0
+                                                for r0 in r0_values):
+            return calibration
+    return None
+
+
+def save_calibration(path, r0, ci, nb_used, converged=True, environment=None, date=None):
+    """Append a calibration to a calibration file
+    Parameters
+    ----------
+    path : str or Path
+    r0, ci, nb_used : dict
+        R0 value, half-width of the 95% confidence interval and number of readings per sensor
+    converged : bool
+        whether the confidence intervals converged
+    environment : dict or None
+        temperature, pressure and humidity at calibration time
+    date : datetime or None
+        date of the calibration, None for now
+    Returns
+    -------
+    dict
+        the stored calibration
+    """
+    calibration = {
+        'date': (date or datetime.now()).isoformat(),
+        'r0': r0,
+        'ci': ci,
+        'nb_reads': nb_used,
+        'converged': converged
+    }
+    calibration.update(environment or {})
+    calibrations = load_calibrations(path)
+    calibrations.append(calibration)
+    with open(path, 'w') as f:
+        json.dump({'calibrations': calibrations}, f, indent=2)
+    return calibration
+
+
+def apply_calibration(mq_sensors, calibration, compensation=None):
+    """Settings of the MQ sensors with the R0 values of a calibration
+    Parameters
+    ----------
+    mq_sensors : dict
+        sensor settings (see cfg.MQ_SENSORS)
+    calibration : dict or None
+        calibration with an 'r0' value per sensor, None to keep the configured values
+    compensation : CompensationTable or None
+        converts the R0 values to the reference conditions, with the temperature
+        and humidity of the calibration if they were recorded
+    Returns
+    -------
+    dict
+        copy of mq_sensors
+    """
+    calibrated = {sensor: dict(settings) for sensor, settings in mq_sensors.items()}
+    if calibration is not None:
+        r0_values = calibration['r0']
+        if compensation is not None:
+            r0_values = compensation.reference_r0(r0_values, calibration.get('temperature'),
+                                                  calibration.get('humidity'))
+        for sensor, r0 in r0_values.items():
+            if sensor in calibrated:
+                calibrated[sensor]['r0'] = r0
+    missing = [sensor for sensor, settings in calibrated.items() if settings.get('r0') is None]
+    if missing:
+        raise ValueError('No R0 value for sensors {}, run get_R0_values.py first'.format(', '.join(missing)))
+    return calibrated
@@ -0,0 +1,147 @@
+# ------------------------------------------------------------------
+#                   Collector of samples of many rooms
+# ------------------------------------------------------------------
+# Small HTTP service receiving the samples of several Raspberry Pi
+# nodes (one per room) on the local network. The samples are written
+# to a local write-ahead buffer and committed to Firebase in batches
+# of up to 500 documents, whatever the number of nodes.
+#
+# Nodes send their samples with a POST request to /samples when
+# COLLECTOR_URL is set in their config. The body is a JSON list of
+# {"collection": ..., "doc_id": ..., "sample": {...}} objects, or a
+# binary batch of compact samples (see encoding.py).
+#
+# Run the collector with: python collector.py
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import json
+import struct
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from encoding import BATCH_CONTENT_TYPE, encode_batch, decode_batch
+from sample_buffer import encode_sample, parse_sample
+
+
+def http_batch_writer(url, timeout=10, binary=False):
+    """Create a function sending samples to a collector in one request
+    Parameters
+    ----------
+    url : str
+        address of the collector, e.g. http://192.168.1.10:8060/samples
+    timeout : float
+        number of seconds to wait for the collector
+    binary : bool
+        whether to send a binary batch instead of JSON, for compact samples
+    Returns
+    -------
+    callable
+        function taking a list of (collection, document ID, sample dict) tuples
+    """
+    def write_batch(docs):
+        if binary:
+            body = encode_batch(docs)
+            content_type = BATCH_CONTENT_TYPE
+        else:
+            body = ('[' + ','.join(
+                '{{"collection": {}, "doc_id": {}, "sample": {}}}'.format(
+                    json.dumps(collection), json.dumps(doc_id), encode_sample(sample))
+                for collection, doc_id, sample in docs) + ']').encode('utf-8')
+            content_type = 'application/json'
+        request = urllib.request.Request(url, data=body, method='POST',
+                                         headers={'Content-Type': content_type})
+        # urlopen raises an exception when the collector can't be reached or returns an error
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+    return write_batch
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    """Append the samples posted by a node to the buffer of the server"""
+
+    def do_POST(self):
+        if self.path != '/samples':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type') == BATCH_CONTENT_TYPE:
+                rows = decode_batch(body)
+            else:
+                rows = [(doc['collection'], doc['doc_id'], parse_sample(doc['sample']))
+                        for doc in json.loads(body)]
+        except (ValueError, KeyError, TypeError, struct.error):
+            self.send_error(400, 'Invalid samples')
+            return
+
+        self.server.sample_buffer.append_many(rows)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Only errors are printed, not every request
+        pass
+
+
+def create_server(host, port, sample_buffer):
+    """Create the HTTP server of the collector
+    Parameters
+    ----------
+    host : str
+    port : int
+    sample_buffer : SampleBuffer
+        buffer receiving the samples of all nodes
+    Returns
+    -------
+    ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), CollectorHandler)
+    server.sample_buffer = sample_buffer
+    return server
+
+
+if __name__ == '__main__':
+    from datetime import timedelta
+    from pathlib import Path
+
+    import config as cfg
+
+    from sample_buffer import SampleBuffer, BufferFlusher, storage_batch_writer
+    from storage import create_storage
+
+    # Firestore, or a local stand-in chosen with STORAGE_BACKEND
+    storage = create_storage(cfg.STORAGE_BACKEND,
+                             firebase_path=Path.cwd() / cfg.FIREBASE_CREDS_JSON,
+                             sqlite_path=cfg.STORAGE_SQLITE_PATH)
+
+    sample_buffer = SampleBuffer(cfg.COLLECTOR_BUFFER_DB_PATH)
+    flusher = BufferFlusher(sample_buffer,
+                            storage_batch_writer(storage, cfg.FIREBASE_DB_NAME),
+                            interval=cfg.FIREBASE_FLUSH_INTERVAL,
+                            batch_size=cfg.FIREBASE_BATCH_SIZE,
+                            max_backoff=cfg.FIREBASE_MAX_BACKOFF,
+                            retention=timedelta(days=cfg.BUFFER_RETENTION_DAYS))
+    flusher.start()
+
+    server = create_server(cfg.COLLECTOR_HOST, cfg.COLLECTOR_PORT, sample_buffer)
+    print('Collector listening on {}:{}'.format(cfg.COLLECTOR_HOST, cfg.COLLECTOR_PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Program stopped')
+        server.server_close()
+        flusher.stop()
+        sample_buffer.close()
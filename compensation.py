@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------
+#           Temperature and humidity compensation of the MQ sensors
+# ------------------------------------------------------------------
+# The resistance Rs of an MQ sensor depends on the temperature and
+# the humidity. The data sheets give the ratio Rs/Rs_ref against the
+# temperature for a few humidity levels, where Rs_ref is measured at
+# the reference conditions (e.g. 20 degrees C and 65% humidity).
+#
+# These curves are interpolated once at startup onto a fine grid of
+# temperature and humidity. Compensating a sample is then a lookup of
+# the nearest grid point, vectorized over all sensors and samples, so
+# its cost does not depend on the number of points on the curves.
+#
+# The R0 values are measured at the temperature and humidity of the
+# calibration, they are converted to the reference conditions as well
+# (see reference_r0), so Rs and R0 are compared at the same conditions.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import numpy as np
+
+
+def interpolate_curve(curve, temperatures, humidities):
+    """Interpolate a correction curve on a grid of temperature and humidity
+    Outside the range of the curve, the values at its edges are used.
+    Parameters
+    ----------
+    curve : dict
+        'temperature': list of temperatures,
+        'humidity': list of humidity levels in increasing order,
+        'factor': Rs/Rs_ref per humidity level and temperature
+    temperatures : numpy array
+        temperatures of the grid
+    humidities : numpy array
+        humidity levels of the grid
+    Returns
+    -------
+    numpy array
+        Rs/Rs_ref with shape (len(temperatures), len(humidities))
+    """
+    curve_temperatures = np.asarray(curve['temperature'], dtype=float)
+    curve_humidities = np.asarray(curve['humidity'], dtype=float)
+    factors = np.asarray(curve['factor'], dtype=float)
+
+    # Interpolate every humidity level over the temperature grid
+    rows = np.array([np.interp(temperatures, curve_temperatures, level) for level in factors])
+
+    # Interpolate linearly between the humidity levels
+    if len(curve_humidities) == 1:
+        return np.repeat(rows.T, len(humidities), axis=1)
+    h = np.clip(humidities, curve_humidities[0], curve_humidities[-1])
+    upper = np.clip(np.searchsorted(curve_humidities, h), 1, len(curve_humidities) - 1)
+    lower = upper - 1
+    weights = (h - curve_humidities[lower])/(curve_humidities[upper] - curve_humidities[lower])
+    return rows[lower].T * (1 - weights) + rows[upper].T * weights
+
+
+class CompensationTable:
+    """Correction factors of the Rs/R0 ratios for temperature and humidity
+
+    Parameters
+    ----------
+    curves : dict
+        correction curve per MQ sensor (see cfg.COMPENSATION), sensors
+        without a curve are not compensated
+    sensors : list
+        names of the MQ sensors, in the order of the columns of the ratios
+    temperature_range : tuple
+        (minimum, maximum, step) of the temperature grid
+    humidity_range : tuple
+        (minimum, maximum, step) of the humidity grid
+    """
+
+    def __init__(self, curves, sensors, temperature_range=(-20, 60, 0.25), humidity_range=(0, 100, 1)):
+        self.sensors = list(sensors)
+        self.t_min, t_max, self.t_step = temperature_range
+        self.h_min, h_max, self.h_step = humidity_range
+        temperatures = np.arange(self.t_min, t_max + self.t_step/2, self.t_step)
+        humidities = np.arange(self.h_min, h_max + self.h_step/2, self.h_step)
+
+        # Grid with shape (temperatures, humidities, sensors), 1 for sensors without a curve
+        self.grid = np.ones((len(temperatures), len(humidities), len(sensors)))
+        for i, sensor in enumerate(sensors):
+            if sensor in curves:
+                self.grid[:, :, i] = interpolate_curve(curves[sensor], temperatures, humidities)
+
+    def factors(self, temperature, humidity):
+        """Look up the correction factors Rs/Rs_ref
+        Parameters
+        ----------
+        temperature : float or numpy array
+        humidity : float or numpy array
+            same shape as temperature, neither may contain NaN
+        Returns
+        -------
+        numpy array
+            factors with shape (n_sensors,) or (n_samples, n_sensors)
+        """
+        t_idx = np.rint((np.asarray(temperature, dtype=float) - self.t_min)/self.t_step)
+        h_idx = np.rint((np.asarray(humidity, dtype=float) - self.h_min)/self.h_step)
+        t_idx = np.clip(t_idx, 0, self.grid.shape[0] - 1).astype(int)
+        h_idx = np.clip(h_idx, 0, self.grid.shape[1] - 1).astype(int)
+        return self.grid[t_idx, h_idx]
+
+    def reference_r0(self, r0, temperature, humidity):
+        """Convert R0 values measured at a temperature and humidity to the reference conditions
+        Parameters
+        ----------
+        r0 : dict
+            R0 value per sensor
+        temperature : float or None
+            temperature at calibration time
+        humidity : float or None
+            humidity at calibration time
+        Returns
+        -------
+        dict
+            R0 value per sensor, unchanged if the temperature or humidity wasn't recorded
+        """
+        if temperature is None or humidity is None or not np.isfinite([temperature, humidity]).all():
+            return dict(r0)
+        factors = dict(zip(self.sensors, self.factors(temperature, humidity).tolist()))
+        return {sensor: value/factors.get(sensor, 1) for sensor, value in r0.items()}
+
+    def compensate(self, ratios, temperature, humidity):
+        """Convert Rs/R0 ratios to the ratios at the reference conditions
+        Samples with a missing temperature or humidity are not compensated.
+        Parameters
+        ----------
+        ratios : numpy array
+            Rs/R0 ratios with shape (n_sensors,) or (n_samples, n_sensors)
+        temperature : float, numpy array or None
+            temperature per sample
+        humidity : float, numpy array or None
+            humidity per sample
+        Returns
+        -------
+        numpy array
+            compensated ratios with the same shape as ratios
+        """
+        if temperature is None or humidity is None:
+            return ratios
+        temperature = np.asarray(temperature, dtype=float)
+        humidity = np.asarray(humidity, dtype=float)
+        missing = np.isnan(temperature) | np.isnan(humidity)
+        factors = self.factors(np.where(missing, self.t_min, temperature), np.where(missing, self.h_min, humidity))
+        factors[missing] = 1
+        return ratios/factors
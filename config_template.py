@@ -13,14 +13,64 @@
 VC = 5.0  # Circuit voltage
 AR_MAX = 1023  # Maximum output value of the analogRead method
 
+# Sensor backend: 'grovepi' for the real sensors, 'simulated' to run without a Raspberry Pi
+SENSOR_BACKEND = 'grovepi'
+SIMULATED_TRACE = None  # CSV or .npy file with recorded analog readings, None for a synthetic trace
+
+# ------------------------------------------------------------------
+#                          Devices and rooms
+# ------------------------------------------------------------------
+DEVICE_ID = 'living_room'  # name of the room of this Raspberry Pi, stored with every sample
+DEVICES = [DEVICE_ID]  # all rooms, shown on the dashboard and checked for alerts
+
 # ------------------------------------------------------------------
 #                      Sensor reading parameters
 # ------------------------------------------------------------------
-NB_R0_READ = 50  # number of readings to average R0 value
+# A calibration takes at least R0_DRIFT_WINDOW: the heater of an MQ sensor warms up for
+# minutes, which can't be told apart from a stable sensor over a window of seconds.
+# A sensor that is already warm converges as soon as the first drift window is complete.
+NB_R0_READ = 7200  # maximum number of readings to compute the R0 values (1 hour)
 R0_INTERVAL = 0.5  # number of seconds between each reading for R0
+R0_MIN_READ = 200  # minimum number of readings per sensor after the warm-up (100 seconds)
+R0_CI_TOLERANCE = 0.01  # calibration stops when the 95% confidence interval is within 1% of R0
+R0_BLOCK = 10  # number of seconds of readings averaged into one value for the confidence interval
+R0_DRIFT_WINDOW = 300  # number of seconds of the last readings on which the warm-up drift is measured
+R0_DRIFT_TOLERANCE = 0.02  # a sensor is warmed up when R0 changes less than 2% over the drift window
+R0_OUTLIER_THRESHOLD = 3.5  # readings with a higher modified z-score are left out
+CALIBRATION_PATH = 'calibration.json'  # R0 values measured with get_R0_values.py
 NB_RS_READ = 5  # number of readings for the sensor value
 RS_INTERVAL = 0.05  # number of seconds between each reading for Rs
 
+# High-rate oversampling: a thread reads the MQ sensors continuously and every sample
+# is the filtered value of the last OVERSAMPLING_WINDOW readings, instead of NB_RS_READ readings
+OVERSAMPLING = False
+OVERSAMPLING_RATE = 200  # number of readings per second of every pin, None for as fast as possible
+OVERSAMPLING_WINDOW = 256  # number of readings per pin the filter is applied on
+OVERSAMPLING_FILTER = 'median'  # 'median', 'trimmed_mean', 'mean' or 'ema'
+OVERSAMPLING_TRIM = 0.1  # fraction of the lowest and highest readings left out by 'trimmed_mean'
+OVERSAMPLING_EMA_ALPHA = 0.05  # smoothing factor of 'ema'
+
+# Health of the MQ sensors, see health.py: readings on a rail (0 or AR_MAX), stuck at the
+# same value or not finite are left out of the samples, spikes are tagged
+HEALTH_RAIL_MARGIN = 2  # readings within this distance of 0 or AR_MAX are on a rail
+HEALTH_STUCK_COUNT = 60  # number of identical readings in a row of a stuck sensor, None to disable
+HEALTH_STUCK_TOLERANCE = 1  # noise in ADC counts below which repeated readings are a steady sensor, not a stuck one
+HEALTH_Z_THRESHOLD = 6  # rolling z-score above which a reading is a spike
+HEALTH_EWMA_ALPHA = 0.05  # weight of a new reading in the rolling mean and variance
+HEALTH_WARMUP = 30  # number of readings before spikes are detected
+
+# What is stored of every sample:
+# 'ppm': the ppm values of all sensors and gases
+# 'raw': the analog readings and the calibration version, the ppm values are derived when reading
+INGEST_MODE = 'ppm'
+
+# How the values of every sample are stored and sent to the collector:
+# 'keyed': one field per value, e.g. 'mq2_co_ppm'
+# 'compact': all values packed as float32 in one bytes field, see encoding.py
+SAMPLE_ENCODING = 'keyed'
+BME680_INTERVAL = 60  # number of seconds between each reading of the BME680 sensor
+SAMPLE_QUEUE_SIZE = 1000  # maximum number of readings waiting to be sent
+
 # ------------------------------------------------------------------
 #                             MQ sensors
 # ------------------------------------------------------------------
@@ -29,27 +79,63 @@ RS_INTERVAL = 0.05  # number of seconds between each reading for Rs
 # http://wiki.seeedstudio.com/Grove-Gas_Sensor-MQ5/
 # pin: analog port numbers on the GrovePi
 # r0_rs_air: R0/Rs ratio in clean air
-# r0: this values should be filled in after measuring it with get_R0_values.py
+# r0: measured with get_R0_values.py and loaded from CALIBRATION_PATH, a value filled in here
+#     is only used when there is no calibration file
 # CAUTION : the r0_rs_air values are extracted by sight on the graphs and therefore will be an approximation
 # To be used at your own risk
 MQ_SENSORS = {
     'mq2': {
         'pin': 0,
         'r0_rs_air': 9.48,
-        'r0': # FILL IN
+        'r0': None
     },
     'mq9': {
         'pin': 1,
         'r0_rs_air': 9.74,
-        'r0': # FILL IN
+        'r0': None
     },
     'mq5': {
         'pin': 2,
         'r0_rs_air': 6.45,
-        'r0': # FILL IN
+        'r0': None
     }
 }
  
+# ------------------------------------------------------------------
+#                 Temperature and humidity compensation
+# ------------------------------------------------------------------
+# Rs/Rs_ref of the MQ sensors against temperature (degrees C) at a few humidity levels (%),
+# Rs_ref is the sensor resistance at 20 degrees C and 65% humidity (see the data sheets below)
+# Sensors without a curve are not compensated, set COMPENSATION to None to disable it
+# CAUTION : these values are extracted by sight on the graphs and therefore will be an approximation
+# To be used at your own risk
+COMPENSATION = {
+    'mq2': {
+        'temperature': [-10, 0, 10, 20, 30, 40, 50],
+        'humidity': [33, 85],
+        'factor': [
+            [1.70, 1.45, 1.25, 1.13, 1.05, 1.00, 0.98],
+            [1.41, 1.20, 1.02, 0.93, 0.87, 0.83, 0.81]
+        ]
+    },
+    'mq9': {
+        'temperature': [-10, 0, 10, 20, 30, 40, 50],
+        'humidity': [33, 85],
+        'factor': [
+            [1.30, 1.18, 1.08, 1.02, 0.97, 0.93, 0.90],
+            [1.15, 1.04, 0.95, 0.90, 0.86, 0.83, 0.81]
+        ]
+    },
+    'mq5': {
+        'temperature': [-10, 0, 10, 20, 30, 40, 50],
+        'humidity': [33, 85],
+        'factor': [
+            [1.25, 1.15, 1.07, 1.02, 0.98, 0.95, 0.93],
+            [1.13, 1.04, 0.96, 0.92, 0.88, 0.86, 0.84]
+        ]
+    }
+}
+
 # ------------------------------------------------------------------
 #                    Curves on the data sheets
 # ------------------------------------------------------------------
@@ -184,6 +270,70 @@ UNITS = {
 FIREBASE_CREDS_JSON = # FILL IN
 FIREBASE_INTERVAL = 60
 FIREBASE_DB_NAME = # FILL IN
+FIREBASE_FLUSH_INTERVAL = 60  # number of seconds between sending buffered samples
+FIREBASE_BATCH_SIZE = 500  # maximum number of samples per batched write (Firestore limit is 500)
+FIREBASE_MAX_BACKOFF = 600  # maximum number of seconds to wait before retrying a failed write
+
+# ------------------------------------------------------------------
+#                           Storage backend
+# ------------------------------------------------------------------
+# Where the samples are stored and read from:
+# 'firestore' (Firebase), 'sqlite' (local database file) or 'memory' (single process only)
+STORAGE_BACKEND = 'firestore'
+STORAGE_SQLITE_PATH = 'storage.db'  # database file of the 'sqlite' backend
+
+# ------------------------------------------------------------------
+#                        Local sample buffer
+# ------------------------------------------------------------------
+BUFFER_DB_PATH = 'samples.db'  # SQLite file where samples are written before sending
+BUFFER_RETENTION_DAYS = 7  # number of days sent samples are kept in the buffer
+
+# ------------------------------------------------------------------
+#                              Rollups
+# ------------------------------------------------------------------
+# Resolutions at which count/min/max/mean/last of every metric are aggregated
+# Rollups are stored in the collections <FIREBASE_DB_NAME>_<resolution>
+ROLLUP_RESOLUTIONS = ['minute', 'hour', 'day']
+
+# ------------------------------------------------------------------
+#                          Local archive
+# ------------------------------------------------------------------
+# Folder with the columnar archive of all samples, None to disable
+ARCHIVE_PATH = 'archive'
+
+# ------------------------------------------------------------------
+#                             Collector
+# ------------------------------------------------------------------
+# A collector (collector.py) receives the samples of all rooms and stores them on Firebase
+# Address of the collector used by this node, e.g. 'http://192.168.1.10:8060/samples'
+# None to send the samples directly to Firebase
+COLLECTOR_URL = None
+COLLECTOR_HOST = '0.0.0.0'
+COLLECTOR_PORT = 8060
+COLLECTOR_BUFFER_DB_PATH = 'collector.db'
+
+# ------------------------------------------------------------------
+#                  Loading data from the storage backend
+# ------------------------------------------------------------------
+LOADER_CACHE_SIZE = 32  # maximum number of query results kept in memory
+LOADER_CACHE_TTL = 60  # number of seconds a query result is kept in memory
+
+# ------------------------------------------------------------------
+#                             Dashboard
+# ------------------------------------------------------------------
+DASHBOARD_BUFFER_SIZE = 1440  # number of samples kept in memory and plotted
+DASHBOARD_REFRESH_INTERVAL = 60  # number of seconds between refreshing the graphs
+DASHBOARD_DEFAULT_RANGE = 'day'  # time range shown when opening the dashboard: 'hour', 'day', 'week' or 'month'
+DASHBOARD_MAX_POINTS = 500  # maximum number of points per graph, longer series are downsampled
+DASHBOARD_DOWNSAMPLING = 'lttb'  # downsampling method: 'lttb' or 'minmax'
+DASHBOARD_ARCHIVE_PATH = None  # set to ARCHIVE_PATH to read from the local archive when running on the Pi
+# Rollup resolution used for time ranges that aren't kept in memory
+DASHBOARD_RANGE_ROLLUPS = {
+    'hour': 'minute',
+    'day': 'minute',
+    'week': 'hour',
+    'month': 'hour'
+}
 
 # ------------------------------------------------------------------
 #                        Alert notifications
@@ -194,9 +344,93 @@ ALERT_GASES = ['lpg', 'co', 'propane', 'ch4', 'h2']
 # Sensor of which values are used to send alert notifications
 ALERT_SENSOR = 'mq2'
 
-# Time interval (in minutes) to check again for critical gas concentrations
+# Rules per gas that trigger an alert, all values of ALERT_SENSOR are checked
+# 'twa': time-weighted average over 'window' minutes above 'threshold'
+# 'slope': increase over 'window' minutes above 'threshold' ppm per minute
+# 'm_of_n': at least 'm' of the last 'n' samples above 'threshold'
+# The threshold defaults to the upper bound of the gas in UPPERBOUNDS
+# e.g. 'co': [{'type': 'twa', 'window': 15}, {'type': 'slope', 'window': 10, 'threshold': 5}]
+ALERT_RULES = {}
+# Rules of the gases that are not in ALERT_RULES,
+# {'type': 'm_of_n', 'm': 1, 'n': 1} alerts on every single value above the upper bound
+ALERT_DEFAULT_RULES = [{'type': 'm_of_n', 'm': 3, 'n': 5}]
+
+# Where new samples are read from: 'storage' (storage backend) or 'archive' (local archive on the Pi)
+ALERT_SOURCE = 'storage'
+
+# Time interval (in minutes) between two alerts of the same room and gas
 ALERT_INTERVAL = 60
 
+# ------------------------------------------------------------------
+#                           Ventilation
+# ------------------------------------------------------------------
+# Energenie socket of every ventilation unit, with the room and the gases controlling it.
+# A unit is turned on when an alert rule of one of its gases is triggered, and turned off
+# when all its gases are below their off threshold. Rooms without a unit only get emails.
+# Optional keys per unit: 'off_thresholds' (ppm per gas), 'min_on' and 'min_off' (seconds)
+VENTILATION_UNITS = [
+    {'socket': 1, 'device': DEVICE_ID, 'gases': ALERT_GASES}
+]
+
+# Default off threshold as a fraction of the upper bound
+VENTILATION_OFF_RATIO = 0.8
+
+# Minimum number of seconds a unit stays on and off, to protect the relays
+VENTILATION_MIN_ON = 300
+VENTILATION_MIN_OFF = 120
+
+# Number of seconds between two checks of the ventilation units
+VENTILATION_TICK = 1
+
+# ------------------------------------------------------------------
+#                           Notifications
+# ------------------------------------------------------------------
+# Channels the alerts are sent to: 'smtp', 'webhook' and/or 'log'
+NOTIFICATION_CHANNELS = ['smtp']
+
+# Number of seconds to collect alerts before sending them in one message
+NOTIFICATION_COALESCE = 5
+
+# Maximum number of pending alerts, one per room and gas
+NOTIFICATION_QUEUE_SIZE = 100
+
+# URL receiving the alerts as a JSON POST request with the 'webhook' channel
+NOTIFICATION_WEBHOOK_URL = None
+
+# File the alerts are appended to with the 'log' channel, they are printed when None
+NOTIFICATION_LOG_PATH = None
+
 # SMTPLIB
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+SMTP_STARTTLS = True
 EMAIL = # FILL IN
-EMAIL_PW = # FILL IN  # Application-specific password https://support.google.com/mail/?p=InvalidSecondFactor
\ No newline at end of file
+EMAIL_PW = # FILL IN  # Application-specific password https://support.google.com/mail/?p=InvalidSecondFactor
+
+# ------------------------------------------------------------------
+#                         Instrumentation
+# ------------------------------------------------------------------
+# Port per script serving its metrics on http://<METRICS_HOST>:<port>/metrics,
+# scripts without a port don't serve their metrics
+# The dashboard serves the metrics of every worker on /metrics
+METRICS_HOST = '127.0.0.1'
+METRICS_PORTS = {
+    'sampler': 9101,
+    'alert': 9102
+}
+
+# File with the call stacks of the sampling profiler, {} is replaced by the name of the script
+# The profiler is off when None, e.g. 'profile_{}.txt'
+PROFILE_PATH = None
+
+# Number of seconds between two samples of the profiler
+PROFILE_INTERVAL = 0.01
+
+# ------------------------------------------------------------------
+#                 Reprocessing of the stored samples
+# ------------------------------------------------------------------
+# Defaults of python air_quality.py backfill, see backfill.py
+BACKFILL_WORKERS = 8  # number of partitions read and written in parallel
+BACKFILL_PAGE_SIZE = 500  # number of documents per query and per batched write
+BACKFILL_PARTITION_DAYS = 1  # number of days per partition
+BACKFILL_CHECKPOINT_PATH = 'backfill.json'  # progress of the last run, to resume after an interruption
@@ -0,0 +1,249 @@
+# ------------------------------------------------------------------
+#                 Converting MQ sensor values to ppm
+# ------------------------------------------------------------------
+# Precompiled conversion table to turn raw analog readings of all MQ
+# sensors into gas concentrations (ppm) in a single NumPy pass.
+#
+# The curve parameters of cfg.CURVES and the R0 values of
+# cfg.MQ_SENSORS are flattened into arrays once. Converting a cycle
+# of readings, or a whole batch of historical readings, is then a
+# handful of vectorized operations instead of a loop over every
+# (sensor, gas) pair. Optionally, the Rs/R0 ratios are compensated
+# for temperature and humidity (see compensation.py).
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import hashlib
+import json
+import math
+
+import numpy as np
+
+import config as cfg
+
+
+def get_ppm(Rs_R0_ratio, curve):
+    """Calculate the corresponding ppm value for a rs_ro_ratio
+    Parameters
+    ----------
+    Rs_R0_ratio : float or numpy array
+        ratio of Rs and R0. Rs is the MQ sensor value currently being read.
+        R0 is the MQ sensor value in clean air.
+    curve : dict
+        dictionary containing the slope and (x, y) coordinates of one known point
+        on the curve with Rs/R0 ratio and gas concentration in ppm
+    Returns
+    -------
+    ppm_val
+        float or numpy array
+    """
+    x_val = (np.log10(Rs_R0_ratio) - curve['y'])/curve['slope'] + curve['x']
+    ppm_val = np.power(10, x_val)
+    return ppm_val
+
+
+def calibration_version(r0, vc, ar_max):
+    """Short identifier of a calibration, the same R0 values always give the same version
+    Parameters
+    ----------
+    r0 : dict
+        R0 value per MQ sensor
+    vc : float
+        circuit voltage
+    ar_max : int
+        maximum output value of the analogRead method
+    Returns
+    -------
+    str
+    """
+    key = json.dumps({'r0': r0, 'vc': vc, 'ar_max': ar_max}, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+class ConversionTable:
+    """Conversion of raw MQ readings to ppm for all sensors and gases at once
+
+    The columns of the ppm output follow the order of `keys`, which are the
+    field names stored on Firebase (e.g. 'mq2_co_ppm').
+
+    Parameters
+    ----------
+    mq_sensors : dict
+        sensor settings with 'pin' and 'r0' per MQ sensor (see cfg.MQ_SENSORS)
+    curves : dict
+        curve parameters per sensor and gas (see cfg.CURVES)
+    vc : float
+        circuit voltage
+    ar_max : int
+        maximum output value of the analogRead method
+    compensation : CompensationTable or None
+        temperature and humidity compensation of the Rs/R0 ratios, None to disable
+    """
+
+    def __init__(self, mq_sensors=None, curves=None, vc=None, ar_max=None, compensation=None):
+        mq_sensors = cfg.MQ_SENSORS if mq_sensors is None else mq_sensors
+        curves = cfg.CURVES if curves is None else curves
+        self.vc = cfg.VC if vc is None else vc
+        self.ar_max = cfg.AR_MAX if ar_max is None else ar_max
+        self.compensation = compensation
+
+        # One entry per sensor, in the order of mq_sensors
+        self.sensors = list(mq_sensors.keys())
+        self.pins = [mq_sensors[s]['pin'] for s in self.sensors]
+        self.r0 = np.array([mq_sensors[s]['r0'] for s in self.sensors], dtype=float)
+        # Field names of the raw analog readings, e.g. 'mq2_raw'
+        self.raw_keys = [s + '_raw' for s in self.sensors]
+        # Identifies the calibration of the sensors, stored with raw samples
+        self.version = calibration_version(dict(zip(self.sensors, self.r0.tolist())), self.vc, self.ar_max)
+
+        # One entry per (sensor, gas) pair
+        self.keys = []
+        self.gases = []
+        sensor_idx, x, y, slope = [], [], [], []
+        for i, mq_sensor in enumerate(self.sensors):
+            for gas, curve in curves[mq_sensor].items():
+                self.keys.append(mq_sensor + '_' + gas + '_ppm')
+                self.gases.append(gas)
+                sensor_idx.append(i)
+                x.append(curve['x'])
+                y.append(curve['y'])
+                slope.append(curve['slope'])
+
+        self.sensor_idx = np.array(sensor_idx, dtype=int)
+        self.x = np.array(x, dtype=float)
+        self.y = np.array(y, dtype=float)
+        self.slope = np.array(slope, dtype=float)
+
+    @property
+    def n_sensors(self):
+        return len(self.sensors)
+
+    @property
+    def n_keys(self):
+        return len(self.keys)
+
+    def rs_r0_ratios(self, raw_values):
+        """Compute the Rs/R0 ratios of raw analog readings
+        Parameters
+        ----------
+        raw_values : array-like
+            averaged analogRead values with shape (n_sensors,) or
+            (n_samples, n_sensors), columns in the order of `sensors`
+        Returns
+        -------
+        ratios
+            numpy array with the same shape as raw_values
+        """
+        raw_values = np.asarray(raw_values, dtype=float)
+        # sensor voltage
+        voltages = raw_values/self.ar_max * self.vc
+        # sensor resistance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resistances = (self.vc - voltages)/voltages
+        # Rs/R0 ratio
+        return resistances/self.r0
+
+    def ppm_from_ratios(self, ratios):
+        """Compute the ppm values of every gas from Rs/R0 ratios
+        Parameters
+        ----------
+        ratios : array-like
+            Rs/R0 ratios with shape (n_sensors,) or (n_samples, n_sensors)
+        Returns
+        -------
+        ppm_vals
+            numpy array with shape (n_keys,) or (n_samples, n_keys)
+        """
+        ratios = np.asarray(ratios, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_vals = (np.log10(ratios[..., self.sensor_idx]) - self.y)/self.slope + self.x
+        return np.power(10, x_vals)
+
+    def ratios_from_ppm(self, ppm_vals):
+        """Recover the Rs/R0 ratios from ppm values, the inverse of ppm_from_ratios
+        The ratio of a sensor is the geometric mean of the ratios of its gases,
+        gases without a finite ppm value are left out. Sensors without any
+        finite ppm value get NaN.
+        Parameters
+        ----------
+        ppm_vals : array-like
+            ppm values with shape (n_keys,) or (n_samples, n_keys)
+        Returns
+        -------
+        ratios
+            numpy array with shape (n_sensors,) or (n_samples, n_sensors)
+        """
+        ppm_vals = np.asarray(ppm_vals, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_ratios = (np.log10(ppm_vals) - self.x)*self.slope + self.y
+        valid = np.isfinite(log_ratios)
+        # Sum and count the log ratios of the gases of every sensor in one product
+        gases = (self.sensor_idx[:, None] == np.arange(self.n_sensors)).astype(float)
+        sums = np.where(valid, log_ratios, 0) @ gases
+        counts = valid @ gases
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.power(10, sums/counts)
+
+    def ppm(self, raw_values, temperature=None, humidity=None):
+        """Compute the ppm values of every gas from raw analog readings
+        Parameters
+        ----------
+        raw_values : array-like
+            averaged analogRead values with shape (n_sensors,) or
+            (n_samples, n_sensors)
+        temperature : float, array-like or None
+            temperature per sample, None to skip the compensation
+        humidity : float, array-like or None
+            humidity per sample, None to skip the compensation
+        Returns
+        -------
+        ppm_vals
+            numpy array with shape (n_keys,) or (n_samples, n_keys)
+        """
+        ratios = self.rs_r0_ratios(raw_values)
+        if self.compensation is not None:
+            ratios = self.compensation.compensate(ratios, temperature, humidity)
+        return self.ppm_from_ratios(ratios)
+
+    def raw_from_dict(self, sample):
+        """Raw analog readings of a sample, in the order of `sensors`, missing readings are NaN"""
+        return np.array([sample.get(key) for key in self.raw_keys], dtype=float)
+
+    def derive_sample(self, sample):
+        """Add the ppm values of every gas to a sample with raw analog readings
+        Samples without raw readings are returned unchanged. The gases of a
+        missing reading (e.g. quarantined by health.py) and values that aren't
+        finite are left out, so no NaN or infinite values are stored.
+        Parameters
+        ----------
+        sample : dict
+            raw readings with keys like 'mq2_raw', and optionally 'temperature' and 'humidity'
+        Returns
+        -------
+        dict
+            the same sample
+        """
+        if all(sample.get(key) is None for key in self.raw_keys):
+            return sample
+        ppm_values = self.ppm(self.raw_from_dict(sample), sample.get('temperature'), sample.get('humidity'))
+        sample.update((key, value) for key, value in self.to_dict(ppm_values).items() if math.isfinite(value))
+        return sample
+
+    def to_dict(self, ppm_vals):
+        """Map one row of ppm values onto their Firebase field names
+        Parameters
+        ----------
+        ppm_vals : array-like
+            ppm values with shape (n_keys,)
+        Returns
+        -------
+        dict
+            {'mq2_co_ppm': float, ...}
+        """
+        return dict(zip(self.keys, np.asarray(ppm_vals, dtype=float).tolist()))
@@ -0,0 +1,217 @@
+# ------------------------------------------------------------------
+#             Deriving ppm values from raw samples on read
+# ------------------------------------------------------------------
+# In the 'raw' ingest mode (INGEST_MODE in the config), the samples
+# only contain the analog readings of the MQ sensors, the BME680
+# values, the health of the sensors that aren't ok (see health.py)
+# and the version of the calibration of the device. The R0
+# values of every calibration are stored once, in the collection
+# <FIREBASE_DB_NAME>_calibrations.
+#
+# The ppm values are derived when the samples are read, with the
+# curves of the config. One conversion table is built and kept per
+# calibration version, and the derived time ranges are cached. A
+# correction of a curve, or of the R0 values of a calibration
+# document, therefore applies to the whole history.
+#
+# The readings of quarantined sensors are skipped, like in the 'ppm'
+# ingest mode. Samples stored with ppm values are returned as they are.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from conversion import ConversionTable
+from health import QUARANTINED
+from loader import TTLCache
+
+# Fields of a raw sample besides the analog readings
+ENVIRONMENT_FIELDS = ['temperature', 'pressure', 'humidity']
+CALIBRATION_FIELD = 'calibration'
+
+
+def calibration_collection(collection_name):
+    """Name of the collection with the calibrations of the devices"""
+    return collection_name + '_calibrations'
+
+
+def calibration_doc(conversion_table, device, date=None):
+    """Document with the calibration of a conversion table
+    Returns
+    -------
+    (doc_id, doc)
+    """
+    doc = {
+        'date': date or datetime.now(),
+        'device': device,
+        'version': conversion_table.version,
+        'r0': dict(zip(conversion_table.sensors, conversion_table.r0.tolist())),
+        'vc': conversion_table.vc,
+        'ar_max': conversion_table.ar_max
+    }
+    return device + '_' + conversion_table.version, doc
+
+
+def health_keys(sensors):
+    """Fields with the health of the sensors, set in the samples by HealthMonitor"""
+    return [sensor + '_health' for sensor in sensors]
+
+
+def raw_sample(sample, conversion_table):
+    """Compact copy of a sample with the raw readings and the health of the sensors, without the ppm values"""
+    keys = conversion_table.raw_keys + health_keys(conversion_table.sensors) + ENVIRONMENT_FIELDS + ['date', 'device']
+    raw = {key: sample[key] for key in keys if key in sample}
+    raw[CALIBRATION_FIELD] = conversion_table.version
+    return raw
+
+
+class Deriver:
+    """Conversion tables of the stored calibrations, built once per calibration version
+
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+        collection of the samples
+    mq_sensors : dict
+        sensor settings (see cfg.MQ_SENSORS), the R0 values are taken from the calibrations
+    curves : dict
+        curve parameters per sensor and gas (see cfg.CURVES)
+    compensation : CompensationTable or None
+    retry_interval : float
+        number of seconds before the storage is read again for an unknown calibration version
+    """
+
+    def __init__(self, storage, collection_name, mq_sensors, curves, compensation=None, retry_interval=60):
+        self.storage = storage
+        self.collection_name = collection_name
+        self.mq_sensors = mq_sensors
+        self.curves = curves
+        self.compensation = compensation
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.calibrations = {}
+        # Monotonic time at which each unknown version was looked up last
+        self.unknown = {}
+        self.tables = {}
+        self.keys = ConversionTable({s: dict(settings, r0=1) for s, settings in mq_sensors.items()}, curves).keys
+
+    def _reload(self):
+        docs = self.storage.newer(calibration_collection(self.collection_name), None)
+        self.calibrations = {doc['version']: doc for doc in docs}
+
+    def table(self, version):
+        """Conversion table of a calibration version, None if the version is unknown"""
+        with self.lock:
+            table = self.tables.get(version)
+            if table is not None:
+                return table
+            if version not in self.calibrations:
+                # A device stored a new calibration, the storage is read at most once per
+                # retry interval for a version that isn't stored (yet)
+                checked = self.unknown.get(version)
+                if checked is not None and time.monotonic() - checked < self.retry_interval:
+                    return None
+                self._reload()
+            calibration = self.calibrations.get(version)
+            if calibration is None:
+                self.unknown[version] = time.monotonic()
+                return None
+            self.unknown.pop(version, None)
+            mq_sensors = {sensor: dict(settings, r0=calibration['r0'].get(sensor))
+                          for sensor, settings in self.mq_sensors.items()}
+            table = ConversionTable(mq_sensors, self.curves, calibration['vc'], calibration['ar_max'],
+                                    compensation=self.compensation)
+            self.tables[version] = table
+            return table
+
+    def derive_sample(self, sample):
+        """Add the ppm values to a raw sample, other samples are returned unchanged"""
+        version = sample.get(CALIBRATION_FIELD)
+        table = self.table(version) if version is not None else None
+        if table is None:
+            return sample
+        for sensor, health_key in zip(table.sensors, health_keys(table.sensors)):
+            if sample.get(health_key) in QUARANTINED:
+                sample.pop(sensor + '_raw', None)
+        return table.derive_sample(sample)
+
+    def derive_columns(self, values, fields):
+        """Derive ppm fields of columnar samples
+        Parameters
+        ----------
+        values : dict
+            NumPy array per field, with the raw readings, the temperature, the humidity,
+            the calibration version, the stored ppm fields and optionally the health fields
+        fields : list
+            ppm fields to derive
+        Returns
+        -------
+        dict
+            NumPy array per ppm field, the stored values are kept for samples without raw readings
+        """
+        derived = {field: np.array(values[field], dtype=float) for field in fields}
+        versions = values[CALIBRATION_FIELD]
+        for version in set(v for v in versions.tolist() if v is not None and v == v):
+            table = self.table(version)
+            if table is None:
+                continue
+            rows = versions == version
+            raw = np.column_stack([values[key][rows] for key in table.raw_keys]).astype(float)
+            # No ppm values for the readings of quarantined sensors
+            for i, health_key in enumerate(health_keys(table.sensors)):
+                if health_key in values:
+                    raw[[status in QUARANTINED for status in values[health_key][rows].tolist()], i] = np.nan
+            ppm_values = table.ppm(raw, values['temperature'][rows], values['humidity'][rows])
+            for field in fields:
+                derived[field][rows] = ppm_values[:, table.keys.index(field)]
+        return derived
+
+
+class DerivedLoader:
+    """Load time ranges like CachedLoader, with the ppm values derived from the raw readings
+
+    Parameters
+    ----------
+    loader : CachedLoader
+    deriver : Deriver
+    maxsize : int
+        maximum number of cached results
+    ttl : float
+        number of seconds a result stays valid
+    """
+
+    def __init__(self, loader, deriver, maxsize=32, ttl=60):
+        self.loader = loader
+        self.deriver = deriver
+        self.cache = TTLCache(maxsize, ttl)
+
+    def load(self, collection_name, fields, start, end=None, device=None):
+        """Read the samples of a collection in a time range, see Storage.range"""
+        ppm_fields = [field for field in fields if field in self.deriver.keys]
+        if not ppm_fields:
+            return self.loader.load(collection_name, fields, start, end, device)
+
+        key = (collection_name, start, end, tuple(fields), device)
+        result = self.cache.get(key)
+        if result is None:
+            raw_keys = [sensor + '_raw' for sensor in self.deriver.mq_sensors]
+            extra = raw_keys + health_keys(self.deriver.mq_sensors) + ['temperature', 'humidity', CALIBRATION_FIELD]
+            extra = [f for f in extra if f not in fields]
+            dates, values = self.loader.load(collection_name, list(fields) + extra, start, end, device)
+            values = dict(values)
+            values.update(self.deriver.derive_columns(values, ppm_fields))
+            result = dates, {field: values[field] for field in fields}
+            self.cache.put(key, result)
+        return result
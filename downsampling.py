@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------
+#                   Downsampling of time series
+# ------------------------------------------------------------------
+# Reduce a time series to a fixed number of points before sending it
+# to the browser. The payload size and the render time of the
+# dashboard then stay constant, whatever time range is selected.
+#
+# - lttb: Largest-Triangle-Three-Buckets, keeps the visual shape
+#   of the line (https://skemman.is/handle/1946/15343)
+# - minmax: keeps the minimum and maximum of each bucket, so no
+#   spike gets lost
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """Downsample with the Largest-Triangle-Three-Buckets algorithm
+    Parameters
+    ----------
+    x : numpy array
+        increasing numeric x values (e.g. timestamps in seconds)
+    y : numpy array
+        y values
+    n_out : int
+        number of points to keep, at least 3
+    Returns
+    -------
+    indices
+        numpy array with the indices of the points to keep
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # First and last point are always kept, the others are split in n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average point of the next bucket (or the last point)
+        if i < n_out - 3:
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+
+        # Keep the point forming the largest triangle with the previous kept point
+        # and the average of the next bucket
+        areas = np.abs((x[prev] - avg_x) * (y[start:end] - y[prev])
+                       - (x[prev] - x[start:end]) * (avg_y - y[prev]))
+        prev = start + int(np.argmax(areas))
+        indices[i + 1] = prev
+
+    return indices
+
+
+def minmax(x, y, n_out):
+    """Downsample by keeping the minimum and maximum of every bucket
+    Parameters
+    ----------
+    x : numpy array
+        increasing numeric x values
+    y : numpy array
+        y values
+    n_out : int
+        maximum number of points to keep, two per bucket
+    Returns
+    -------
+    indices
+        numpy array with the indices of the points to keep, in x order
+    """
+    n = len(x)
+    n_buckets = n_out // 2
+    if n_out >= n or n_buckets < 1:
+        return np.arange(n)
+
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    starts = edges[:-1]
+    # reduceat computes the min/max of each bucket in one pass
+    bucket_ids = np.repeat(np.arange(n_buckets), np.diff(edges))
+    min_vals = np.minimum.reduceat(y, starts)
+    max_vals = np.maximum.reduceat(y, starts)
+
+    # First index of the minimum and maximum in every bucket
+    min_pos = np.flatnonzero(y == min_vals[bucket_ids])
+    max_pos = np.flatnonzero(y == max_vals[bucket_ids])
+    _, first_min = np.unique(bucket_ids[min_pos], return_index=True)
+    _, first_max = np.unique(bucket_ids[max_pos], return_index=True)
+    return np.unique(np.concatenate([min_pos[first_min], max_pos[first_max]]))
+
+
+DOWNSAMPLERS = {
+    'lttb': lttb,
+    'minmax': minmax
+}
+
+
+def downsample(timestamps, values, n_out, method='lttb'):
+    """Reduce a series of sensor values to at most n_out points
+    Missing values (None or NaN) are dropped before downsampling.
+    Parameters
+    ----------
+    timestamps : list with datetimes of the sensor values
+    values : list with the sensor values
+    n_out : int
+        maximum number of points to keep
+    method : str
+        'lttb' or 'minmax'
+    Returns
+    -------
+    (timestamps, values)
+        lists with the kept timestamps and values
+    """
+    y = np.array(values, dtype=float)
+    valid = np.flatnonzero(np.isfinite(y))
+    if len(valid) <= n_out:
+        return [timestamps[i] for i in valid], y[valid].tolist()
+
+    x = np.array([timestamps[i].timestamp() for i in valid])
+    kept = DOWNSAMPLERS[method](x, y[valid], n_out)
+    return [timestamps[valid[i]] for i in kept], y[valid[kept]].tolist()
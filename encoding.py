@@ -0,0 +1,318 @@
+# ------------------------------------------------------------------
+#                 Compact encoding of the samples
+# ------------------------------------------------------------------
+# A keyed sample repeats field names like 'mq2_propane_ppm' in every
+# document. In the 'compact' encoding (SAMPLE_ENCODING in the config),
+# the numeric fields of a sample are packed as float32 values in the
+# fixed order of a schema, in one bytes field. The date, the device
+# and the other fields stay keyed, so the documents can still be
+# queried by date and device.
+#
+# The order of the fields follows the MQ sensors and the curves of
+# the config. Only the fields that are stored are packed: the ppm
+# values in the 'ppm' ingest mode and the raw readings in the 'raw'
+# ingest mode (INGEST_MODE in the config), both with the temperature,
+# pressure and humidity. A schema is identified by a hash of its fields and is
+# stored once in the collection <FIREBASE_DB_NAME>_schemas, so the
+# readers can decode the samples of older configs. Keyed samples are
+# returned as they are.
+#
+# Batches sent to the collector are encoded in one binary body: the
+# packed values of all samples, and their dates as delta-of-delta
+# offsets in the smallest integer type that fits them.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import hashlib
+import json
+import struct
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import numpy as np
+
+from sample_buffer import encode_sample, decode_sample
+
+# Fields of a compact sample
+SCHEMA_FIELD = 'schema'
+VALUES_FIELD = 'values'
+
+# Fields of every schema besides the ppm values or the raw readings
+ENVIRONMENT_FIELDS = ['temperature', 'pressure', 'humidity']
+
+# Binary batches: magic bytes and length of the JSON header
+BATCH_MAGIC = b'AQB1'
+BATCH_HEADER = struct.Struct('<4sI')
+BATCH_CONTENT_TYPE = 'application/x-air-quality-batch'
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def sample_fields(conversion_table, ingest_mode='ppm'):
+    """Numeric fields of the stored samples of a conversion table, in a fixed order
+    Parameters
+    ----------
+    conversion_table : ConversionTable
+    ingest_mode : str
+        'ppm' for samples with the ppm values, 'raw' for samples with the raw readings
+    Returns
+    -------
+    list
+    """
+    if ingest_mode == 'raw':
+        return conversion_table.raw_keys + ENVIRONMENT_FIELDS
+    return conversion_table.keys + ENVIRONMENT_FIELDS
+
+
+def schema_collection(collection_name):
+    """Name of the collection with the schemas of the compact samples"""
+    return collection_name + '_schemas'
+
+
+class SampleSchema:
+    """Fixed order of the numeric fields of compact samples
+
+    Parameters
+    ----------
+    fields : list
+        names of the numeric fields, see sample_fields
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.index = {field: i for i, field in enumerate(self.fields)}
+        self.struct = struct.Struct('<{}f'.format(len(self.fields)))
+        self.version = hashlib.sha1(json.dumps(self.fields).encode('utf-8')).hexdigest()[:12]
+
+    def doc(self, date=None):
+        """Document describing the schema
+        Returns
+        -------
+        (doc_id, doc)
+        """
+        return self.version, {'date': date or datetime.now(), 'version': self.version, 'fields': self.fields}
+
+    def compact(self, sample):
+        """Copy of a sample with the fields of the schema packed, missing fields become NaN"""
+        compact = {key: value for key, value in sample.items() if key not in self.index}
+        nan = float('nan')
+        compact[VALUES_FIELD] = self.struct.pack(*[nan if sample.get(field) is None else sample[field]
+                                                   for field in self.fields])
+        compact[SCHEMA_FIELD] = self.version
+        return compact
+
+    def expand(self, sample):
+        """Keyed copy of a compact sample, without the missing fields"""
+        expanded = {key: value for key, value in sample.items() if key not in (VALUES_FIELD, SCHEMA_FIELD)}
+        for field, value in zip(self.fields, self.struct.unpack(sample[VALUES_FIELD])):
+            if value == value:
+                expanded[field] = value
+        return expanded
+
+    def decode(self, payloads):
+        """Decode the packed values of several samples
+        Parameters
+        ----------
+        payloads : list
+            VALUES_FIELD of the samples
+        Returns
+        -------
+        numpy array
+            float32 values with shape (n_samples, n_fields), a view on the joined payloads
+        """
+        return np.frombuffer(b''.join(payloads), dtype='<f4').reshape(-1, len(self.fields))
+
+
+class SchemaRegistry:
+    """Schemas of the compact samples of a collection, loaded from the storage when needed
+
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+        collection of the samples
+    retry_interval : float
+        number of seconds before the storage is read again for an unknown schema version
+    """
+
+    def __init__(self, storage, collection_name, retry_interval=60):
+        self.storage = storage
+        self.collection_name = collection_name
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.schemas = {}
+        # Monotonic time at which each unknown version was looked up last
+        self.unknown = {}
+
+    def schema(self, version):
+        """Schema of a version, None if the version is unknown"""
+        with self.lock:
+            if version in self.schemas:
+                return self.schemas[version]
+            # A device stored a new schema, the storage is read at most once per
+            # retry interval for a version that isn't stored (yet)
+            checked = self.unknown.get(version)
+            if checked is not None and time.monotonic() - checked < self.retry_interval:
+                return None
+            docs = self.storage.newer(schema_collection(self.collection_name), None)
+            self.schemas.update({doc['version']: SampleSchema(doc['fields']) for doc in docs})
+            if version not in self.schemas:
+                self.unknown[version] = time.monotonic()
+                return None
+            self.unknown.pop(version, None)
+            return self.schemas[version]
+
+    def expand(self, sample):
+        """Keyed copy of a compact sample, keyed samples are returned unchanged"""
+        if VALUES_FIELD not in sample:
+            return sample
+        schema = self.schema(sample.get(SCHEMA_FIELD))
+        if schema is None:
+            print('Unknown schema {} of a sample of {}'.format(sample.get(SCHEMA_FIELD), sample['date']))
+            return sample
+        return schema.expand(sample)
+
+    def decode_columns(self, values, fields):
+        """Decode the packed fields of the compact samples into columns
+        Parameters
+        ----------
+        values : dict
+            NumPy array per field, with SCHEMA_FIELD and VALUES_FIELD
+        fields : list
+            fields to decode, fields that aren't packed are skipped
+        Returns
+        -------
+        dict
+            NumPy array per packed field, the keyed values are kept for the other samples
+        """
+        versions = values[SCHEMA_FIELD]
+        if versions.dtype != object:
+            # No compact samples in the range
+            return {}
+        schemas = {version: self.schema(version) for version in set(versions.tolist()) if isinstance(version, str)}
+        schemas = {version: schema for version, schema in schemas.items() if schema is not None}
+        packed_fields = [field for field in fields if any(field in schema.index for schema in schemas.values())]
+        decoded = {field: np.array(values[field], dtype=float) for field in packed_fields}
+        for version, schema in schemas.items():
+            rows = versions == version
+            packed = schema.decode(values[VALUES_FIELD][rows].tolist())
+            for field in packed_fields:
+                if field in schema.index:
+                    decoded[field][rows] = packed[:, schema.index[field]]
+        return decoded
+
+
+def to_microseconds(date):
+    """Microseconds since 1970 of a naive date, or of an aware date in UTC"""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return (date - EPOCH) // MICROSECOND
+
+
+def encode_timestamps(timestamps):
+    """Encode integer timestamps as the first value, the first delta and the deltas of the deltas
+    Returns
+    -------
+    (dtype, bytes)
+        smallest integer type of the deltas of the deltas and the encoded timestamps
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    head = timestamps[:2].copy()
+    if len(head) == 2:
+        head[1] -= head[0]
+    dod = np.diff(timestamps, n=2)
+    dtype = np.dtype('<i8')
+    for candidate in ('<i1', '<i2', '<i4'):
+        info = np.iinfo(candidate)
+        if len(dod) == 0 or (dod.min() >= info.min and dod.max() <= info.max):
+            dtype = np.dtype(candidate)
+            break
+    return dtype.str, np.pad(head, (0, 2 - len(head))).astype('<i8').tobytes() + dod.astype(dtype).tobytes()
+
+
+def decode_timestamps(payload, dtype, n):
+    """Decode n timestamps encoded with encode_timestamps"""
+    head = np.frombuffer(payload, dtype='<i8', count=2)
+    dod = np.frombuffer(payload, dtype=dtype, count=max(n - 2, 0), offset=16).astype(np.int64)
+    deltas = np.concatenate([head[1:], head[1] + np.cumsum(dod)])
+    return np.concatenate([head[:1], head[0] + np.cumsum(deltas)])[:n]
+
+
+def encode_batch(docs):
+    """Encode a batch of documents in one binary body
+    The compact samples of the most frequent schema are packed, the other
+    documents are sent as JSON in the header.
+    Parameters
+    ----------
+    docs : list
+        list of (collection, document ID, sample dict) tuples
+    Returns
+    -------
+    bytes
+    """
+    versions = [sample.get(SCHEMA_FIELD) for _, _, sample in docs if VALUES_FIELD in sample]
+    version = max(set(versions), key=versions.count) if versions else None
+    packed = [(collection, doc_id, sample) for collection, doc_id, sample in docs
+              if VALUES_FIELD in sample and sample.get(SCHEMA_FIELD) == version]
+    others = [(collection, doc_id, sample) for collection, doc_id, sample in docs
+              if not (VALUES_FIELD in sample and sample.get(SCHEMA_FIELD) == version)]
+
+    aware = bool(packed) and packed[0][2]['date'].tzinfo is not None
+    dtype, timestamps = encode_timestamps([to_microseconds(sample['date']) for _, _, sample in packed])
+    header = {
+        'schema': version,
+        'n': len(packed),
+        'utc': aware,
+        'timestamps': dtype,
+        'timestamps_size': len(timestamps),
+        # Other keyed fields of the packed samples, e.g. the device
+        'docs': [[collection, doc_id, {key: value for key, value in sample.items()
+                                       if key not in ('date', VALUES_FIELD, SCHEMA_FIELD)}]
+                 for collection, doc_id, sample in packed],
+        'others': [[collection, doc_id, encode_sample(sample)] for collection, doc_id, sample in others]
+    }
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return (BATCH_HEADER.pack(BATCH_MAGIC, len(header)) + header + timestamps
+            + b''.join(sample[VALUES_FIELD] for _, _, sample in packed))
+
+
+def decode_batch(body):
+    """Decode a batch encoded with encode_batch
+    Returns
+    -------
+    list
+        list of (collection, document ID, sample dict) tuples, the packed samples stay compact
+    """
+    magic, header_size = BATCH_HEADER.unpack_from(body)
+    if magic != BATCH_MAGIC:
+        raise ValueError('Not an encoded batch')
+    offset = BATCH_HEADER.size
+    header = json.loads(bytes(body[offset:offset + header_size]))
+    offset += header_size
+
+    n = header['n']
+    timestamps = decode_timestamps(body[offset:offset + header['timestamps_size']], header['timestamps'], n)
+    offset += header['timestamps_size']
+    values = memoryview(body)[offset:]
+    size = len(values) // n if n else 0
+
+    rows = []
+    for i, ((collection, doc_id, sample), timestamp) in enumerate(zip(header['docs'], timestamps.tolist())):
+        date = EPOCH + timestamp * MICROSECOND
+        sample['date'] = date.replace(tzinfo=timezone.utc) if header['utc'] else date
+        sample[VALUES_FIELD] = bytes(values[i * size:(i + 1) * size])
+        sample[SCHEMA_FIELD] = header['schema']
+        rows.append((collection, doc_id, sample))
+    rows.extend((collection, doc_id, decode_sample(sample)) for collection, doc_id, sample in header['others'])
+    return rows
@@ -1,10 +1,14 @@
 # ------------------------------------------------------------------
 #                    Computing R0 value of MQ sensors
 # ------------------------------------------------------------------
-# Computing the RO values of MQ sensors by measuring in clean air. 
-# The Ro value will be used to compute the ratio Rs/Ro for determining 
+# Computing the RO values of MQ sensors by measuring in clean air.
+# The Ro value will be used to compute the ratio Rs/Ro for determining
 # the gas concentration in ppm.
 #
+# The readings stop as soon as the R0 values are accurate enough (see
+# calibration.py). The R0 values are stored in the calibration file,
+# from which get_sensor_values.py loads them.
+#
 # Based on code from http://wiki.seeedstudio.com/Grove-Gas_Sensor-MQ2/#play-with-arduino
 #
 # Author : Bert Carremans
@@ -13,37 +17,46 @@
 # THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
 # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
 # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN 
-# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN 
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
 # ------------------------------------------------------------------
 
 import config as cfg
-import grovepi
-import time
-
-# mq_values will contain the sensor values
-mq_values = {}
-
-# Set pin mode to INPUT for all MQ sensors
-for sensor, data in cfg.MQ_SENSORS.items():
-    grovepi.pinMode(data['pin'],"INPUT")
-    mq_values[sensor] = 0  # Initizalize sensor values to zero
-    
-# Read sensor value NB_R0_READ times
-for i in range(cfg.NB_R0_READ):
-    for sensor, value in mq_values.items():
-        mq_values[sensor] += grovepi.analogRead(cfg.MQ_SENSORS[sensor]['pin'])
-    time.sleep(cfg.R0_INTERVAL)
-
-# Compute values to get to R0 value
-for sensor, value in mq_values.items():
-    # average sensor value
-    mq_values[sensor] = mq_values[sensor]/cfg.NB_R0_READ
-    # sensor voltage
-    mq_values[sensor] = mq_values[sensor]/cfg.AR_MAX * cfg.VC
-    # sensor resistance
-    mq_values[sensor] = (cfg.VC - mq_values[sensor])/mq_values[sensor]
-    # R0 value
-    mq_values[sensor] = mq_values[sensor]/cfg.MQ_SENSORS[sensor]['r0_rs_air']
-    print('R0 value for sensor {}: {}'.format(sensor, mq_values[sensor]))
\ No newline at end of file
+
+from calibration import R0Calibrator, calibrate, nb_readings, save_calibration
+from sensors import create_backends
+
+sensors = list(cfg.MQ_SENSORS.keys())
+pins = [cfg.MQ_SENSORS[sensor]['pin'] for sensor in sensors]
+
+# GrovePi and BME680 sensor, or their simulators
+adc, bme680_sensor = create_backends(cfg.SENSOR_BACKEND, pins, cfg.SIMULATED_TRACE)
+
+calibrator = R0Calibrator([cfg.MQ_SENSORS[sensor]['r0_rs_air'] for sensor in sensors],
+                          max_reads=cfg.NB_R0_READ,
+                          min_reads=cfg.R0_MIN_READ,
+                          ci_tolerance=cfg.R0_CI_TOLERANCE,
+                          drift_window=max(nb_readings(cfg.R0_DRIFT_WINDOW, cfg.R0_INTERVAL), 2),
+                          drift_tolerance=cfg.R0_DRIFT_TOLERANCE,
+                          block_size=nb_readings(cfg.R0_BLOCK, cfg.R0_INTERVAL),
+                          outlier_threshold=cfg.R0_OUTLIER_THRESHOLD,
+                          vc=cfg.VC,
+                          ar_max=cfg.AR_MAX)
+
+# Read sensor values until the R0 values converge, at most NB_R0_READ times
+converged = calibrate(adc, pins, calibrator, cfg.R0_INTERVAL)
+r0, ci, nb_used = calibrator.estimate()
+if not converged:
+    print('R0 values did not converge after {} readings, they are stored but not used'.format(calibrator.nb_reads))
+
+for sensor, value, interval, nb in zip(sensors, r0, ci, nb_used):
+    print('R0 value for sensor {}: {} (+/- {}, {} readings)'.format(sensor, value, interval, nb))
+
+save_calibration(cfg.CALIBRATION_PATH,
+                 r0=dict(zip(sensors, r0.tolist())),
+                 ci=dict(zip(sensors, ci.tolist())),
+                 nb_used=dict(zip(sensors, nb_used.tolist())),
+                 converged=converged,
+                 environment=bme680_sensor.read())
+print('Calibration stored in {}'.format(cfg.CALIBRATION_PATH))
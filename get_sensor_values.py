@@ -23,113 +23,162 @@
 # CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
 # ------------------------------------------------------------------
 
-import numpy as np
-import time
 from datetime import datetime
+from datetime import timedelta
 from pathlib import Path
 
 import config as cfg
-
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-
-import grovepi  # https://github.com/DexterInd/GrovePi/tree/master/Software/Python
-import bme680  # https://github.com/pimoroni/bme680-python
-
-def get_ppm(Rs_R0_ratio, curve):
-    """Calculate the corresponding ppm value for a rs_ro_ratio
-    Parameters
-    ----------
-    Rs_R0_ratio : float
-        ratio of Rs and R0. Rs is the MQ sensor value currently being read. 
-        R0 is the MQ sensor value in clean air.
-    curve : dict
-        dictionary containing the slope and (x, y) coordinates of one known point
-        on the curve with Rs/R0 ratio and gas concentration in ppm
+from conversion import ConversionTable
+from calibration import load_calibrations, apply_calibration, usable_calibration
+from ingest import SampleStore
+from sampler import Sampler
+from sample_buffer import SampleBuffer, BufferFlusher, deferred_batch_writer, storage_batch_writer
+from rollups import RollupAggregator
+from sensors import create_backends, read_analog_average
+from metrics import registry, start_instrumentation
+
+# Optional parts are only imported when they are used, to start sampling sooner
+
+def create_writer():
+    """Create the function sending the samples, called by the flusher at its first batch"""
+    if cfg.COLLECTOR_URL:
+        # Samples are sent to the collector, which stores the samples of all rooms
+        from collector import http_batch_writer
+        return http_batch_writer(cfg.COLLECTOR_URL, binary=cfg.SAMPLE_ENCODING == 'compact')
+
+    # Firestore, or a local stand-in chosen with STORAGE_BACKEND
+    from storage import create_storage
+    storage = create_storage(cfg.STORAGE_BACKEND,
+                             firebase_path=Path.cwd() / cfg.FIREBASE_CREDS_JSON,
+                             sqlite_path=cfg.STORAGE_SQLITE_PATH)
+    return storage_batch_writer(storage, cfg.FIREBASE_DB_NAME)
+
+write_batch = registry.timed('storage_write', deferred_batch_writer(create_writer))
+
+# Compensation for the temperature and humidity of the BME680 sensor
+compensation = None
+if cfg.COMPENSATION:
+    from compensation import CompensationTable
+    compensation = CompensationTable(cfg.COMPENSATION, list(cfg.MQ_SENSORS.keys()))
+
+# R0 values of the latest calibration with get_R0_values.py that converged, if any,
+# at the reference conditions of the compensation. Without R0 values the sampler doesn't start.
+calibrations = load_calibrations(cfg.CALIBRATION_PATH)
+calibration = usable_calibration(calibrations)
+if calibrations and calibration is None:
+    print('None of the calibrations in {} converged'.format(cfg.CALIBRATION_PATH))
+mq_sensors = apply_calibration(cfg.MQ_SENSORS, calibration, compensation)
+
+# Precompiled conversion of raw MQ readings to ppm values
+conversion_table = ConversionTable(mq_sensors, cfg.CURVES, compensation=compensation)
+
+# GrovePi and BME680 sensor, or their simulators
+adc, bme680_sensor = create_backends(cfg.SENSOR_BACKEND, conversion_table.pins, cfg.SIMULATED_TRACE)
+
+# Continuous high-rate readings of the MQ sensors, filtered when a sample is taken
+oversampler = None
+if cfg.OVERSAMPLING:
+    from oversampling import OversamplingReader
+    oversampler = OversamplingReader(adc, conversion_table.pins,
+                                     window=cfg.OVERSAMPLING_WINDOW,
+                                     method=cfg.OVERSAMPLING_FILTER,
+                                     rate=cfg.OVERSAMPLING_RATE,
+                                     trim=cfg.OVERSAMPLING_TRIM,
+                                     alpha=cfg.OVERSAMPLING_EMA_ALPHA)
+
+# Durations of the stages of the pipeline
+adc_timer = registry.timer('adc')
+bme680_timer = registry.timer('bme680')
+
+def read_mq():
+    """Read all MQ sensors (NB_RS_READ times, or from the oversampler)
+    Returns
+    -------
+    dict
+        raw analog readings with keys like 'mq2_raw'
+    """
+    with adc_timer.time():
+        if oversampler is not None:
+            mq_values = oversampler.filtered(timeout=cfg.FIREBASE_INTERVAL)
+        else:
+            mq_values = read_analog_average(adc, conversion_table.pins, cfg.NB_RS_READ, cfg.RS_INTERVAL)
+    return dict(zip(conversion_table.raw_keys, mq_values.tolist()))
+
+def read_bme680():
+    """Read temperature, pressure and humidity with BME680 sensor
     Returns
     -------
-    ppm_val
-        float
+    dict
+        values with keys 'temperature', 'pressure' and 'humidity'
     """
-    x_val = (np.log10(Rs_R0_ratio) - curve['y'])/curve['slope'] + curve['x']
-    ppm_val = np.power(x_val, 10)
-    return ppm_val
-
-# Initialize Firebase app with credentials
-firebase_path = Path.cwd() / cfg.FIREBASE_CREDS_JSON
-cred = credentials.Certificate(str(firebase_path))
-firebase_admin.initialize_app(cred)
-
-# Create Firestore object
-db = firestore.client()
-
-# mq_values will contain the MQ sensor values
-mq_values = {}
-
-# ppm_values will contain the gas concentration values
-ppm_values = {}
-
-# Set pin mode to INPUT for all MQ sensors
-for mq_sensor, data in cfg.MQ_SENSORS.items():
-    grovepi.pinMode(data['pin'],"INPUT")
-    mq_values[mq_sensor] = 0  # Initizalize mq_sensor values to zero
-    for gas, curve in cfg.CURVES[mq_sensor].items():
-        ppm_values[mq_sensor] = {}  # Initialize empty dict for each mq_sensor
-
-# Set port for BME680 sensor
-# Set sampling rates and filter for BME680 sensor
-bme680_sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
-bme680_sensor.set_humidity_oversample(bme680.OS_2X)
-bme680_sensor.set_pressure_oversample(bme680.OS_4X)
-bme680_sensor.set_temperature_oversample(bme680.OS_8X)
-bme680_sensor.set_filter(bme680.FILTER_SIZE_3)
-
-running = True
-while running:
-    try:
-        # Read temperature, pressure and humidity with BME680 sensor
-        bme680_sensor.get_sensor_data()
-
-        # Read MQ sensors value NB_RS_READ times
-        for i in range(cfg.NB_RS_READ):
-            for mq_sensor, value in mq_values.items():
-                mq_values[mq_sensor] += grovepi.analogRead(cfg.MQ_SENSORS[mq_sensor]['pin'])
-            time.sleep(cfg.RS_INTERVAL)
-
-        # Compute ppm values
-        for mq_sensor, value in mq_values.items():
-            # average mq_sensor value
-            mq_values[mq_sensor] = mq_values[mq_sensor]/cfg.NB_RS_READ
-            # mq_sensor voltage
-            mq_values[mq_sensor] = mq_values[mq_sensor]/cfg.AR_MAX * cfg.VC
-            # mq_sensor resistance
-            mq_values[mq_sensor] = (cfg.VC - mq_values[mq_sensor])/mq_values[mq_sensor]
-            # Rs/R0 ratio
-            mq_values[mq_sensor] = mq_values[mq_sensor]/cfg.MQ_SENSORS[mq_sensor]['r0']
-
-            # Linear interpolation of ppm with the Rs/R0 ratio
-            for gas, curve in cfg.CURVES[mq_sensor].items():
-                ppm_values[mq_sensor][gas] = get_ppm(mq_values[mq_sensor], curve)
-
-        # Sending data to Firebase
-        firebase_values = {mq_sensor + '_' + gas + '_ppm': ppm
-                            for mq_sensor, gases in ppm_values.items()
-                            for gas, ppm in gases.items()
-                          }
-        firebase_values['temperature'] = bme680_sensor.data.temperature
-        firebase_values['pressure'] = bme680_sensor.data.pressure
-        firebase_values['humidity'] = bme680_sensor.data.humidity
-        firebase_values['date'] = datetime.now()
-
-        db.collection(cfg.FIREBASE_DB_NAME).add(firebase_values)  # add method will use auto-generated document ID 
-
-        # Send data at a set interval
-        time.sleep(cfg.FIREBASE_INTERVAL)
-
-    except IOError:
-        print ("Error reading MQ data")
-
-    except KeyboardInterrupt:
-        print('Program stopped')
-        running = False
+    with bme680_timer.time():
+        return bme680_sensor.read()
+
+# Read the sensors in background threads at a set interval
+sampler = Sampler(read_mq, read_bme680,
+                  mq_interval=cfg.FIREBASE_INTERVAL,
+                  bme680_interval=cfg.BME680_INTERVAL,
+                  queue_size=cfg.SAMPLE_QUEUE_SIZE)
+
+# Every sample is written to the local buffer first and sent to Firebase
+# (or the collector) in batches by a background thread
+sample_buffer = SampleBuffer(cfg.BUFFER_DB_PATH)
+flusher = BufferFlusher(sample_buffer,
+                        write_batch,
+                        interval=cfg.FIREBASE_FLUSH_INTERVAL,
+                        batch_size=cfg.FIREBASE_BATCH_SIZE,
+                        max_backoff=cfg.FIREBASE_MAX_BACKOFF,
+                        retention=timedelta(days=cfg.BUFFER_RETENTION_DAYS))
+
+# Rollups per minute, hour and day are maintained while the samples come in
+rollup_aggregator = RollupAggregator(conversion_table.keys + ['temperature', 'pressure', 'humidity'],
+                                     cfg.ROLLUP_RESOLUTIONS)
+
+# Columnar archive of all samples on the local disk, with the raw readings and the ppm values
+archive = None
+if cfg.ARCHIVE_PATH:
+    from archive import SampleArchive
+    archive = SampleArchive(cfg.ARCHIVE_PATH, conversion_table.raw_keys + rollup_aggregator.fields)
+
+# Health check, ppm values, local buffer, archive and rollups of every sample
+store = SampleStore(conversion_table, sample_buffer, rollup_aggregator, archive)
+store.store_metadata()
+
+# Restore the periods that were in progress before a restart with the buffered samples
+store.restore_rollups(datetime.now())
+
+# Queue lengths and write counts, read when the metrics are scraped
+registry.gauge('sample_queue_length', sampler.sample_queue.qsize, 'Number of readings waiting to be stored')
+registry.gauge('buffer_pending', sample_buffer.nb_pending, 'Number of samples waiting to be sent')
+registry.gauge('documents_sent', lambda: flusher.nb_sent, 'Number of documents sent since the start')
+registry.gauge('write_failures', lambda: flusher.nb_failures, 'Number of failed batch writes since the start')
+store.register_gauges()
+profiler = start_instrumentation(cfg.METRICS_PORTS.get('sampler'), cfg.METRICS_HOST,
+                                 cfg.PROFILE_PATH.format('sampler') if cfg.PROFILE_PATH else None,
+                                 cfg.PROFILE_INTERVAL)
+
+if oversampler is not None:
+    oversampler.start()
+sampler.start()
+flusher.start()
+
+try:
+    for i, sample in enumerate(sampler.samples()):
+        store.store(sample)
+        if i == 0:
+            # Tracked by the startup benchmark, see benchmark.py --startup
+            print('First sample stored', flush=True)
+
+except KeyboardInterrupt:
+    print('Program stopped')
+    sampler.stop()
+    if oversampler is not None:
+        oversampler.stop()
+    for sample in sampler.samples():
+        store.store(sample)
+    # Store the periods in progress, they are completed after a restart
+    store.store_current_rollups()
+    flusher.stop()
+    sample_buffer.close()
+    if profiler is not None:
+        profiler.stop()
@@ -0,0 +1,207 @@
+# ------------------------------------------------------------------
+#                   Health of the MQ sensors
+# ------------------------------------------------------------------
+# Every raw reading of an MQ sensor is checked before it is converted
+# to ppm values:
+# - 'invalid': the reading is missing, NaN or infinite
+# - 'rail_low': the reading is 0 or close to it, e.g. a disconnected
+#   pin, the ppm value would be a division by zero
+# - 'rail_high': the ADC is saturated at AR_MAX
+# - 'stuck': the same reading was repeated many times in a row, by a
+#   sensor that was noisier than one ADC count before. A steady sensor
+#   with less noise than that repeats the same quantized reading, which
+#   is still a live sensor
+# - 'spike': the reading is far from the recent readings (rolling
+#   z-score), which can be a real gas event
+#
+# The readings with one of the first four statuses are quarantined:
+# they are left out of the sample, so no ppm values are computed for
+# that sensor. Spikes are kept and only tagged. A sample gets a field
+# '<sensor>_health' for every sensor that isn't 'ok'.
+#
+# The statistics of every sensor are updated in O(1) time and memory:
+# the mean and variance of all readings (Welford) and an exponentially
+# weighted mean and variance for the z-score.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import math
+from datetime import datetime
+
+# Statuses of which the readings are left out of the samples
+QUARANTINED = {'invalid', 'rail_low', 'rail_high', 'stuck'}
+
+
+def health_collection(collection_name):
+    """Name of the collection with the health status of every device"""
+    return collection_name + '_health'
+
+
+class SensorHealth:
+    """Streaming checks and statistics of the raw readings of one MQ sensor
+
+    Parameters
+    ----------
+    ar_max : int
+        maximum output value of the analogRead method
+    rail_margin : float
+        readings within this distance of 0 or ar_max are on a rail
+    stuck_count : int or None
+        number of identical readings in a row of a stuck sensor, None to disable
+    stuck_tolerance : float
+        rolling standard deviation, in ADC counts, above which a sensor repeating
+        the same reading is stuck
+    z_threshold : float
+        rolling z-score above which a reading is a spike
+    alpha : float
+        weight of a new reading in the rolling mean and variance
+    warmup : int
+        number of readings before spikes are detected
+    """
+
+    def __init__(self, ar_max, rail_margin=2, stuck_count=60, stuck_tolerance=1, z_threshold=6, alpha=0.05,
+                 warmup=30):
+        self.ar_max = ar_max
+        self.rail_margin = rail_margin
+        self.stuck_count = stuck_count
+        self.stuck_tolerance = stuck_tolerance
+        self.z_threshold = z_threshold
+        self.alpha = alpha
+        self.warmup = warmup
+
+        # Welford's running mean and sum of squared differences of all valid readings
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        # Exponentially weighted mean and variance of the recent readings
+        self.ew_mean = None
+        self.ew_var = 0.0
+        self.z = 0.0
+        # Repetitions of the last reading, and the rolling standard deviation before them
+        self.last = None
+        self.repeats = 0
+        self.repeats_std = 0.0
+        self.status = 'ok'
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def update(self, value):
+        """Check a reading and update the statistics
+        Returns
+        -------
+        str
+            status of the reading
+        """
+        if value is None or not math.isfinite(value):
+            self.status = 'invalid'
+            return self.status
+
+        if value == self.last:
+            self.repeats += 1
+        else:
+            self.repeats = 1
+            self.repeats_std = math.sqrt(self.ew_var)
+        self.last = value
+
+        if value <= self.rail_margin:
+            self.status = 'rail_low'
+        elif value >= self.ar_max - self.rail_margin:
+            self.status = 'rail_high'
+        elif (self.stuck_count is not None and self.repeats >= self.stuck_count
+              and self.repeats_std > self.stuck_tolerance):
+            self.status = 'stuck'
+        else:
+            self.status = 'ok'
+            self._add(value)
+        return self.status
+
+    def _add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        if self.ew_mean is None:
+            self.ew_mean = value
+            return
+        delta = value - self.ew_mean
+        std = math.sqrt(self.ew_var)
+        self.z = delta / std if std > 0 else 0.0
+        if self.count > self.warmup and abs(self.z) > self.z_threshold:
+            self.status = 'spike'
+        # West's exponentially weighted update of the mean and variance
+        self.ew_mean += self.alpha * delta
+        self.ew_var = (1 - self.alpha) * (self.ew_var + self.alpha * delta * delta)
+
+    def summary(self):
+        return {
+            'status': self.status,
+            'last': self.last,
+            'count': self.count,
+            'mean': self.mean,
+            'std': math.sqrt(self.variance),
+            'z': self.z
+        }
+
+
+class HealthMonitor:
+    """Health of all MQ sensors of a device
+
+    Parameters
+    ----------
+    sensors : list
+        names of the MQ sensors, e.g. ['mq2', 'mq9']
+    ar_max : int
+        maximum output value of the analogRead method
+    **params
+        parameters of SensorHealth
+    """
+
+    def __init__(self, sensors, ar_max, **params):
+        self.sensors = {sensor: SensorHealth(ar_max, **params) for sensor in sensors}
+        self.changed = False
+
+    def check(self, sample):
+        """Check the raw readings of a sample, quarantined readings are removed from the sample
+        Parameters
+        ----------
+        sample : dict
+            raw readings with keys like 'mq2_raw'
+        Returns
+        -------
+        dict
+            status per sensor that isn't 'ok'
+        """
+        statuses = {}
+        for sensor, health in self.sensors.items():
+            key = sensor + '_raw'
+            previous = health.status
+            status = health.update(sample.get(key))
+            if status != previous:
+                self.changed = True
+                print('{} sensor {}: {} -> {} (reading {})'.format(
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sensor, previous, status, sample.get(key)))
+            if status == 'ok':
+                continue
+            statuses[sensor] = status
+            sample[sensor + '_health'] = status
+            if status in QUARANTINED:
+                sample.pop(key, None)
+        return statuses
+
+    def doc(self, device, date=None):
+        """Document with the health of every sensor of a device, resets changed"""
+        self.changed = False
+        return {
+            'date': date or datetime.now(),
+            'device': device,
+            'sensors': {sensor: health.summary() for sensor, health in self.sensors.items()}
+        }
@@ -3,7 +3,10 @@
 # ------------------------------------------------------------------
 # This script will send alert notifications when the values on 
 # the MQ2 sensor reaches a critical value. Additionally, it will 
-# turn on ventilation when the air quality is bad.
+# turn on ventilation when the air quality is bad (see ventilation.py).
+#
+# Every new sample on Firebase (or in the local archive) is checked
+# as soon as it arrives.
 #
 # Author : Bert Carremans
 # Date   : 23/01/2019
@@ -17,115 +20,154 @@
 # ------------------------------------------------------------------
 import config as cfg
 from pathlib import Path
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
 
+import queue
 from datetime import datetime
 from datetime import timedelta
-import pytz
-
-import energenie
-
-def find_crit_val(timestamps, val_list, ubound):
-    """Find the first timestamp with a critical value
-    Parameters
-    ----------
-    timestamps : list with timestamps for the sensor values
-    val_list : list with ppm values of a gas
-    ubound : upperbound for ppm values of a gas
-    Returns
-    -------
-    (crit_time, crit_value)
-        tuple with timestamp and critical value
-    """
-    try:
-        (crit_time, crit_value) = next(((i,v) for i, v in zip(timestamps, val_list) if v > ubound))          
-    except:
-        (crit_time, crit_value) = (None,None)
-    return (crit_time, crit_value)
 
-sensor_on = True
-ventilation_on = False
+from alert_engine import RuleEvaluator, ArchiveFollower, listen_new_samples
+from ventilation import VentilationController, create_units
+from notifications import NotificationDispatcher, create_channels
+from health import QUARANTINED
+from metrics import registry, start_instrumentation
+from storage import utc_date
 
-reference_time = datetime.now()  # timestamp to compare if one hour has passed before sending alerts
-
-# Initialize Firebase app with credentials
-firebase_path = Path.cwd() / cfg.FIREBASE_CREDS_JSON
-cred = credentials.Certificate(str(firebase_path))
-firebase_admin.initialize_app(cred)
+sensor_on = True
 
-# Create Firestore object
-db = firestore.client()
+# The alerts are sent in the background, at most once per alert interval per room and gas
+notifications = NotificationDispatcher(create_channels(cfg.NOTIFICATION_CHANNELS,
+                                                       email=cfg.EMAIL,
+                                                       email_pw=cfg.EMAIL_PW,
+                                                       smtp_host=cfg.SMTP_HOST,
+                                                       smtp_port=cfg.SMTP_PORT,
+                                                       smtp_starttls=cfg.SMTP_STARTTLS,
+                                                       webhook_url=cfg.NOTIFICATION_WEBHOOK_URL,
+                                                       log_path=cfg.NOTIFICATION_LOG_PATH),
+                                       cooldown=timedelta(minutes=cfg.ALERT_INTERVAL).total_seconds(),
+                                       coalesce=cfg.NOTIFICATION_COALESCE,
+                                       queue_size=cfg.NOTIFICATION_QUEUE_SIZE)
+# Time every send per channel, from the background thread of the dispatcher
+for channel in notifications.channels:
+    channel.send = registry.timed('notify_' + type(channel).__name__.lower().replace('channel', ''), channel.send)
+notifications.start()
+
+# The ventilation units are switched by their own control loop
+# The Energenie library is only needed when there are ventilation units
+units = []
+if cfg.VENTILATION_UNITS:
+    import energenie
+    units = create_units(cfg.VENTILATION_UNITS, cfg.ALERT_SENSOR, cfg.UPPERBOUNDS, cfg.VENTILATION_OFF_RATIO,
+                         cfg.VENTILATION_MIN_ON, cfg.VENTILATION_MIN_OFF, energenie.switch_on, energenie.switch_off)
+ventilation = VentilationController(units, tick=cfg.VENTILATION_TICK)
+ventilation.start()
+
+# Every new sample is pushed onto the queue as soon as it is stored
+evaluator = RuleEvaluator(cfg.ALERT_SENSOR, cfg.ALERT_GASES, cfg.UPPERBOUNDS,
+                          cfg.ALERT_RULES, cfg.ALERT_DEFAULT_RULES)
+sample_queue = queue.Queue()
+deriver = None
+start = datetime.now()
+if cfg.ALERT_SOURCE == 'archive':
+    # Follow the local archive when running on the Raspberry Pi
+    from archive import SampleArchive
+    archive = SampleArchive(cfg.ARCHIVE_PATH, [key for _, key, _ in evaluator.bounds])
+    watch = ArchiveFollower(archive, sample_queue, start, cfg.FIREBASE_INTERVAL)
+    watch.start()
+else:
+    from loader import CachedLoader
+    from derivation import Deriver, DerivedLoader
+    from encoding import SchemaRegistry
+    from storage import create_storage
+
+    # Firestore, or a local stand-in chosen with STORAGE_BACKEND
+    storage = create_storage(cfg.STORAGE_BACKEND,
+                             firebase_path=Path.cwd() / cfg.FIREBASE_CREDS_JSON,
+                             sqlite_path=cfg.STORAGE_SQLITE_PATH)
+
+    # Compact samples are decoded with the schema of their device, and samples stored
+    # as raw readings get their ppm values with the calibration of their device
+    schemas = SchemaRegistry(storage, cfg.FIREBASE_DB_NAME)
+    compensation = None
+    if cfg.COMPENSATION:
+        from compensation import CompensationTable
+        compensation = CompensationTable(cfg.COMPENSATION, list(cfg.MQ_SENSORS.keys()))
+    deriver = Deriver(storage, cfg.FIREBASE_DB_NAME, cfg.MQ_SENSORS, cfg.CURVES, compensation)
+
+    # The samples of the last alert interval fill the windows of the rules at startup,
+    # the listener takes over from the last of them, so samples stored late in the
+    # meantime aren't missed. Only the samples from the start onwards are notified,
+    # the older ones were notified before a restart.
+    history = max(cfg.ALERT_INTERVAL, evaluator.history)
+    loader = DerivedLoader(CachedLoader(storage, cfg.LOADER_CACHE_SIZE, cfg.LOADER_CACHE_TTL, schemas=schemas),
+                           deriver,
+                           cfg.LOADER_CACHE_SIZE, cfg.LOADER_CACHE_TTL)
+    with registry.timer('alert_history').time():
+        dates, values = loader.load(cfg.FIREBASE_DB_NAME, [key for _, key, _ in evaluator.bounds] + ['device'],
+                                    start - timedelta(minutes=history), start)
+    listen_start = dates[-1] if len(dates) > 0 else start
+    for i, date in enumerate(dates):
+        if date == listen_start:
+            # Passed on by the listener, which includes its start date
+            break
+        sample = {field: column[i] for field, column in values.items() if column[i] is not None}
+        sample['date'] = date
+        sample_queue.put(sample)
+    watch = listen_new_samples(storage, cfg.FIREBASE_DB_NAME, sample_queue, listen_start)
+
+# Durations of the stages of the alert loop, and the lengths of the queues
+derive_timer = registry.timer('derive')
+evaluate_timer = registry.timer('evaluate')
+ventilation_timer = registry.timer('ventilation')
+samples_counter = registry.counter('alert_samples_total', 'Number of samples checked for critical values')
+alerts_counter = registry.counter('alerts_total', 'Number of critical values')
+registry.gauge('alert_queue_length', sample_queue.qsize, 'Number of samples waiting to be checked')
+registry.gauge('notification_queue_length', notifications.pending_count, 'Number of alerts waiting to be sent')
+profiler = start_instrumentation(cfg.METRICS_PORTS.get('alert'), cfg.METRICS_HOST,
+                                 cfg.PROFILE_PATH.format('alert') if cfg.PROFILE_PATH else None,
+                                 cfg.PROFILE_INTERVAL)
 
 while sensor_on:
     try:
-        # Check for critical values and send an alert via email if necessary
-        if datetime.now() > reference_time + timedelta(minutes=cfg.ALERT_INTERVAL):
-            reference_time = datetime.now()
-
-            print('Checking for critical values')
-            # Read data from Firebase
-            # Order by date and select results of the alert interval
-            # Current time localized to timezone of Brussels
-            brussels_tz = pytz.timezone('Europe/Brussels')
-            prev_check_time = brussels_tz.localize(datetime.now()) - timedelta(minutes=cfg.ALERT_INTERVAL)
-
-            # Preparing the data
-            ppm_vals = {}
-            for gas in cfg.ALERT_GASES:
-                ppm_vals[gas] = []
-            timestamps = []
-
-            docs = db.collection(cfg.FIREBASE_DB_NAME).order_by(u'date').where(u'date', '>=', prev_check_time).get()
-            for doc in docs:
-                data = doc.to_dict()
-                for gas in cfg.ALERT_GASES:
-                    ppm_vals[gas].append(data[cfg.ALERT_SENSOR + gas + '_ppm'])
-
-                # Extract hour, minutes and seconds
-                timestamps.append(data['date'].strftime('%H:%M:%S'))
-
-            # Looking for critical values
-            crit_dict = {}
-            for gas in cfg.ALERT_GASES:
-                (crit_time, crit_value) = find_crit_val(timestamps, ppm_vals[gas], cfg.UPPERBOUNDS[gas])
-                crit_dict[gas] = (crit_time, crit_value)
-
-            critical_msg = ''
-            for k, v in crit_dict.items():
-                # If we find a critical value, we add this to critical_msg
-                if v[0] is not None and v[1] is not None:
-                    critical_msg += '\nCritical value for ' + k + ' of ' + str(v[1]) + cfg.UNITS[k] + ' at ' + str(v[0])
-
-            if critical_msg != '':
-                 # Turning/keeping on the ventilation
-                if not ventilation_on:
-                    energenie.switch_on(1)
-                    ventilation_on = True
-
-                try:
-                    # Sending an email (source: https://automatetheboringstuff.com/chapter16/)
-                    msg = MIMEText(critical_msg, _charset='utf-8')  # Encoding the email message
-                    msg['Subject'] = Header('Air Quality Alert', 'utf-8')
-                    print('Sending email with critical values')
-                    smtpObj = smtplib.SMTP('smtp.gmail.com', 587)
-                    smtpObj.ehlo()
-                    smtpObj.starttls()
-                    smtpObj.login(cfg.EMAIL, cfg.EMAIL_PW)
-                    smtpObj.sendmail(cfg.EMAIL, cfg.EMAIL, msg.as_string())
-                    smtpObj.quit()  
-                except smtplib.SMTPException:
-                    print('Something went wrong while sending the email')
-            else:
-                # Turning/keeping off the ventilation
-                if ventilation_on:
-                    energenie.switch_off(1)
-                    ventilation_on = False
+        # Wait for the next sample
+        sample = sample_queue.get()
+        samples_counter.inc()
+        if deriver is not None:
+            with derive_timer.time():
+                sample = deriver.derive_sample(schemas.expand(sample))
+
+        # Samples stored before samples had a device belong to this device
+        device = sample.get('device', cfg.DEVICE_ID)
+
+        # Looking for critical values
+        with evaluate_timer.time():
+            crit_dict = evaluator.critical_values(sample, device)
+        alerts_counter.inc(len(crit_dict))
+
+        # Turning on or off the ventilation of the room
+        with ventilation_timer.time():
+            ventilation.update(device, sample, crit_dict)
+
+        if utc_date(sample['date']) < utc_date(start):
+            # Checked before a restart, only the windows of the rules are filled
+            continue
+
+        # Queueing the alerts, they are sent in the background
+        for gas, (rule, value) in crit_dict.items():
+            notifications.notify(device, gas, 'Critical ' + rule + ' for ' + gas + ' of ' + str(value)
+                                 + cfg.UNITS[gas] + ' in ' + device + ' at ' + sample['date'].strftime('%H:%M:%S'))
+
+        # Sensors of which the readings were quarantined by the sampler, see health.py
+        for sensor in cfg.MQ_SENSORS:
+            status = sample.get(sensor + '_health')
+            if status in QUARANTINED:
+                notifications.notify(device, sensor, 'Sensor ' + sensor + ' in ' + device + ' is ' + status
+                                     + ' at ' + sample['date'].strftime('%H:%M:%S') + ', its readings are ignored')
+
     except KeyboardInterrupt:
         print('Program stopped')
-        sensor_on = False
\ No newline at end of file
+        watch.unsubscribe()
+        ventilation.stop()
+        notifications.stop()
+        if profiler is not None:
+            profiler.stop()
+        sensor_on = False
@@ -0,0 +1,191 @@
+# ------------------------------------------------------------------
+#                   Storing the samples of a device
+# ------------------------------------------------------------------
+# The steps every sample of get_sensor_values.py goes through once the
+# sensors are read:
+# - the health check of the MQ readings (see health.py)
+# - the conversion to ppm values
+# - the write to the local buffer, as ppm values or raw readings
+#   (INGEST_MODE) and keyed or compact (SAMPLE_ENCODING)
+# - the local archive and the rollups
+#
+# A sample dated before the previous one (the clock of the Pi was set
+# back, e.g. by NTP after a boot) is still written to the local buffer,
+# but left out of the archive and the rollups, which are in
+# chronological order.
+#
+# The benchmark (see benchmark.py) drives the same steps, so its
+# timings are those of the real pipeline.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import config as cfg
+from derivation import calibration_collection, calibration_doc, raw_sample
+from encoding import SampleSchema, SCHEMA_FIELD, VALUES_FIELD, sample_fields, schema_collection
+from health import HealthMonitor, QUARANTINED, health_collection
+from metrics import registry
+from rollups import bucket_start, rollup_collection, rollup_doc_id
+
+
+def create_health_monitor(conversion_table):
+    """Health monitor of the MQ sensors with the settings of the config"""
+    return HealthMonitor(conversion_table.sensors, conversion_table.ar_max,
+                         rail_margin=cfg.HEALTH_RAIL_MARGIN,
+                         stuck_count=cfg.HEALTH_STUCK_COUNT,
+                         stuck_tolerance=cfg.HEALTH_STUCK_TOLERANCE,
+                         z_threshold=cfg.HEALTH_Z_THRESHOLD,
+                         alpha=cfg.HEALTH_EWMA_ALPHA,
+                         warmup=cfg.HEALTH_WARMUP)
+
+
+class SampleStore:
+    """Check, convert and store the samples of a device
+
+    Parameters
+    ----------
+    conversion_table : ConversionTable
+    sample_buffer : SampleBuffer
+        local buffer the documents are written to
+    rollup_aggregator : RollupAggregator
+    archive : SampleArchive or None
+        local archive of all samples, None to disable
+    health : HealthMonitor or None
+        None for a monitor with the settings of the config
+    device : str or None
+        room of the samples, None for cfg.DEVICE_ID
+    collection_name : str or None
+        collection of the samples, None for cfg.FIREBASE_DB_NAME
+    ingest_mode : str or None
+        'ppm' or 'raw', None for cfg.INGEST_MODE
+    encoding : str or None
+        'keyed' or 'compact', None for cfg.SAMPLE_ENCODING
+    timer : callable
+        function returning the timer of a stage, with a time() context manager
+    """
+
+    def __init__(self, conversion_table, sample_buffer, rollup_aggregator, archive=None, health=None,
+                 device=None, collection_name=None, ingest_mode=None, encoding=None, timer=registry.timer):
+        self.conversion_table = conversion_table
+        self.sample_buffer = sample_buffer
+        self.rollup_aggregator = rollup_aggregator
+        self.archive = archive
+        self.health = create_health_monitor(conversion_table) if health is None else health
+        self.device = cfg.DEVICE_ID if device is None else device
+        self.collection_name = cfg.FIREBASE_DB_NAME if collection_name is None else collection_name
+        self.ingest_mode = cfg.INGEST_MODE if ingest_mode is None else ingest_mode
+        self.encoding = cfg.SAMPLE_ENCODING if encoding is None else encoding
+
+        # Fixed order of the values of compact samples, with the fields that are stored
+        self.schema = SampleSchema(sample_fields(conversion_table, self.ingest_mode))
+
+        # Durations of the stages and counts
+        self.timers = {stage: timer(stage) for stage in ('health', 'ppm', 'buffer', 'archive', 'rollups')}
+        self.samples_counter = registry.counter('samples_total', 'Number of samples stored in the local buffer')
+        self.health_counters = {}
+        self.out_of_order_counter = registry.counter('samples_out_of_order_total',
+                                                     'Number of samples dated before the previous sample')
+        self.last_date = None
+
+    def store_metadata(self):
+        """Write the documents the readers need to the local buffer: the calibration
+        of the raw samples and the schema of the compact samples"""
+        if self.ingest_mode == 'raw':
+            # The ppm values are derived from the raw samples on read, with the R0 values of this calibration
+            doc_id, doc = calibration_doc(self.conversion_table, self.device)
+            self.sample_buffer.append(doc, collection=calibration_collection(self.collection_name), doc_id=doc_id)
+        if self.encoding == 'compact':
+            doc_id, doc = self.schema.doc()
+            self.sample_buffer.append(doc, collection=schema_collection(self.collection_name), doc_id=doc_id)
+
+    def check_health(self, sample):
+        """Quarantine the bad readings of a sample and publish the health of the sensors when it changed"""
+        for sensor, status in self.health.check(sample).items():
+            if (sensor, status) not in self.health_counters:
+                self.health_counters[sensor, status] = registry.counter(
+                    'sensor_health_total', 'Number of readings that are not ok, per sensor and status',
+                    sensor=sensor, status=status)
+            self.health_counters[sensor, status].inc()
+        if self.health.changed:
+            # One document per device, overwritten when a status changes
+            self.sample_buffer.append(self.health.doc(self.device, sample['date']),
+                                      collection=health_collection(self.collection_name), doc_id=self.device)
+
+    def document(self, sample):
+        """Document stored for a sample, in the ingest mode and encoding"""
+        if self.ingest_mode == 'raw':
+            doc = raw_sample(sample, self.conversion_table)
+        else:
+            doc = {key: value for key, value in sample.items() if key not in self.conversion_table.raw_keys}
+        return self.schema.compact(doc) if self.encoding == 'compact' else doc
+
+    def store(self, sample):
+        """Write a sample and the rollups it completes to the local buffer and archive
+        The ppm values of all sensors and gases are computed in one pass, with the
+        temperature and humidity of the sample.
+        """
+        with self.timers['health'].time():
+            self.check_health(sample)
+        with self.timers['ppm'].time():
+            self.conversion_table.derive_sample(sample)
+        sample['device'] = self.device
+        with self.timers['buffer'].time():
+            self.sample_buffer.append(self.document(sample))
+        self.samples_counter.inc()
+
+        if self.last_date is not None and sample['date'] < self.last_date:
+            self.out_of_order_counter.inc()
+            print('Sample of {} is dated before the previous sample of {}, not archived'.format(
+                sample['date'], self.last_date))
+            return
+        self.last_date = sample['date']
+        if self.archive is not None:
+            with self.timers['archive'].time():
+                try:
+                    self.archive.append(sample)
+                except ValueError as e:
+                    # Dated before the samples archived before a restart
+                    self.out_of_order_counter.inc()
+                    print('Sample of {} not archived: {}'.format(sample['date'], e))
+        with self.timers['rollups'].time():
+            for resolution, rollup in self.rollup_aggregator.add(sample):
+                self.store_rollup(resolution, rollup)
+
+    def store_rollup(self, resolution, rollup):
+        """Write a rollup to the local buffer, the same period always overwrites the same document"""
+        rollup['device'] = self.device
+        self.sample_buffer.append(rollup,
+                                  collection=rollup_collection(self.collection_name, resolution),
+                                  doc_id=rollup_doc_id(resolution, rollup['date'], self.device))
+
+    def store_current_rollups(self):
+        """Store the periods in progress, they are completed after a restart"""
+        for resolution, rollup in self.rollup_aggregator.current():
+            self.store_rollup(resolution, rollup)
+
+    def restore_rollups(self, now):
+        """Restore the periods that were in progress before a restart with the buffered samples"""
+        oldest_start = min(bucket_start(now, resolution) for resolution in self.rollup_aggregator.resolutions)
+        for sample in self.sample_buffer.samples_since(oldest_start):
+            if VALUES_FIELD in sample:
+                if sample[SCHEMA_FIELD] != self.schema.version:
+                    # Stored with another config, the period is completed with the new samples only
+                    continue
+                sample = self.schema.expand(sample)
+            if self.last_date is not None and sample['date'] < self.last_date:
+                continue
+            self.last_date = sample['date']
+            self.rollup_aggregator.add(self.conversion_table.derive_sample(sample))
+
+    def register_gauges(self):
+        """Health of every sensor, read when the metrics are scraped"""
+        for sensor, sensor_health in self.health.sensors.items():
+            registry.gauge('sensor_ok', lambda h=sensor_health: float(h.status not in QUARANTINED),
+                           'Whether the readings of a sensor are used, 0 when they are quarantined', sensor=sensor)
+            registry.gauge('sensor_zscore', lambda h=sensor_health: h.z, 'Rolling z-score of the last reading',
+                           sensor=sensor)
@@ -0,0 +1,124 @@
+# ------------------------------------------------------------------
+#                    Cached loader of sensor data
+# ------------------------------------------------------------------
+# Shared data access for the dashboard and the alert checker.
+#
+# A time range of a collection is returned in a columnar format: a
+# list of dates and a NumPy array per field, read from the storage
+# backend (see storage.py). Results are kept in an LRU cache with a time-to-live, keyed by the
+# collection, time range, fields and device. Repeated loads of the
+# same data are served from memory instead of re-reading the
+# documents.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from encoding import SCHEMA_FIELD, VALUES_FIELD
+
+
+class TTLCache:
+    """Least recently used cache of which the entries expire after a time-to-live
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of entries
+    ttl : float
+        number of seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize=32, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get the value of a key, None when it isn't cached or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def to_column(values):
+    """Convert a list of values into a NumPy array, float when possible
+    Missing numeric values become NaN. Strings and bytes are kept as they are,
+    even when they look like numbers (e.g. a calibration version of digits only).
+    """
+    first = next((v for v in values if v is not None), None)
+    if isinstance(first, (str, bytes)):
+        return np.array(values, dtype=object)
+    try:
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=object)
+
+
+class CachedLoader:
+    """Load time ranges of collections through a TTL cache
+
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    maxsize : int
+        maximum number of cached results
+    ttl : float
+        number of seconds a result stays valid
+    schemas : SchemaRegistry or None
+        schemas of the compact samples (see encoding.py), None when all samples are keyed
+    """
+
+    def __init__(self, storage, maxsize=32, ttl=60, schemas=None):
+        self.storage = storage
+        self.cache = TTLCache(maxsize, ttl)
+        self.schemas = schemas
+
+    def load(self, collection_name, fields, start, end=None, device=None):
+        """Read the samples of a collection in a time range, see Storage.range
+        The returned arrays are shared between callers and should not be modified.
+        """
+        key = (collection_name, start, end, tuple(fields), device)
+        result = self.cache.get(key)
+        if result is None:
+            if self.schemas is None:
+                result = self.storage.range(collection_name, fields, start, end, device)
+            else:
+                # Compact samples are decoded into the columns of the keyed samples
+                dates, values = self.storage.range(collection_name, list(fields) + [SCHEMA_FIELD, VALUES_FIELD],
+                                                   start, end, device)
+                values = dict(values)
+                values.update(self.schemas.decode_columns(values, fields))
+                result = dates, {field: values[field] for field in fields}
+            self.cache.put(key, result)
+        return result
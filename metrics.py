@@ -0,0 +1,311 @@
+# ------------------------------------------------------------------
+#                   Instrumentation of the pipeline
+# ------------------------------------------------------------------
+# Timers, counters and gauges around the stages of the scripts, e.g.
+# reading the ADC, computing the ppm values, writing to Firestore,
+# evaluating the alert rules or sending an email.
+#
+# Durations are measured with a monotonic clock and counted in
+# histograms with fixed buckets, so recording a duration costs a
+# bisection and an addition, whatever the number of measurements.
+#
+# The metrics are served as text in the Prometheus format on
+# http://<host>:<port>/metrics, and on /metrics of the dashboard.
+#
+# Optionally, a sampling profiler records the call stacks of all
+# threads at a fixed interval and writes them in the collapsed stack
+# format of flame graph tools (e.g. flamegraph.pl or speedscope).
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+# Upper bounds of the buckets of the durations, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PREFIX = 'air_quality_'
+
+
+class Counter:
+    """Number of events"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge:
+    """Value read when the metrics are rendered, e.g. the length of a queue
+
+    Parameters
+    ----------
+    fn : callable
+        function without arguments returning the value
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def samples(self, name, labels):
+        try:
+            value = self.fn()
+        except Exception:
+            value = float('nan')
+        return [(name, labels, value)]
+
+
+class Histogram:
+    """Distribution of values over fixed buckets
+
+    Parameters
+    ----------
+    buckets : tuple
+        upper bounds of the buckets in increasing order, values above the last bound go to +Inf
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the number of seconds spent in its block"""
+        return Timing(self)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + ['+Inf'], counts):
+            cumulative += n
+            samples.append((name + '_bucket', labels + (('le', str(bound)),), cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, count))
+        return samples
+
+
+class Timing:
+    """Measure the duration of a block with a monotonic clock"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    """Metrics of a process, by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}  # name -> (type, help, {labels: metric})
+
+    def _get(self, kind, name, help, labels, create):
+        name = PREFIX + name
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            _, _, metrics = self.families.setdefault(name, (kind, help, {}))
+            metric = metrics.get(labels)
+            if metric is None:
+                metric = metrics[labels] = create()
+            return metric
+
+    def counter(self, name, help='', **labels):
+        """Get or create a counter, the name should end with _total"""
+        return self._get('counter', name, help, labels, Counter)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        """Get or create a histogram"""
+        return self._get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, fn, help='', **labels):
+        """Register a function returning the value of a gauge"""
+        return self._get('gauge', name, help, labels, lambda: Gauge(fn))
+
+    def timer(self, stage):
+        """Histogram of the durations of a stage of the pipeline, use as `with registry.timer(stage).time():`"""
+        return self.histogram('stage_seconds', 'Duration of the stages of the pipeline', stage=stage)
+
+    def timed(self, stage, fn):
+        """Wrap a function, so every call is timed as a stage"""
+        histogram = self.timer(stage)
+
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def render(self):
+        """Metrics in the Prometheus text format"""
+        with self.lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in sorted(self.families.items())]
+        lines = []
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    label_text = ','.join('{}="{}"'.format(k, v) for k, v in sample_labels)
+                    lines.append('{}{} {}'.format(sample_name, '{' + label_text + '}' if label_text else '',
+                                                  repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the running script
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def serve_metrics(port, host='127.0.0.1', metrics_registry=registry):
+    """Serve the metrics on /metrics until the process stops"""
+    # Imported here, so the HTTP server doesn't delay the start of the scripts
+    from http.server import BaseHTTPRequestHandler
+    from http.server import ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are not logged
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print('Could not serve the metrics on port {}: {}'.format(port, e))
+        return
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def start_metrics_server(port, host='127.0.0.1', metrics_registry=registry):
+    """Serve the metrics in a background thread
+    Returns
+    -------
+    threading.Thread
+    """
+    thread = threading.Thread(target=serve_metrics, args=(port, host, metrics_registry),
+                              name='metrics', daemon=True)
+    thread.start()
+    return thread
+
+
+class SamplingProfiler(threading.Thread):
+    """Record the call stacks of all threads at a fixed interval
+
+    The stacks are written to a file in the collapsed stack format, one
+    line per stack with its number of samples, every dump_interval seconds
+    and when the profiler is stopped.
+
+    Parameters
+    ----------
+    path : str
+        file to write the stacks to
+    interval : float
+        number of seconds between two samples
+    dump_interval : float
+        number of seconds between two writes of the file
+    """
+
+    def __init__(self, path, interval=0.01, dump_interval=60):
+        super().__init__(name='profiler', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.stacks = StackCounter()
+        self.stop_event = threading.Event()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, code.co_filename.rsplit('/', 1)[-1],
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self):
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+    def run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump += self.dump_interval
+        self.dump()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.join(timeout)
+
+
+def start_instrumentation(port=None, host='127.0.0.1', profile_path=None, profile_interval=0.01):
+    """Start the metrics server and the profiler of a script, when they are configured
+    Returns
+    -------
+    SamplingProfiler or None
+    """
+    if port is not None:
+        start_metrics_server(port, host)
+    profiler = None
+    if profile_path is not None:
+        profiler = SamplingProfiler(profile_path, profile_interval)
+        profiler.start()
+    return profiler
@@ -0,0 +1,287 @@
+# ------------------------------------------------------------------
+#                   Sending alert notifications
+# ------------------------------------------------------------------
+# The alerts are kept per room and gas and sent by a background
+# thread, so a slow or unreachable mail server never delays the
+# detection of critical values or the ventilation control.
+#
+# The thread waits a few seconds after the first alert, so the alerts
+# of several gases end up in one message. A new alert for a room and
+# gas that is still pending replaces the old one, and an alert for the
+# same room and gas is accepted at most once per cooldown period.
+#
+# Every message is sent to all channels:
+# - 'smtp': email over one SMTP session, which is kept open between
+#   messages and reopened when the server closed it
+# - 'webhook': JSON POST request, e.g. to a chat or home automation service
+# - 'log': printed, or appended to a local file
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import json
+import threading
+import time
+from datetime import datetime
+
+
+class SMTPChannel:
+    """Send messages by email over a persistent SMTP session
+
+    Parameters
+    ----------
+    host : str
+    port : int
+    sender : str
+        email address of the sender, also the recipient when recipient is None
+    password : str or None
+        password to log in with the sender address, no login when None
+    recipient : str or None
+    starttls : bool
+        whether to encrypt the session with STARTTLS
+    timeout : float
+        number of seconds to wait for the server
+    """
+
+    def __init__(self, host, port, sender, password=None, recipient=None, starttls=True, timeout=30):
+        # Imported here, the mail modules are only needed with an SMTP channel
+        import smtplib
+        from email.header import Header
+        from email.mime.text import MIMEText
+        self.smtplib = smtplib
+        self.Header = Header
+        self.MIMEText = MIMEText
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.recipient = recipient or sender
+        self.starttls = starttls
+        self.timeout = timeout
+        self.session = None
+
+    def _connect(self):
+        session = self.smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            session.ehlo()
+            if self.starttls:
+                session.starttls()
+                session.ehlo()
+            if self.password is not None:
+                session.login(self.sender, self.password)
+        except (self.smtplib.SMTPException, OSError):
+            session.close()
+            raise
+        self.session = session
+
+    def send(self, subject, text):
+        msg = self.MIMEText(text, _charset='utf-8')  # Encoding the email message
+        msg['Subject'] = self.Header(subject, 'utf-8')
+        msg['From'] = self.sender
+        msg['To'] = self.recipient
+
+        # The server closes idle sessions, a closed session is reopened once
+        for attempt in range(2):
+            if self.session is None:
+                self._connect()
+            try:
+                self.session.sendmail(self.sender, [self.recipient], msg.as_string())
+                return
+            except (self.smtplib.SMTPServerDisconnected, OSError):
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.quit()
+            except (self.smtplib.SMTPException, OSError):
+                self.session.close()
+            self.session = None
+
+
+class WebhookChannel:
+    """Send messages as a JSON POST request with 'subject' and 'text'
+
+    Parameters
+    ----------
+    url : str
+    timeout : float
+        number of seconds to wait for the service
+    """
+
+    def __init__(self, url, timeout=10):
+        import urllib.request
+        self.urllib_request = urllib.request
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, subject, text):
+        body = json.dumps({'subject': subject, 'text': text}).encode('utf-8')
+        request = self.urllib_request.Request(self.url, data=body, method='POST',
+                                              headers={'Content-Type': 'application/json'})
+        with self.urllib_request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def close(self):
+        pass
+
+
+class LogChannel:
+    """Print messages, or append them to a file
+
+    Parameters
+    ----------
+    path : str or None
+        file to append the messages to, they are printed when None
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def send(self, subject, text):
+        line = '{} {}:{}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), subject, text)
+        if self.path is None:
+            print(line)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        pass
+
+
+def create_channels(names, email=None, email_pw=None, smtp_host='smtp.gmail.com', smtp_port=587,
+                    smtp_starttls=True, webhook_url=None, log_path=None):
+    """Create the notification channels of the config
+    Parameters
+    ----------
+    names : list
+        'smtp', 'webhook' and/or 'log'
+    Returns
+    -------
+    list
+        channel objects with send(subject, text) and close()
+    """
+    channels = []
+    for name in names:
+        if name == 'smtp':
+            channels.append(SMTPChannel(smtp_host, smtp_port, email, email_pw, starttls=smtp_starttls))
+        elif name == 'webhook':
+            channels.append(WebhookChannel(webhook_url))
+        elif name == 'log':
+            channels.append(LogChannel(log_path))
+        else:
+            raise ValueError('Unknown notification channel: ' + str(name))
+    return channels
+
+
+class NotificationDispatcher(threading.Thread):
+    """Thread sending the alerts in the background, coalesced and rate limited
+
+    Parameters
+    ----------
+    channels : list
+        channel objects, see create_channels
+    cooldown : float
+        minimum number of seconds between two alerts of the same room and gas
+    coalesce : float
+        number of seconds to collect alerts after the first one, before sending a message
+    queue_size : int
+        maximum number of pending alerts (rooms and gases), newer alerts are dropped when it is reached
+    subject : str
+        subject of the messages
+    """
+
+    def __init__(self, channels, cooldown, coalesce=5, queue_size=100, subject='Air Quality Alert'):
+        super().__init__(name='notifications', daemon=True)
+        self.channels = channels
+        self.cooldown = cooldown
+        self.coalesce = coalesce
+        self.queue_size = queue_size
+        self.subject = subject
+        self.lock = threading.Lock()
+        self.pending = {}  # text of the alert to send per (room, gas)
+        self.last_accepted = {}  # monotonic time of the last accepted alert per (room, gas)
+        self.alert_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def notify(self, device, gas, text):
+        """Add an alert to the next message without waiting
+        An alert of a room and gas that is already pending replaces its text.
+        Parameters
+        ----------
+        device : str
+            room of the alert
+        gas : str
+        text : str
+            line of the message
+        Returns
+        -------
+        bool
+            False when the alert is dropped
+        """
+        key = (device, gas)
+        now = time.monotonic()
+        with self.lock:
+            if key not in self.pending:
+                last = self.last_accepted.get(key)
+                if last is not None and now - last < self.cooldown:
+                    return False
+                if len(self.pending) >= self.queue_size:
+                    print('Too many pending alerts, dropping the alert for ' + gas + ' in ' + device)
+                    return False
+                # The cooldown starts now, the alerts that follow don't wait for the message to be sent
+                self.last_accepted[key] = now
+            self.pending[key] = text
+        self.alert_event.set()
+        return True
+
+    def pending_count(self):
+        """Number of alerts waiting to be sent"""
+        with self.lock:
+            return len(self.pending)
+
+    def _collect(self):
+        """Wait for an alert and take the alerts of the coalesce period, the latest one per room and gas"""
+        if not self.alert_event.wait(timeout=1):
+            return {}
+        self.stop_event.wait(self.coalesce)
+        return self._take()
+
+    def _take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.alert_event.clear()
+        return pending
+
+    def _send(self, pending):
+        text = ''.join('\n' + line for line in pending.values())
+        for channel in self.channels:
+            try:
+                channel.send(self.subject, text)
+            except Exception as e:
+                print('Something went wrong while sending a notification with {}: {}'.format(
+                    type(channel).__name__, e))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            pending = self._collect()
+            if pending:
+                self._send(pending)
+        # Send the alerts that are still pending
+        pending = self._take()
+        if pending:
+            self._send(pending)
+        for channel in self.channels:
+            channel.close()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.join(timeout)
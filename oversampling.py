@@ -0,0 +1,165 @@
+# ------------------------------------------------------------------
+#              High-rate oversampling of the MQ sensors
+# ------------------------------------------------------------------
+# A background thread reads all analog pins in a tight loop, at up to
+# hundreds of readings per second, into a preallocated NumPy ring
+# buffer. When a sample is taken, the readings in the window are
+# filtered in one vectorized pass per pin, with a median, trimmed
+# mean, mean or exponential moving average. The filtered value is
+# available immediately, so sampling adds no latency, and no memory
+# is allocated per reading.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+
+import numpy as np
+
+
+def median_filter(readings, ages, trim=0.1, alpha=0.1):
+    return np.median(readings, axis=0)
+
+
+def mean_filter(readings, ages, trim=0.1, alpha=0.1):
+    return readings.mean(axis=0)
+
+
+def trimmed_mean_filter(readings, ages, trim=0.1, alpha=0.1):
+    """Mean of every column without the lowest and highest fraction trim of the readings"""
+    nb_cut = int(len(readings) * trim)
+    ordered = np.sort(readings, axis=0)
+    return ordered[nb_cut:len(readings) - nb_cut].mean(axis=0)
+
+
+def ema_filter(readings, ages, trim=0.1, alpha=0.1):
+    """Exponential moving average of every column, ages[i] is 0 for the newest reading"""
+    weights = (1 - alpha) ** ages
+    return weights @ readings / weights.sum()
+
+
+FILTERS = {
+    'median': median_filter,
+    'mean': mean_filter,
+    'trimmed_mean': trimmed_mean_filter,
+    'ema': ema_filter
+}
+
+
+class RingBuffer:
+    """Preallocated buffer with the last window readings of every pin
+
+    Parameters
+    ----------
+    window : int
+        number of readings kept per pin
+    nb_pins : int
+    """
+
+    def __init__(self, window, nb_pins):
+        self.data = np.zeros((window, nb_pins))
+        self.window = window
+        self.position = 0
+        self.count = 0
+
+    def append(self, row):
+        self.data[self.position] = row
+        self.position = (self.position + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+
+    def ages(self):
+        """Age of the reading in every row of data, 0 for the newest"""
+        return (self.position - 1 - np.arange(self.window)) % self.window
+
+
+class OversamplingReader(threading.Thread):
+    """Thread reading the analog pins at a high rate
+
+    Parameters
+    ----------
+    adc : analog backend
+        see sensors.py
+    pins : list
+        analog pins
+    window : int
+        number of readings per pin the filter is applied on
+    method : str
+        key of FILTERS
+    rate : float or None
+        number of readings of every pin per second, None to read as fast as possible
+    trim : float
+        fraction of the lowest and highest readings left out by the trimmed mean
+    alpha : float
+        smoothing factor of the exponential moving average
+    """
+
+    def __init__(self, adc, pins, window=256, method='median', rate=200, trim=0.1, alpha=0.1):
+        super().__init__(name='oversampling', daemon=True)
+        if method not in FILTERS:
+            raise ValueError('Unknown filter: {}'.format(method))
+        self.adc = adc
+        self.pins = list(pins)
+        self.filter = FILTERS[method]
+        self.interval = 1 / rate if rate else 0
+        self.trim = trim
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.ready = threading.Event()
+        self.buffer = RingBuffer(window, len(self.pins))
+        self.row = np.zeros(len(self.pins))
+        self.snapshot = np.zeros((window, len(self.pins)))
+        self.nb_read = 0
+        self.nb_errors = 0
+
+    def run(self):
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                for idx, pin in enumerate(self.pins):
+                    self.row[idx] = self.adc.read_analog(pin)
+            except IOError:
+                self.nb_errors += 1
+            else:
+                with self.lock:
+                    self.buffer.append(self.row)
+                self.nb_read += 1
+                self.ready.set()
+
+            if self.interval:
+                # Drift-free pacing, readings that fall behind are not caught up
+                next_time = max(next_time + self.interval, time.monotonic())
+                self.stop_event.wait(next_time - time.monotonic())
+
+    def filtered(self, timeout=None):
+        """Filtered value of every pin over the readings in the window
+        Parameters
+        ----------
+        timeout : float or None
+            maximum number of seconds to wait for the first reading
+        Returns
+        -------
+        numpy array
+            filtered reading per pin, in the order of pins
+        """
+        if not self.ready.wait(timeout):
+            raise IOError('No analog readings within {} seconds'.format(timeout))
+        with self.lock:
+            count = self.buffer.count
+            np.copyto(self.snapshot, self.buffer.data)
+            ages = self.buffer.ages()
+        if count < self.buffer.window:
+            # Rows that aren't filled yet have an age of count or more
+            valid = ages < count
+            return self.filter(self.snapshot[valid], ages[valid], trim=self.trim, alpha=self.alpha)
+        return self.filter(self.snapshot, ages, trim=self.trim, alpha=self.alpha)
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.join(timeout)
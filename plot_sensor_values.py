@@ -14,158 +14,332 @@
 # ------------------------------------------------------------------
 import config as cfg
 from pathlib import Path
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
+import os
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
 
-# Initialize Firebase app with credentials
+from archive import SampleArchive, to_datetimes
+from downsampling import downsample
+from rollups import rollup_collection
+from loader import CachedLoader, TTLCache
+from compensation import CompensationTable
+from derivation import Deriver
+from encoding import SchemaRegistry
+from sample_feed import SampleFeed
+from storage import create_storage
+from metrics import registry, start_instrumentation, CONTENT_TYPE
+
+
+# Firebase credentials
 if str(Path.cwd()).startswith('/home'):
     firebase_path = Path.cwd() / 'air_quality_monitoring' / cfg.FIREBASE_CREDS_JSON
 else:
     firebase_path = Path.cwd() / cfg.FIREBASE_CREDS_JSON
-cred = credentials.Certificate(str(firebase_path))
-firebase_admin.initialize_app(cred)
-
-# Create Firestore object
-db = firestore.client()
 
-# Read data from Firebase
-# Order by date and select last 30 results
+# Firestore, or a local stand-in chosen with STORAGE_BACKEND
+storage = create_storage(cfg.STORAGE_BACKEND, firebase_path=firebase_path, sqlite_path=cfg.STORAGE_SQLITE_PATH)
 
-# Initializing lists/dicts to contain the data
-timestamps = []
-temperatures = []
-humidities = []
-pressures = []
-ppm_values = {}
-for mq_sensor in cfg.MQ_SENSORS.keys():
-    ppm_values[mq_sensor] = {}
-
-for mq_sensor in cfg.MQ_SENSORS.keys():
-    for gas in cfg.CURVES[mq_sensor].keys():
-        ppm_values[mq_sensor][gas] = []
-
-docs = db.collection(cfg.FIREBASE_DB_NAME).order_by('date', direction=firestore.Query.DESCENDING).limit(30).get()
-print(docs)
-for doc in docs:
-    data = doc.to_dict()
-
-    # Extract hour, minutes and seconds
-    timestamps.append(data['date'].strftime('%H:%M:%S'))
-
-    # Extract temperatures, humidities and pressures
-    temperatures.append(data['temperature'])
-    humidities.append(data['humidity'])
-    pressures.append(data['pressure'])
-
-    # Extract the gas concentration values per sensor
-    for mq_sensor in cfg.MQ_SENSORS.keys():
-        for gas in cfg.CURVES[mq_sensor].keys():
-            sensor_gas_key = mq_sensor + '_' + gas + '_ppm'
-            ppm_values[mq_sensor][gas].append(data[sensor_gas_key])
-
-# Reverse ordering of the data as we extracted the last entries in the collection in Firestore
-timestamps.reverse()
-temperatures.reverse()
-humidities.reverse()
-pressures.reverse()
-
-# Creating graphs list with data of bme680 sensor
-graphs = [
-    dcc.Graph(
-        id='temperature',
-        figure={
-            'data':[{
-                'x':timestamps,
-                'y':temperatures,
-                'type':'line',
-                'name': 'Temperature',
-                'line': {'width':2, 'color': '#542788'}
-                }],
-            'layout':{
-                'title': 'Temperature',
-                'yaxis': {'title': 'Celsius'},
-                'xaxis': {'title': 'Timestamp', 'tickvals':timestamps}
-            }
-        }
-    ),
-    dcc.Graph(
-        id='humidity',
-        figure={
-            'data':[{
-                'x':timestamps,
-                'y':humidities,
-                'type':'line',
-                'name': 'Humidity',
-                'line': {'width':2, 'color': '#542788'}
-                }],
-            'layout':{
-                'title': 'Humidity',
-                'yaxis': {'title': '%'},
-                'xaxis': {'title': 'Timestamp', 'tickvals':timestamps}
-            }
-        }
-    ),
-    dcc.Graph(
-        id='pressure',
-        figure={
-            'data':[{
-                'x':timestamps,
-                'y':pressures,
-                'type':'line',
-                'name': 'Pressure',
-                'line': {'width':2, 'color': '#542788'}
-                }],
-            'layout':{
-                'title': 'Pressure',
-                'yaxis': {'title': 'hPa'},
-                'xaxis': {'title': 'Timestamp', 'tickvals':timestamps}
-            }
-        }
-    )
+# Metrics to plot with their field name, title, unit and line color
+metrics = [
+    ('temperature', 'Temperature', cfg.UNITS['temperature'], '#542788'),
+    ('humidity', 'Humidity', cfg.UNITS['humidity'], '#542788'),
+    ('pressure', 'Pressure', cfg.UNITS['pressure'], '#542788')
 ]
-
-# Appending data of MQ sensors to graphs
 for mq_sensor in cfg.MQ_SENSORS.keys():
     for gas in cfg.CURVES[mq_sensor].keys():
         sensor_gas_key = mq_sensor + '_' + gas + '_ppm'
         title = gas + ' concentration on '+ mq_sensor + ' sensor'
-        data = ppm_values[mq_sensor][gas]
-        data.reverse()
-
-        graphs.append(dcc.Graph(
-            id=sensor_gas_key,
-            figure={
-                'data': [{
-                    'x': timestamps,
-                    'y': data,
-                    'type':'line',
-                    'name': title,
-                    'line': {'width':2}
-                }],
-                'layout': {
-                    'title': title,
-                    'yaxis': {'title': 'ppm'},
-                    'xaxis': {'title': 'Timestamp', 'tickvals':timestamps}
-                }
-            }
-        ))
+        metrics.append((sensor_gas_key, title, 'ppm', None))
+
+# Read data from the storage backend
+# The feed keeps the last DASHBOARD_BUFFER_SIZE samples of every room in memory
+# and only fetches the new documents on every refresh, with one query for all rooms
+# and all viewers (see refresh)
+# Compact samples are decoded with the schema of their device, and samples stored
+# as raw readings get their ppm values with the calibration of their device
+schemas = SchemaRegistry(storage, cfg.FIREBASE_DB_NAME)
+compensation = CompensationTable(cfg.COMPENSATION, list(cfg.MQ_SENSORS.keys())) if cfg.COMPENSATION else None
+deriver = Deriver(storage, cfg.FIREBASE_DB_NAME, cfg.MQ_SENSORS, cfg.CURVES, compensation)
+
+feed = SampleFeed(storage, cfg.FIREBASE_DB_NAME,
+                  fields=[field for field, _, _, _ in metrics],
+                  maxlen=cfg.DASHBOARD_BUFFER_SIZE * len(cfg.DEVICES),
+                  min_poll_interval=cfg.DASHBOARD_REFRESH_INTERVAL/2,
+                  default_device=cfg.DEVICE_ID,
+                  derive=lambda sample: deriver.derive_sample(schemas.expand(sample)))
+
+# Longer time ranges are loaded through a cache shared by all viewers
+loader = CachedLoader(storage, cfg.LOADER_CACHE_SIZE, cfg.LOADER_CACHE_TTL, schemas=schemas)
+
+# Local archive, only available when the dashboard runs on the Raspberry Pi
+archive = SampleArchive(cfg.DASHBOARD_ARCHIVE_PATH, feed.fields) if cfg.DASHBOARD_ARCHIVE_PATH else None
+
+# Time ranges that can be selected on the dashboard
+TIME_RANGES = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+    'month': timedelta(days=30)
+}
+
+# Time ranges of which the graphs are extended with the new samples of the feed,
+# the graphs of the longer ranges show rollups and are redrawn instead
+FEED_RANGES = ['hour', 'day']
+
+# Points left free in the graphs of these ranges for the new samples, the graphs
+# are redrawn once they are used up, so a graph never has more than DASHBOARD_MAX_POINTS
+FEED_HEADROOM = cfg.DASHBOARD_MAX_POINTS // 10
+
+def get_range_data(time_range, device):
+    """Get the downsampled data of all metrics of a room for a time range
+    The data comes from the local archive when the dashboard runs on the
+    Raspberry Pi. Otherwise it comes from the feed when it covers the time
+    range, or from the rollups on Firebase.
+    Parameters
+    ----------
+    time_range : str
+        key of TIME_RANGES
+    device : str
+        room of which the data is shown
+    Returns
+    -------
+    (series, last_date)
+        dict with a (timestamps, values) tuple per field and the date of
+        the last sample
+    """
+    if feed.last_date is None:
+        return {field: ([], []) for field, _, _, _ in metrics}, None
+
+    start = feed.last_date - TIME_RANGES[time_range]
+    if archive is not None and device == cfg.DEVICE_ID:
+        # Dates in the archive are the local time of the Raspberry Pi
+        archive_timestamps, values = archive.range(datetime.now() - TIME_RANGES[time_range])
+        timestamps = to_datetimes(archive_timestamps)
+    elif start >= feed.oldest_date():
+        timestamps, values = feed.since(start, device)
+    else:
+        # Longer time ranges are read from the rollups, using the mean of every period
+        resolution = cfg.DASHBOARD_RANGE_ROLLUPS[time_range]
+        timestamps, rollup_values = loader.load(rollup_collection(cfg.FIREBASE_DB_NAME, resolution),
+                                                [field + '_mean' for field in feed.fields], start,
+                                                device=device)
+        values = {field: rollup_values[field + '_mean'] for field in feed.fields}
+
+    # Every series is reduced to a fixed number of points before sending it to the browser
+    max_points = cfg.DASHBOARD_MAX_POINTS - (FEED_HEADROOM if time_range in FEED_RANGES else 0)
+    series = {field: downsample(timestamps, values[field], max_points,
+                                cfg.DASHBOARD_DOWNSAMPLING)
+              for field, _, _, _ in metrics}
+    return series, timestamps[-1] if len(timestamps) > 0 else feed.last_date
+
+def build_figure(title, unit, color, timestamps, values):
+    """Create the figure of one metric
+    Parameters
+    ----------
+    title : str
+    unit : str
+    color : str or None
+    timestamps : list with timestamps of the sensor values
+    values : list with the sensor values
+    Returns
+    -------
+    dict
+    """
+    line = {'width': 2}
+    if color is not None:
+        line['color'] = color
+
+    return {
+        'data': [{
+            'x': timestamps,
+            'y': values,
+            'type': 'line',
+            'name': title,
+            'line': line
+        }],
+        'layout': {
+            'title': title,
+            'yaxis': {'title': unit},
+            'xaxis': {'title': 'Timestamp'}
+        }
+    }
+
+def build_figures(series):
+    """Create the figures of all metrics with the series of get_range_data"""
+    return [build_figure(title, unit, color, *series[field])
+            for field, title, unit, color in metrics]
+
+def nb_points(figures):
+    """Largest number of points of the graphs"""
+    return max((len(figure['data'][0]['x']) for figure in figures), default=0)
+
+# Figures per time range and room, shared by all viewers of this process
+figure_cache = TTLCache(maxsize=len(TIME_RANGES) * len(cfg.DEVICES), ttl=cfg.DASHBOARD_REFRESH_INTERVAL)
+figure_lock = threading.Lock()
+
+# Durations of the dashboard stages
+figures_timer = registry.timer('figures')
+poll_timer = registry.timer('feed_poll')
+refresh_timer = registry.timer('refresh')
+loader.load = registry.timed('range_load', loader.load)
+
+def get_figures(time_range, device):
+    """Get the figures of all metrics of a room for a time range
+    Viewers asking for the same figures share one computation per refresh interval.
+    Returns
+    -------
+    (figures, last_date)
+    """
+    key = (time_range, device)
+    result = figure_cache.get(key)
+    if result is None:
+        with figure_lock:
+            # Another viewer may have computed the figures in the meantime
+            result = figure_cache.get(key)
+            if result is None:
+                with figures_timer.time():
+                    series, last_date = get_range_data(time_range, device)
+                    result = (build_figures(series), last_date)
+                figure_cache.put(key, result)
+    return result
+
+def refresh():
+    """Fetch the new samples and precompute the figures of the default time range of every room"""
+    try:
+        with poll_timer.time():
+            feed.poll()
+    except Exception as e:
+        print('Refreshing the dashboard data failed: {}'.format(e))
+        return
+    with refresh_timer.time():
+        for device in cfg.DEVICES:
+            series, last_date = get_range_data(cfg.DASHBOARD_DEFAULT_RANGE, device)
+            figure_cache.put((cfg.DASHBOARD_DEFAULT_RANGE, device), (build_figures(series), last_date))
+
+def refresh_loop():
+    while True:
+        time.sleep(cfg.DASHBOARD_REFRESH_INTERVAL)
+        refresh()
+
+# One refresher per process queries the storage backend, the callbacks only read from memory
+refresher_pid = None
+refresher_lock = threading.Lock()
+
+def ensure_refresher():
+    """Start the refresher of this process, once per worker of a WSGI server"""
+    global refresher_pid
+    with refresher_lock:
+        # Threads don't survive the fork of a worker process, so the process ID is checked
+        if refresher_pid == os.getpid():
+            return
+        refresher_pid = os.getpid()
+        refresh()
+        threading.Thread(target=refresh_loop, name='dashboard-refresher', daemon=True).start()
+        start_instrumentation(profile_path=cfg.PROFILE_PATH.format('dashboard_' + str(refresher_pid))
+                              if cfg.PROFILE_PATH else None, profile_interval=cfg.PROFILE_INTERVAL)
+
+def serve_layout():
+    """Build the layout with the latest data, every page load gets the latest data"""
+    ensure_refresher()
+    figures, last_date = get_figures(cfg.DASHBOARD_DEFAULT_RANGE, cfg.DEVICES[0])
+
+    graphs = [dcc.Graph(id=field, figure=figure)
+              for (field, _, _, _), figure in zip(metrics, figures)]
+
+    return html.Div([
+        html.H1(style={'textAlign':'center'}, children='Indoor Air Quality Dashboard'),
+        html.Div(id='container'),
+        dcc.Dropdown(
+            id='device',
+            options=[{'label': device, 'value': device} for device in cfg.DEVICES],
+            value=cfg.DEVICES[0],
+            clearable=False
+        ),
+        dcc.RadioItems(
+            id='time-range',
+            options=[{'label': time_range.capitalize(), 'value': time_range}
+                     for time_range in TIME_RANGES.keys()],
+            value=cfg.DASHBOARD_DEFAULT_RANGE,
+            labelStyle={'display': 'inline-block'}
+        ),
+        dcc.Interval(id='refresh', interval=cfg.DASHBOARD_REFRESH_INTERVAL * 1000),
+        dcc.Store(id='last-date', data=last_date.isoformat() if last_date else None),
+        dcc.Store(id='nb-points', data=nb_points(figures)),
+        html.Div(graphs)
+    ])
 
 # Preparing the Dash app
 # CSS is automatically loaded from the assets folder
 app = dash.Dash(__name__)
 app.title = 'Indoor Air Quality Dashboard'
+app.layout = serve_layout
+
+# WSGI application, e.g. for several workers: gunicorn -w 4 plot_sensor_values:server
+# Every worker has its own refresher and caches
+server = app.server
+
+@server.route('/metrics')
+def serve_metrics():
+    """Metrics of this worker in the Prometheus text format"""
+    return registry.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+@app.callback(
+    [Output(field, 'figure') for field, _, _, _ in metrics]
+    + [Output(field, 'extendData') for field, _, _, _ in metrics]
+    + [Output('last-date', 'data'), Output('nb-points', 'data')],
+    [Input('refresh', 'n_intervals'), Input('time-range', 'value'), Input('device', 'value')],
+    [State('last-date', 'data'), State('nb-points', 'data')]
+)
+def update_graphs(n_intervals, time_range, device, last_date, points):
+    """Redraw the graphs when another time range or room is selected, otherwise
+    append the samples the browser hasn't seen yet to every graph of a short
+    time range, or redraw the graphs of a long time range with new data"""
+    ensure_refresher()
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    no_updates = [dash.no_update] * len(metrics)
+
+    if 'time-range.value' in triggered or 'device.value' in triggered:
+        figures, new_last_date = get_figures(time_range, device)
+        return (figures + no_updates
+                + [new_last_date.isoformat() if new_last_date else None, nb_points(figures)])
+
+    if time_range not in FEED_RANGES:
+        # Raw samples aren't mixed into the rollups, the refreshed figures are sent when there is new data
+        figures, new_last_date = get_figures(time_range, device)
+        if new_last_date is None or (last_date and new_last_date <= datetime.fromisoformat(last_date)):
+            raise PreventUpdate
+        return figures + no_updates + [new_last_date.isoformat(), nb_points(figures)]
+
+    # The refresher fetched the new samples, only those the browser hasn't seen are sent
+    since = datetime.fromisoformat(last_date) if last_date else None
+    timestamps, values = feed.since(since, device)
+    if not timestamps:
+        raise PreventUpdate
+
+    points = points or 0
+    if points + len(timestamps) > cfg.DASHBOARD_MAX_POINTS:
+        # The headroom is used up, the graphs are redrawn with downsampled data
+        figures, new_last_date = get_figures(time_range, device)
+        if new_last_date is not None and (since is None or new_last_date > since):
+            return figures + no_updates + [new_last_date.isoformat(), nb_points(figures)]
+        # The cached figures are older than the graphs, only the newest samples are kept
+        timestamps = timestamps[-FEED_HEADROOM:]
+        values = {field: column[-FEED_HEADROOM:] for field, column in values.items()}
 
-app.layout = html.Div([
-    html.H1(style={'textAlign':'center'}, children='Indoor Air Quality Dashboard'),
-    html.Div(id='container'),
-    html.Div(graphs)
-])
+    # The graphs never have more than DASHBOARD_MAX_POINTS points, the oldest are dropped
+    extensions = [({'x': [timestamps], 'y': [values[field]]}, [0], cfg.DASHBOARD_MAX_POINTS)
+                  for field, _, _, _ in metrics]
+    return (no_updates + extensions
+            + [timestamps[-1].isoformat(), min(points + len(timestamps), cfg.DASHBOARD_MAX_POINTS)])
 
 if __name__ == '__main__':
-    app.run_server()
\ No newline at end of file
+    app.run_server()
@@ -0,0 +1,144 @@
+# ------------------------------------------------------------------
+#                  Rollups of the sensor data
+# ------------------------------------------------------------------
+# Aggregates the samples per minute, hour and day while they are
+# ingested. For every metric, the count, minimum, maximum, mean and
+# last value of the period are kept. When a period is complete, its
+# rollup is stored as one document in a separate collection per
+# resolution (e.g. <FIREBASE_DB_NAME>_hour).
+#
+# Dashboards and alert checks can then read a few hundred rollup
+# documents for long time ranges instead of every single sample.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+from datetime import timedelta
+
+import numpy as np
+
+RESOLUTIONS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+
+STATISTICS = ['min', 'max', 'mean', 'last']
+
+
+def rollup_collection(collection_name, resolution):
+    """Name of the collection with the rollups of a resolution"""
+    return collection_name + '_' + resolution
+
+
+def bucket_start(date, resolution):
+    """Start of the period a date belongs to
+    Parameters
+    ----------
+    date : datetime
+    resolution : str
+        key of RESOLUTIONS
+    Returns
+    -------
+    datetime
+    """
+    midnight = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return date - (date - midnight) % RESOLUTIONS[resolution]
+
+
+class RollupBucket:
+    """Running count, min, max, sum and last value of all metrics in one period"""
+
+    def __init__(self, start, nb_fields):
+        self.start = start
+        self.count = 0
+        self.counts = np.zeros(nb_fields)
+        self.sums = np.zeros(nb_fields)
+        self.mins = np.full(nb_fields, np.nan)
+        self.maxs = np.full(nb_fields, np.nan)
+        self.lasts = np.full(nb_fields, np.nan)
+
+    def add(self, values):
+        """Add the values of one sample, missing values are NaN"""
+        valid = np.isfinite(values)
+        self.count += 1
+        self.counts += valid
+        self.sums += np.where(valid, values, 0)
+        # fmin and fmax ignore NaN
+        self.mins = np.fmin(self.mins, values)
+        self.maxs = np.fmax(self.maxs, values)
+        self.lasts = np.where(valid, values, self.lasts)
+
+    def to_dict(self, fields):
+        """Rollup document with the statistics of every metric"""
+        with np.errstate(invalid='ignore'):
+            means = self.sums / self.counts
+        doc = {'date': self.start, 'count': self.count}
+        for stat, values in zip(STATISTICS, [self.mins, self.maxs, means, self.lasts]):
+            for field, value in zip(fields, values.tolist()):
+                doc[field + '_' + stat] = None if np.isnan(value) else value
+        return doc
+
+
+class RollupAggregator:
+    """Maintain rollups of a stream of samples at several resolutions
+
+    Parameters
+    ----------
+    fields : list
+        names of the metrics to aggregate
+    resolutions : list
+        keys of RESOLUTIONS
+    """
+
+    def __init__(self, fields, resolutions=None):
+        self.fields = list(fields)
+        self.resolutions = list(RESOLUTIONS.keys()) if resolutions is None else list(resolutions)
+        self.buckets = {}
+
+    def add(self, sample):
+        """Add a sample to the rollups
+        Parameters
+        ----------
+        sample : dict
+            sensor values with a 'date' key
+        Returns
+        -------
+        list
+            list of (resolution, rollup document) tuples of the periods
+            that were completed by this sample
+        """
+        values = np.array([sample.get(field) for field in self.fields], dtype=float)
+        completed = []
+        for resolution in self.resolutions:
+            start = bucket_start(sample['date'], resolution)
+            bucket = self.buckets.get(resolution)
+            if bucket is not None and bucket.start != start:
+                completed.append((resolution, bucket.to_dict(self.fields)))
+                bucket = None
+            if bucket is None:
+                bucket = RollupBucket(start, len(self.fields))
+                self.buckets[resolution] = bucket
+            bucket.add(values)
+        return completed
+
+    def current(self):
+        """Rollup documents of the periods that aren't complete yet
+        Returns
+        -------
+        list
+            list of (resolution, rollup document) tuples
+        """
+        return [(resolution, bucket.to_dict(self.fields))
+                for resolution, bucket in self.buckets.items()]
+
+
+def rollup_doc_id(resolution, start, device=None):
+    """Document ID of a rollup, the same period of a device always gets the same ID"""
+    doc_id = resolution + '_' + start.strftime('%Y%m%d%H%M')
+    return doc_id if device is None else device + '_' + doc_id
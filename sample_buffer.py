@@ -0,0 +1,303 @@
+# ------------------------------------------------------------------
+#                 Local write-ahead buffer for samples
+# ------------------------------------------------------------------
+# Every sample is first appended to a local SQLite database on the
+# Raspberry Pi. A background flusher sends the pending samples to
+# Cloud Firestore in batched writes and marks them as acknowledged
+# once the batch is committed. When the network is down, the samples
+# stay in the buffer and the flusher retries with exponential backoff.
+# No samples are lost during a Wi-Fi outage or a restart.
+#
+# Every sample gets a document ID when it is appended. Re-sending a
+# batch after a crash therefore overwrites the same documents instead
+# of creating duplicates.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import base64
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from datetime import timedelta
+
+FIRESTORE_MAX_BATCH_SIZE = 500  # maximum number of writes in one Firestore batch
+
+
+# Bytes values, e.g. the packed values of compact samples, are stored as {BYTES_KEY: base64 string}
+BYTES_KEY = '$bytes'
+
+
+def to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return {BYTES_KEY: base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def encode_sample(sample):
+    """Serialize a sample dict to JSON, dates are stored in ISO format"""
+    return json.dumps({k: to_json_value(v) for k, v in sample.items()})
+
+
+def parse_sample(sample):
+    """Convert the ISO formatted date and the bytes values of a deserialized sample"""
+    sample['date'] = datetime.fromisoformat(sample['date'])
+    for key, value in sample.items():
+        if isinstance(value, dict) and BYTES_KEY in value:
+            sample[key] = base64.b64decode(value[BYTES_KEY])
+    return sample
+
+
+def decode_sample(payload):
+    """Deserialize a sample stored with encode_sample"""
+    return parse_sample(json.loads(payload))
+
+
+class SampleBuffer:
+    """Durable append log of samples in a SQLite database
+
+    Parameters
+    ----------
+    path : str or Path
+        location of the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS samples (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    doc_id TEXT NOT NULL,
+                    collection TEXT,
+                    date TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    acked INTEGER NOT NULL DEFAULT 0
+                )''')
+            # Buffers created before samples could target another collection
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(samples)')]
+            if 'collection' not in columns:
+                self.conn.execute('ALTER TABLE samples ADD COLUMN collection TEXT')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_samples_acked ON samples (acked, id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_samples_date ON samples (date)')
+
+    def append(self, sample, collection=None, doc_id=None):
+        """Append a sample to the buffer
+        Parameters
+        ----------
+        sample : dict
+            sensor values with a 'date' key
+        collection : str or None
+            collection to store the sample in, None for the default collection
+        doc_id : str or None
+            document ID, a random ID is generated when None
+        Returns
+        -------
+        doc_id
+            str, document ID the sample will be stored under
+        """
+        if doc_id is None:
+            doc_id = uuid.uuid4().hex
+        with self.lock, self.conn:
+            self.conn.execute('INSERT INTO samples (doc_id, collection, date, payload) VALUES (?, ?, ?, ?)',
+                              (doc_id, collection, sample['date'].isoformat(), encode_sample(sample)))
+        return doc_id
+
+    def append_many(self, rows):
+        """Append several samples in one transaction
+        Parameters
+        ----------
+        rows : list
+            list of (collection, document ID, sample dict) tuples
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO samples (doc_id, collection, date, payload) VALUES (?, ?, ?, ?)',
+                [(doc_id or uuid.uuid4().hex, collection, sample['date'].isoformat(), encode_sample(sample))
+                 for collection, doc_id, sample in rows])
+
+    def pending(self, limit=FIRESTORE_MAX_BATCH_SIZE):
+        """Get the oldest samples that weren't acknowledged yet
+        Parameters
+        ----------
+        limit : int
+            maximum number of samples to return
+        Returns
+        -------
+        list
+            list of (row id, collection, document ID, sample dict) tuples
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, collection, doc_id, payload FROM samples WHERE acked = 0 ORDER BY id LIMIT ?',
+                (limit,)).fetchall()
+        return [(row_id, collection, doc_id, decode_sample(payload))
+                for row_id, collection, doc_id, payload in rows]
+
+    def samples_since(self, date):
+        """Get the samples of the default collection from a date onwards
+        Parameters
+        ----------
+        date : datetime
+        Returns
+        -------
+        list
+            list of sample dicts ordered by date
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT payload FROM samples WHERE collection IS NULL AND date >= ? ORDER BY date',
+                (date.isoformat(),)).fetchall()
+        return [decode_sample(payload) for payload, in rows]
+
+    def nb_pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM samples WHERE acked = 0').fetchone()[0]
+
+    def ack(self, row_ids):
+        """Mark samples as stored remotely"""
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE samples SET acked = 1 WHERE id = ?',
+                                  [(row_id,) for row_id in row_ids])
+
+    def purge(self, retention):
+        """Delete acknowledged samples older than the retention period
+        Parameters
+        ----------
+        retention : timedelta
+        """
+        cutoff = (datetime.now() - retention).isoformat()
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM samples WHERE acked = 1 AND date < ?', (cutoff,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def storage_batch_writer(storage, collection_name):
+    """Create a function storing samples in one batched write of a storage backend
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+        default collection, used for samples without a collection
+    Returns
+    -------
+    callable
+        function taking a list of (collection, document ID, sample dict) tuples
+    """
+    def write_batch(docs):
+        storage.append([(collection or collection_name, doc_id, sample) for collection, doc_id, sample in docs])
+
+    return write_batch
+
+
+def deferred_batch_writer(create_writer):
+    """Create a function building the real writer at the first batch
+    The client of the remote storage is then built by the flusher thread, after
+    the first samples are taken. When building it fails, the batch fails and the
+    client is built again at the next flush.
+    Parameters
+    ----------
+    create_writer : callable
+        function without arguments returning a write_batch function
+    Returns
+    -------
+    callable
+        function taking a list of (collection, document ID, sample dict) tuples
+    """
+    writer = None
+
+    def write_batch(docs):
+        nonlocal writer
+        if writer is None:
+            writer = create_writer()
+        writer(docs)
+
+    return write_batch
+
+
+class BufferFlusher(threading.Thread):
+    """Background thread sending the pending samples of a SampleBuffer
+
+    Parameters
+    ----------
+    sample_buffer : SampleBuffer
+    write_batch : callable
+        function storing a list of (collection, document ID, sample dict) tuples remotely,
+        raising an exception when the write failed
+    interval : float
+        number of seconds between two flushes
+    batch_size : int
+        maximum number of samples per write
+    max_backoff : float
+        maximum number of seconds to wait before retrying a failed write
+    retention : timedelta
+        how long acknowledged samples are kept in the buffer
+    """
+
+    def __init__(self, sample_buffer, write_batch, interval=60, batch_size=FIRESTORE_MAX_BATCH_SIZE,
+                 max_backoff=600, retention=timedelta(days=7)):
+        super().__init__(name='flusher', daemon=True)
+        self.sample_buffer = sample_buffer
+        self.write_batch = write_batch
+        self.interval = interval
+        self.batch_size = min(batch_size, FIRESTORE_MAX_BATCH_SIZE)
+        self.max_backoff = max_backoff
+        self.retention = retention
+        self.stop_event = threading.Event()
+        self.nb_sent = 0
+        self.nb_failures = 0
+
+    def flush(self):
+        """Send all pending samples in batches
+        Returns
+        -------
+        bool
+            True when the buffer was emptied, False when a write failed
+        """
+        while True:
+            rows = self.sample_buffer.pending(self.batch_size)
+            if not rows:
+                return True
+            try:
+                self.write_batch([(collection, doc_id, sample) for _, collection, doc_id, sample in rows])
+            except Exception as e:
+                self.nb_failures += 1
+                print('Error sending data: {}'.format(e))
+                return False
+            self.sample_buffer.ack([row[0] for row in rows])
+            self.nb_sent += len(rows)
+            if len(rows) < self.batch_size:
+                return True
+
+    def run(self):
+        backoff = self.interval
+        while not self.stop_event.is_set():
+            if self.flush():
+                backoff = self.interval
+                self.sample_buffer.purge(self.retention)
+            else:
+                # Exponential backoff while the remote storage is unreachable
+                backoff = min(backoff * 2, self.max_backoff)
+            self.stop_event.wait(backoff)
+
+    def stop(self, timeout=None):
+        """Stop the thread after a last attempt to send the pending samples"""
+        self.stop_event.set()
+        self.join(timeout)
+        self.flush()
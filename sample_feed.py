@@ -0,0 +1,150 @@
+# ------------------------------------------------------------------
+#                   Incremental feed of sensor data
+# ------------------------------------------------------------------
+# Keeps the most recent samples of a collection in an in-memory ring
+# buffer. After the initial load, only the documents added since the
+# last poll are fetched from the storage backend, so a refresh
+# transfers a handful of documents instead of the whole window. The
+# samples of a room that arrive after the newer samples of another
+# room are inserted in chronological order (see NewSampleReader).
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from storage import LATE_SAMPLES, NewSampleReader
+
+
+class SampleFeed:
+    """Ring buffer with the latest samples of a collection
+
+    Parameters
+    ----------
+    storage : Storage
+        storage backend, see storage.py
+    collection_name : str
+    fields : list
+        names of the fields to keep, besides 'date'
+    maxlen : int
+        maximum number of samples kept in memory
+    min_poll_interval : float
+        minimum number of seconds between two queries on the storage backend
+    default_device : str or None
+        device of the samples stored before samples had a 'device' field
+    derive : callable or None
+        function applied on every new document, e.g. Deriver.derive_sample
+    overlap : timedelta
+        period before the newest date that is read again for the samples that arrive late
+    """
+
+    def __init__(self, storage, collection_name, fields, maxlen, min_poll_interval=0, default_device=None,
+                 derive=None, overlap=LATE_SAMPLES):
+        self.storage = storage
+        self.collection_name = collection_name
+        self.fields = list(fields)
+        self.maxlen = maxlen
+        self.min_poll_interval = min_poll_interval
+        self.default_device = default_device
+        self.derive = derive
+        self.overlap = overlap
+        self.reader = None
+        self.lock = threading.Lock()
+        self.last_poll = None
+        self.dates = deque(maxlen=maxlen)
+        self.devices = deque(maxlen=maxlen)
+        self.values = {field: deque(maxlen=maxlen) for field in self.fields}
+
+    @property
+    def last_date(self):
+        return self.dates[-1] if self.dates else None
+
+    def _append(self, data):
+        """Add a sample in chronological order, a late sample is inserted before the newer ones"""
+        date = data['date']
+        position = len(self.dates)
+        while position > 0 and self.dates[position - 1] > date:
+            position -= 1
+        if len(self.dates) == self.maxlen:
+            if position == 0:
+                # Older than all buffered samples
+                return
+            for column in [self.dates, self.devices] + list(self.values.values()):
+                column.popleft()
+            position -= 1
+        self.dates.insert(position, date)
+        self.devices.insert(position, data.get('device', self.default_device))
+        for field in self.fields:
+            self.values[field].insert(position, data.get(field))
+
+    def _load_latest(self):
+        """Fill the buffer with the latest maxlen documents"""
+        samples = self.storage.latest(self.collection_name, self.maxlen)
+        if samples:
+            # The new documents are read from the last loaded date onwards, the loaded ones are skipped
+            self.reader = NewSampleReader(self.storage, self.collection_name, samples[0]['date'], self.overlap)
+            self.reader.last_date = samples[-1]['date']
+            self.reader.read(skip=True)
+        return samples
+
+    def _load_newer(self):
+        """Get the documents that were added since the last poll"""
+        return self.reader.read()
+
+    def poll(self):
+        """Fetch the new documents and add them to the buffer
+        Returns
+        -------
+        nb_new
+            int, number of new samples
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.last_poll is not None and now - self.last_poll < self.min_poll_interval:
+                return 0
+            self.last_poll = now
+
+            new_data = self._load_latest() if self.reader is None else self._load_newer()
+            for data in new_data:
+                self._append(data if self.derive is None else self.derive(data))
+            return len(new_data)
+
+    def since(self, date=None, device=None):
+        """Get the buffered samples newer than a date
+        Parameters
+        ----------
+        date : datetime or None
+            last date already known by the caller, None to get all samples
+        device : str or None
+            only get the samples of this device, None for all devices
+        Returns
+        -------
+        (dates, values)
+            list of dates and dict with a list of values per field
+        """
+        with self.lock:
+            dates = list(self.dates)
+            start = 0
+            if date is not None:
+                start = len(dates)
+                while start > 0 and dates[start - 1] > date:
+                    start -= 1
+            values = {field: list(islice(self.values[field], start, None)) for field in self.fields}
+            dates = dates[start:]
+            if device is not None:
+                keep = [i for i, d in enumerate(islice(self.devices, start, None)) if d == device]
+                dates = [dates[i] for i in keep]
+                values = {field: [column[i] for i in keep] for field, column in values.items()}
+            return dates, values
+
+    def oldest_date(self):
+        with self.lock:
+            return self.dates[0] if self.dates else None
@@ -0,0 +1,232 @@
+# ------------------------------------------------------------------
+#                      Sampling scheduler
+# ------------------------------------------------------------------
+# Decouples reading the sensors from storing the readings.
+#
+# Every sensor (group) gets its own producer thread which calls a
+# read function at a fixed period on the monotonic clock. The next
+# tick is computed from the previous scheduled tick, not from the time
+# the read finished, so the sampling period doesn't drift. The
+# readings are put on a bounded queue. The consumer (e.g. the Firebase
+# uploader) drains the queue at its own pace. A slow upload can
+# therefore never stretch or skip a sample period. When the queue is
+# full, the oldest reading is dropped so the producers never block.
+#
+# The dates of the readings follow the monotonic clock, anchored on
+# the wall clock. The Pi has no real-time clock, so its wall clock is
+# set by NTP after the boot: when both clocks drift apart, the anchor
+# is moved to the current wall clock.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+
+
+def put_drop_oldest(sample_queue, item):
+    """Put an item on a bounded queue, dropping the oldest item when it is full
+    Parameters
+    ----------
+    sample_queue : queue.Queue
+    item : object
+    Returns
+    -------
+    nb_dropped
+        int, number of items that were dropped
+    """
+    nb_dropped = 0
+    while True:
+        try:
+            sample_queue.put_nowait(item)
+            return nb_dropped
+        except queue.Full:
+            try:
+                sample_queue.get_nowait()
+                nb_dropped += 1
+            except queue.Empty:
+                pass
+
+
+class Clock:
+    """Monotonic clock with a wall-clock anchor
+
+    Timestamps are derived from the monotonic clock, so the intervals between
+    the samples are regular. When the wall clock is set (e.g. NTP sync after
+    boot on the Pi) and drifts more than max_drift seconds from the anchored
+    monotonic clock, the anchor is moved to the new wall-clock time.
+
+    Parameters
+    ----------
+    max_drift : float
+        number of seconds the wall clock and the anchored monotonic clock may differ
+    """
+
+    def __init__(self, max_drift=2.0):
+        self.max_drift = max_drift
+        self.lock = threading.Lock()
+        self.start_monotonic = time.monotonic()
+        self.start_date = datetime.now()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def _check_drift(self):
+        now_monotonic, now_date = time.monotonic(), datetime.now()
+        drift = (now_date - self.start_date).total_seconds() - (now_monotonic - self.start_monotonic)
+        if abs(drift) > self.max_drift:
+            print('The wall clock moved {:.1f} seconds, the dates of the samples follow it'.format(drift))
+            self.start_monotonic, self.start_date = now_monotonic, now_date
+
+    def to_date(self, monotonic_time):
+        """Convert a monotonic timestamp into a datetime"""
+        with self.lock:
+            self._check_drift()
+            return self.start_date + timedelta(seconds=monotonic_time - self.start_monotonic)
+
+
+class PeriodicProducer(threading.Thread):
+    """Thread calling a read function at a fixed period
+
+    Parameters
+    ----------
+    source : str
+        name of the sensor (group), added to every reading
+    read_fn : callable
+        function without arguments returning a dict with the sensor values
+    interval : float
+        number of seconds between two readings
+    sample_queue : queue.Queue
+        bounded queue receiving the readings
+    clock : Clock
+    stop_event : threading.Event
+    """
+
+    def __init__(self, source, read_fn, interval, sample_queue, clock, stop_event):
+        super().__init__(name=source, daemon=True)
+        self.source = source
+        self.read_fn = read_fn
+        self.interval = interval
+        self.sample_queue = sample_queue
+        self.clock = clock
+        self.stop_event = stop_event
+        self.nb_read = 0
+        self.nb_skipped = 0
+        self.nb_dropped = 0
+
+    def run(self):
+        next_tick = self.clock.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                values = self.read_fn()
+            except Exception as e:
+                # One bad reading doesn't stop the producer
+                print('Error reading {} data: {!r}'.format(self.source, e))
+            else:
+                self.nb_read += 1
+                self.nb_dropped += put_drop_oldest(self.sample_queue, {
+                    'source': self.source,
+                    'tick': next_tick,
+                    'date': self.clock.to_date(next_tick),
+                    'values': values
+                })
+
+            # Schedule relative to the previous tick to avoid drift.
+            # If the read took longer than a period, skip to the next tick.
+            next_tick += self.interval
+            now = self.clock.monotonic()
+            if next_tick < now:
+                nb_missed = int((now - next_tick) // self.interval) + 1
+                self.nb_skipped += nb_missed
+                next_tick += nb_missed * self.interval
+            self.stop_event.wait(next_tick - now)
+
+
+class Sampler:
+    """Run independent producers for the MQ sensors and the BME680 sensor
+
+    The readings of both producers are merged into one document per MQ
+    reading, holding the latest available BME680 values.
+
+    Parameters
+    ----------
+    read_mq : callable
+        function returning a dict with the ppm values of all MQ sensors
+    read_bme680 : callable
+        function returning a dict with temperature, pressure and humidity
+    mq_interval : float
+        number of seconds between two MQ readings
+    bme680_interval : float
+        number of seconds between two BME680 readings
+    queue_size : int
+        maximum number of readings waiting to be consumed
+    """
+
+    def __init__(self, read_mq, read_bme680, mq_interval, bme680_interval, queue_size=1000):
+        self.sample_queue = queue.Queue(maxsize=queue_size)
+        self.clock = Clock()
+        self.stop_event = threading.Event()
+        self.producers = [
+            PeriodicProducer('bme680', read_bme680, bme680_interval,
+                             self.sample_queue, self.clock, self.stop_event),
+            PeriodicProducer('mq', read_mq, mq_interval,
+                             self.sample_queue, self.clock, self.stop_event)
+        ]
+
+    def start(self):
+        for producer in self.producers:
+            producer.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        for producer in self.producers:
+            producer.join(timeout)
+
+    def is_running(self):
+        return not self.stop_event.is_set()
+
+    def samples(self, timeout=1.0):
+        """Generator of merged sample documents
+        MQ readings arriving before the first BME680 reading are held back,
+        so that every document contains all fields. At most queue_size readings
+        are held back, the oldest ones are dropped.
+        Parameters
+        ----------
+        timeout : float
+            number of seconds to wait for a reading before checking whether
+            the sampler was stopped
+        Yields
+        ------
+        dict
+            sensor values of the MQ and BME680 sensors with a 'date' key
+        """
+        bme680_values = None
+        pending = deque(maxlen=self.sample_queue.maxsize or None)
+        while self.is_running() or not self.sample_queue.empty():
+            try:
+                reading = self.sample_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            if reading['source'] == 'bme680':
+                bme680_values = reading['values']
+            else:
+                pending.append(reading)
+
+            if bme680_values is None:
+                continue
+            for mq_reading in pending:
+                sample = dict(mq_reading['values'])
+                sample.update(bme680_values)
+                sample['date'] = mq_reading['date']
+                yield sample
+            pending.clear()
@@ -0,0 +1,221 @@
+# ------------------------------------------------------------------
+#                    Sensor backends
+# ------------------------------------------------------------------
+# Hardware abstraction for the analog MQ sensors and the BME680
+# sensor. The real backends use the GrovePi and BME680 libraries,
+# which are only imported when the backend is created. The simulated
+# backends produce deterministic synthetic readings, or replay a
+# recorded trace of analog readings. This allows to run, profile and
+# load-test the whole pipeline without a Raspberry Pi.
+#
+# Analog backends have the methods set_input(pin) and
+# read_analog(pin). BME680 backends have the method read(), which
+# returns a dict with temperature, pressure and humidity.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+
+import numpy as np
+
+
+class GrovePiADC:
+    """Analog readings of the GrovePi"""
+
+    def __init__(self):
+        import grovepi  # https://github.com/DexterInd/GrovePi/tree/master/Software/Python
+        self.grovepi = grovepi
+
+    def set_input(self, pin):
+        self.grovepi.pinMode(pin, "INPUT")
+
+    def read_analog(self, pin):
+        return self.grovepi.analogRead(pin)
+
+
+class BME680Sensor:
+    """Temperature, pressure and humidity of the BME680 sensor"""
+
+    def __init__(self):
+        import bme680  # https://github.com/pimoroni/bme680-python
+
+        # Set port for BME680 sensor
+        # Set sampling rates and filter for BME680 sensor
+        self.sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
+        self.sensor.set_humidity_oversample(bme680.OS_2X)
+        self.sensor.set_pressure_oversample(bme680.OS_4X)
+        self.sensor.set_temperature_oversample(bme680.OS_8X)
+        self.sensor.set_filter(bme680.FILTER_SIZE_3)
+
+    def read(self):
+        self.sensor.get_sensor_data()
+        return {
+            'temperature': self.sensor.data.temperature,
+            'pressure': self.sensor.data.pressure,
+            'humidity': self.sensor.data.humidity
+        }
+
+
+def synthetic_trace(nb_samples, pins, seed=0, ar_max=1023):
+    """Generate a deterministic trace of analog readings
+    Every pin has a baseline with a slow drift, noise and a few spikes
+    of gas concentration.
+    Parameters
+    ----------
+    nb_samples : int
+        number of readings per pin
+    pins : list
+        analog pins
+    seed : int
+        seed of the random generator, the same seed gives the same trace
+    ar_max : int
+        maximum output value of the analogRead method
+    Returns
+    -------
+    trace
+        numpy array with shape (nb_samples, max(pins) + 1)
+    """
+    rng = np.random.default_rng(seed)
+    trace = np.zeros((nb_samples, max(pins) + 1))
+    t = np.arange(nb_samples)
+    for pin in pins:
+        baseline = rng.uniform(100, 300)
+        drift = 20 * np.sin(2 * np.pi * t / max(nb_samples / 3, 1) + rng.uniform(0, 2 * np.pi))
+        noise = rng.normal(0, 3, nb_samples)
+        spikes = np.zeros(nb_samples)
+        for start in rng.integers(0, nb_samples, size=max(nb_samples // 5000, 1)):
+            length = int(rng.integers(10, 200))
+            spikes[start:start + length] += rng.uniform(100, 400)
+        trace[:, pin] = baseline + drift + noise + spikes
+    return np.clip(np.rint(trace), 1, ar_max)
+
+
+def load_trace(path):
+    """Load a recorded trace of analog readings
+    Parameters
+    ----------
+    path : str or Path
+        .npy file, or CSV file with one column per analog pin
+    Returns
+    -------
+    trace
+        numpy array with shape (nb_samples, nb_pins)
+    """
+    if str(path).endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+class SimulatedADC:
+    """Analog readings replayed from a trace
+
+    Every call of read_analog on a pin returns the next value of the trace
+    for that pin. The trace is replayed in a loop.
+
+    Parameters
+    ----------
+    trace : numpy array
+        readings with shape (nb_samples, nb_pins), see synthetic_trace and load_trace
+    delay : float
+        number of seconds a reading takes, to mimic the I2C latency of the GrovePi
+    """
+
+    def __init__(self, trace, delay=0):
+        self.trace = np.asarray(trace)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.positions = {}
+
+    def set_input(self, pin):
+        self.positions.setdefault(pin, 0)
+
+    def read_analog(self, pin):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            position = self.positions.get(pin, 0)
+            self.positions[pin] = (position + 1) % len(self.trace)
+        return int(self.trace[position, pin])
+
+
+class SimulatedBME680:
+    """Deterministic temperature, pressure and humidity readings
+
+    Parameters
+    ----------
+    seed : int
+    """
+
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.nb_reads = 0
+
+    def read(self):
+        self.nb_reads += 1
+        phase = 2 * np.pi * self.nb_reads / 1440
+        return {
+            'temperature': float(21 + 2 * np.sin(phase) + self.rng.normal(0, 0.1)),
+            'pressure': float(1013 + 5 * np.sin(phase / 7) + self.rng.normal(0, 0.2)),
+            'humidity': float(45 + 10 * np.cos(phase) + self.rng.normal(0, 0.5))
+        }
+
+
+def create_backends(kind, pins, trace_path=None, seed=0):
+    """Create the analog and BME680 backends
+    Parameters
+    ----------
+    kind : str
+        'grovepi' for the real sensors, 'simulated' for the simulators
+    pins : list
+        analog pins of the MQ sensors
+    trace_path : str or None
+        recorded trace replayed by the simulator, None for a synthetic trace
+    seed : int
+        seed of the simulators
+    Returns
+    -------
+    (adc, bme680_sensor)
+    """
+    if kind == 'grovepi':
+        adc, bme680_sensor = GrovePiADC(), BME680Sensor()
+    elif kind == 'simulated':
+        trace = load_trace(trace_path) if trace_path else synthetic_trace(100000, pins, seed)
+        adc, bme680_sensor = SimulatedADC(trace), SimulatedBME680(seed)
+    else:
+        raise ValueError('Unknown sensor backend: {}'.format(kind))
+
+    # Set pin mode to INPUT for all MQ sensors
+    for pin in pins:
+        adc.set_input(pin)
+    return adc, bme680_sensor
+
+
+def read_analog_average(adc, pins, nb_reads, interval):
+    """Read all analog pins several times and average the readings
+    Parameters
+    ----------
+    adc : analog backend
+    pins : list
+    nb_reads : int
+        number of readings per pin
+    interval : float
+        number of seconds between two readings
+    Returns
+    -------
+    numpy array
+        average reading per pin, in the order of pins
+    """
+    values = np.zeros(len(pins))
+    for i in range(nb_reads):
+        for idx, pin in enumerate(pins):
+            values[idx] += adc.read_analog(pin)
+        if interval:
+            time.sleep(interval)
+    return values / nb_reads
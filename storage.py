@@ -0,0 +1,546 @@
+# ------------------------------------------------------------------
+#                       Storage backends
+# ------------------------------------------------------------------
+# Common interface for storing and querying the samples, with
+# implementations for Cloud Firestore, a local SQLite database and
+# an in-memory store. The backend is chosen with STORAGE_BACKEND in
+# the config. The local backends allow latency-sensitive deployments
+# without a round-trip to Firebase, and benchmarking the dashboard
+# and alerting without a live service.
+#
+# Every backend has the methods:
+# - append(docs): store a list of (collection, document ID, sample) tuples
+# - range(collection, fields, start, end, device): columnar time range
+# - latest(collection, n): the last n samples
+# - newer(collection, date): the samples after a date
+# - page(collection, start, end, after, limit): documents with their IDs, by cursor
+# - subscribe(collection, start, callback): call back with every new sample
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import bisect
+import sqlite3
+import threading
+from datetime import timedelta
+from datetime import timezone
+from pathlib import Path
+
+from loader import to_column
+from sample_buffer import encode_sample, decode_sample
+
+
+def to_columns(samples, fields):
+    """Convert a list of sample dicts into a list of dates and a NumPy array per field"""
+    dates = [sample['date'] for sample in samples]
+    return dates, {field: to_column([sample.get(field) for sample in samples]) for field in fields}
+
+
+class Storage:
+    """Interface of the storage backends"""
+
+    def append(self, docs):
+        """Store samples, a sample with an existing document ID replaces the stored one
+        Parameters
+        ----------
+        docs : list
+            list of (collection, document ID, sample dict) tuples
+        """
+        raise NotImplementedError
+
+    def range(self, collection, fields, start, end=None, device=None):
+        """Read the samples of a collection in a time range
+        Parameters
+        ----------
+        collection : str
+        fields : list
+            names of the fields to read, besides 'date'
+        start : datetime
+        end : datetime or None
+            end of the range (exclusive), None for all samples from start onwards
+        device : str or None
+            only read the samples of this device, None for all devices
+        Returns
+        -------
+        (dates, values)
+            list of dates and dict with a NumPy array per field
+        """
+        raise NotImplementedError
+
+    def latest(self, collection, n):
+        """Read the last n samples of a collection, in chronological order"""
+        raise NotImplementedError
+
+    def newer(self, collection, date):
+        """Read the samples of a collection after a date, in chronological order"""
+        raise NotImplementedError
+
+    def subscribe(self, collection, start, callback):
+        """Call back with every sample added to a collection from a start date onwards
+        Returns
+        -------
+        subscription
+            call subscription.unsubscribe() to stop
+        """
+        raise NotImplementedError
+
+    def page(self, collection, start, end=None, after=None, limit=500, device=None):
+        """Read one page of the documents of a time range, ordered by date and document ID
+        Parameters
+        ----------
+        collection : str
+        start : datetime
+        end : datetime or None
+            end of the range (exclusive), None for all documents from start onwards
+        after : tuple or None
+            (date, document ID) of the last document of the previous page, None for the first page
+        limit : int
+            maximum number of documents
+        device : str or None
+            only read the documents of this device, None for all devices
+        Returns
+        -------
+        list
+            list of (document ID, sample dict) tuples
+        """
+        raise NotImplementedError
+
+
+# Number of seconds the samples of a room can arrive after the newer samples of
+# another room: the buffers send their samples every FIREBASE_FLUSH_INTERVAL and
+# wait up to FIREBASE_MAX_BACKOFF after a failed write
+LATE_SAMPLES = timedelta(minutes=15)
+
+
+class NewSampleReader:
+    """Read the samples added to a collection since the last read
+
+    Every room sends its samples in batches, so a sample can be stored after
+    the newer samples of another room. A date cursor would skip it: the
+    samples from `overlap` before the newest date are read again, and the
+    samples that were already read are skipped by their document ID.
+
+    Parameters
+    ----------
+    storage : Storage
+    collection : str
+    start : datetime
+        samples from this date onwards are read
+    overlap : timedelta
+        period before the newest date that is read again
+    page_size : int
+        number of documents per query
+    """
+
+    def __init__(self, storage, collection, start, overlap=LATE_SAMPLES, page_size=500):
+        self.storage = storage
+        self.collection = collection
+        self.overlap = overlap
+        self.page_size = page_size
+        self.start_date = start
+        self.last_date = start
+        self.seen = {}  # document ID -> date, of the samples in the overlap
+
+    def read(self, skip=False):
+        """Samples that weren't read yet, in chronological order
+        Parameters
+        ----------
+        skip : bool
+            only mark the samples as read, e.g. when they were loaded otherwise
+        """
+        start = max(self.start_date, self.last_date - self.overlap)
+        samples = []
+        after = None
+        while True:
+            page = self.storage.page(self.collection, start, after=after, limit=self.page_size)
+            for doc_id, sample in page:
+                if doc_id not in self.seen:
+                    self.seen[doc_id] = sample['date']
+                    samples.append(sample)
+            if len(page) < self.page_size:
+                break
+            after = page[-1][1]['date'], page[-1][0]
+        samples.sort(key=lambda sample: sample['date'])
+        if samples:
+            self.last_date = max(self.last_date, samples[-1]['date'])
+        oldest = self.last_date - self.overlap
+        self.seen = {doc_id: date for doc_id, date in self.seen.items() if date >= oldest}
+        return [] if skip else samples
+
+
+class PollingSubscription(threading.Thread):
+    """Subscription of a backend without notifications, polls for new samples"""
+
+    def __init__(self, storage, collection, start, callback, interval, overlap=LATE_SAMPLES):
+        super().__init__(name='subscription', daemon=True)
+        # Like a Firestore listener, the samples at the start date itself are included
+        self.reader = NewSampleReader(storage, collection, start, overlap)
+        self.callback = callback
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.start()
+
+    def run(self):
+        while True:
+            for sample in self.reader.read():
+                self.callback(sample)
+            if self.stop_event.wait(self.interval):
+                return
+
+    def unsubscribe(self):
+        self.stop_event.set()
+
+
+def utc_date(date):
+    """Aware UTC copy of a date, naive dates are in UTC like Firestore stores them"""
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
+
+
+class FirestoreSubscription(threading.Thread):
+    """Firestore listener on the new samples, restarted from the last seen date at an interval
+
+    A listener keeps every document of its query in memory and reads them
+    all again when it reconnects, so its start date is moved forward. The
+    documents passed on by the previous listener are not passed on again.
+    Firestore returns aware UTC dates, the dates are compared in UTC.
+    """
+
+    def __init__(self, db, collection, start, callback, interval):
+        super().__init__(name='subscription', daemon=True)
+        self.db = db
+        self.collection = collection
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_date = utc_date(start)
+        self.delivered = {}  # document ID -> date, of the samples from last_date onwards
+        self.stop_event = threading.Event()
+        self.watch = self._listen(self.last_date)
+        self.start()
+
+    def _listen(self, start):
+        query = self.db.collection(self.collection).where('date', '>=', start)
+        return query.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        # Runs in the thread of the listener, which stops for good on an exception
+        for change in changes:
+            try:
+                self._on_change(change)
+            except Exception as e:
+                print('Something went wrong with a new sample of {}: {!r}'.format(self.collection, e))
+
+    def _on_change(self, change):
+        if change.type.name != 'ADDED':
+            return
+        doc_id = change.document.id
+        sample = change.document.to_dict()
+        date = utc_date(sample['date'])
+        with self.lock:
+            if doc_id in self.delivered:
+                return
+            if date > self.last_date:
+                self.last_date = date
+                self.delivered = {i: d for i, d in self.delivered.items() if d >= self.last_date}
+            if date >= self.last_date:
+                self.delivered[doc_id] = date
+        self.callback(sample)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                start = self.last_date
+            # The new listener starts before the old one stops, so no sample is missed
+            watch = self._listen(start)
+            with self.lock:
+                self.watch, old_watch = watch, self.watch
+            old_watch.unsubscribe()
+
+    def unsubscribe(self):
+        self.stop_event.set()
+        with self.lock:
+            self.watch.unsubscribe()
+
+
+class FirestoreStorage(Storage):
+    """Samples stored on Cloud Firestore
+
+    Parameters
+    ----------
+    firebase_path : str or Path
+        JSON file with the credentials of the Firebase app
+    resubscribe_interval : float
+        number of seconds after which a subscription restarts from its last sample
+    """
+
+    def __init__(self, firebase_path, resubscribe_interval=3600):
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import firestore
+
+        # Initialize Firebase app with credentials
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(str(firebase_path))
+            firebase_admin.initialize_app(cred)
+
+        # Create Firestore object
+        self.firestore = firestore
+        self.db = firestore.client()
+        self.resubscribe_interval = resubscribe_interval
+
+    def append(self, docs):
+        batch = self.db.batch()
+        for collection, doc_id, sample in docs:
+            batch.set(self.db.collection(collection).document(doc_id), sample)
+        batch.commit()
+
+    def range(self, collection, fields, start, end=None, device=None):
+        fields = list(fields)
+        query = self.db.collection(collection).where('date', '>=', start)
+        if end is not None:
+            query = query.where('date', '<', end)
+        if device is not None:
+            query = query.where('device', '==', device)
+        # Only the requested fields are transferred
+        query = query.order_by('date').select(['date'] + fields)
+        return to_columns([doc.to_dict() for doc in query.stream()], fields)
+
+    def latest(self, collection, n):
+        docs = (self.db.collection(collection)
+                .order_by('date', direction=self.firestore.Query.DESCENDING)
+                .limit(n)
+                .get())
+        # Reverse ordering of the data as we extracted the last entries in the collection
+        samples = [doc.to_dict() for doc in docs]
+        samples.reverse()
+        return samples
+
+    def newer(self, collection, date):
+        query = self.db.collection(collection).order_by('date')
+        if date is not None:
+            query = query.start_after({'date': date})
+        return [doc.to_dict() for doc in query.get()]
+
+    def subscribe(self, collection, start, callback):
+        return FirestoreSubscription(self.db, collection, start, callback, self.resubscribe_interval)
+
+    def page(self, collection, start, end=None, after=None, limit=500, device=None):
+        document_id = self.firestore.FieldPath.document_id()
+        query = self.db.collection(collection).where('date', '>=', start)
+        if end is not None:
+            query = query.where('date', '<', end)
+        if device is not None:
+            query = query.where('device', '==', device)
+        query = query.order_by('date').order_by(document_id)
+        if after is not None:
+            date, doc_id = after
+            query = query.start_after({'date': date, document_id: self.db.collection(collection).document(doc_id)})
+        return [(doc.id, doc.to_dict()) for doc in query.limit(limit).stream()]
+
+
+class SQLiteStorage(Storage):
+    """Samples stored in a local SQLite database
+
+    Parameters
+    ----------
+    path : str or Path
+        location of the SQLite database file
+    poll_interval : float
+        number of seconds between two checks for new samples of a subscription
+    """
+
+    def __init__(self, path, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    collection TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    device TEXT,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (collection, doc_id)
+                )''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_date ON documents (collection, date)')
+
+    def _select(self, sql, params):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [decode_sample(payload) for payload, in rows]
+
+    def append(self, docs):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO documents (collection, doc_id, date, device, payload) VALUES (?, ?, ?, ?, ?)',
+                [(collection, doc_id, sample['date'].isoformat(), sample.get('device'), encode_sample(sample))
+                 for collection, doc_id, sample in docs])
+
+    def range(self, collection, fields, start, end=None, device=None):
+        sql = 'SELECT payload FROM documents WHERE collection = ? AND date >= ?'
+        params = [collection, start.isoformat()]
+        if end is not None:
+            sql += ' AND date < ?'
+            params.append(end.isoformat())
+        if device is not None:
+            sql += ' AND device = ?'
+            params.append(device)
+        return to_columns(self._select(sql + ' ORDER BY date', params), fields)
+
+    def latest(self, collection, n):
+        samples = self._select('SELECT payload FROM documents WHERE collection = ? ORDER BY date DESC LIMIT ?',
+                               (collection, n))
+        samples.reverse()
+        return samples
+
+    def newer(self, collection, date):
+        if date is None:
+            return self._select('SELECT payload FROM documents WHERE collection = ? ORDER BY date',
+                                (collection,))
+        return self._select('SELECT payload FROM documents WHERE collection = ? AND date > ? ORDER BY date',
+                            (collection, date.isoformat()))
+
+    def subscribe(self, collection, start, callback):
+        return PollingSubscription(self, collection, start, callback, self.poll_interval)
+
+    def page(self, collection, start, end=None, after=None, limit=500, device=None):
+        sql = 'SELECT doc_id, payload FROM documents WHERE collection = ? AND date >= ?'
+        params = [collection, start.isoformat()]
+        if end is not None:
+            sql += ' AND date < ?'
+            params.append(end.isoformat())
+        if device is not None:
+            sql += ' AND device = ?'
+            params.append(device)
+        if after is not None:
+            date, doc_id = after
+            sql += ' AND (date > ? OR (date = ? AND doc_id > ?))'
+            params.extend([date.isoformat(), date.isoformat(), doc_id])
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY date, doc_id LIMIT ?', params + [limit]).fetchall()
+        return [(doc_id, decode_sample(payload)) for doc_id, payload in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class MemoryStorage(Storage):
+    """Samples kept in memory, only shared within one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collections = {}  # collection -> sorted list of (date, doc_id)
+        self.samples = {}  # (collection, doc_id) -> sample
+        self.subscribers = {}  # collection -> list of (start, callback)
+
+    def append(self, docs):
+        new_samples = []
+        with self.lock:
+            for collection, doc_id, sample in docs:
+                keys = self.collections.setdefault(collection, [])
+                old_sample = self.samples.get((collection, doc_id))
+                if old_sample is not None:
+                    keys.remove((old_sample['date'], doc_id))
+                bisect.insort(keys, (sample['date'], doc_id))
+                self.samples[(collection, doc_id)] = dict(sample)
+                new_samples.append((collection, dict(sample)))
+
+        for collection, sample in new_samples:
+            for start, callback in list(self.subscribers.get(collection, [])):
+                if sample['date'] >= start:
+                    callback(sample)
+
+    def _get(self, collection, keys):
+        return [dict(self.samples[(collection, doc_id)]) for _, doc_id in keys]
+
+    def _slice(self, collection, start=None, end=None):
+        keys = self.collections.get(collection, [])
+        dates = [date for date, _ in keys]
+        i_start = 0 if start is None else bisect.bisect_left(dates, start)
+        i_end = len(keys) if end is None else bisect.bisect_left(dates, end)
+        return keys[i_start:i_end]
+
+    def range(self, collection, fields, start, end=None, device=None):
+        with self.lock:
+            samples = self._get(collection, self._slice(collection, start, end))
+        if device is not None:
+            samples = [sample for sample in samples if sample.get('device') == device]
+        return to_columns(samples, fields)
+
+    def latest(self, collection, n):
+        with self.lock:
+            keys = self.collections.get(collection, [])
+            return self._get(collection, keys[max(len(keys) - n, 0):])
+
+    def newer(self, collection, date):
+        with self.lock:
+            keys = self.collections.get(collection, [])
+            if date is not None:
+                dates = [d for d, _ in keys]
+                keys = keys[bisect.bisect_right(dates, date):]
+            return self._get(collection, keys)
+
+    def subscribe(self, collection, start, callback):
+        storage = self
+        subscriber = (start, callback)
+        with self.lock:
+            self.subscribers.setdefault(collection, []).append(subscriber)
+            # Like a Firestore listener, the samples already stored from start onwards come first
+            samples = self._get(collection, self._slice(collection, start))
+        for sample in samples:
+            callback(sample)
+
+        class MemorySubscription:
+            def unsubscribe(self):
+                with storage.lock:
+                    storage.subscribers[collection].remove(subscriber)
+
+        return MemorySubscription()
+
+    def page(self, collection, start, end=None, after=None, limit=500, device=None):
+        with self.lock:
+            keys = self._slice(collection, start, end)
+            if after is not None:
+                keys = keys[bisect.bisect_right(keys, tuple(after)):]
+            samples = []
+            for date, doc_id in keys:
+                sample = self.samples[(collection, doc_id)]
+                if device is None or sample.get('device') == device:
+                    samples.append((doc_id, dict(sample)))
+                    if len(samples) == limit:
+                        break
+        return samples
+
+
+def create_storage(kind, firebase_path=None, sqlite_path=None):
+    """Create the storage backend chosen in the config
+    Parameters
+    ----------
+    kind : str
+        'firestore', 'sqlite' or 'memory'
+    firebase_path : str or Path
+        credentials of the Firebase app, for 'firestore'
+    sqlite_path : str or Path
+        database file, for 'sqlite'
+    Returns
+    -------
+    Storage
+    """
+    if kind == 'firestore':
+        return FirestoreStorage(firebase_path)
+    if kind == 'sqlite':
+        return SQLiteStorage(Path(sqlite_path))
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError('Unknown storage backend: {}'.format(kind))
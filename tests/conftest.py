@@ -0,0 +1,40 @@
+# Tests of the air quality scripts
+#
+# The scripts import their settings from config.py, which every user
+# creates from config_template.py. The tests use the template with the
+# FILL IN values replaced, and the local stand-ins of the sensors and
+# of Firestore.
+
+import re
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Settings of the tests, appended to the template
+TEST_CONFIG = '''
+SENSOR_BACKEND = 'simulated'
+SIMULATED_TRACE = None
+STORAGE_BACKEND = 'memory'
+COLLECTOR_URL = None
+NOTIFICATION_CHANNELS = ['log']
+VENTILATION_UNITS = []
+METRICS_PORTS = {}
+PROFILE_PATH = None
+MQ_SENSORS = {sensor: dict(settings, r0=settings.get('r0') or 1) for sensor, settings in MQ_SENSORS.items()}
+'''
+
+
+def config_source(extra=''):
+    """Source of a config.py for the tests"""
+    source = (ROOT / 'config_template.py').read_text()
+    source = re.sub(r': # FILL IN,?', ': 1000,', source)
+    source = re.sub(r' = # FILL IN.*', " = 'test'", source)
+    return source + TEST_CONFIG + extra
+
+
+config = types.ModuleType('config')
+exec(compile(config_source(), 'config.py', 'exec'), config.__dict__)
+sys.modules['config'] = config
@@ -0,0 +1,49 @@
+import numpy as np
+
+from calibration import R0Calibrator, nb_readings, usable_calibration
+
+INTERVAL = 0.5
+
+
+def run(raw):
+    calibrator = R0Calibrator([9.8], max_reads=len(raw), min_reads=200, ci_tolerance=0.01,
+                              drift_window=nb_readings(300, INTERVAL), block_size=nb_readings(10, INTERVAL))
+    for value in raw:
+        calibrator.add([value])
+        if calibrator.nb_reads % 10 == 0 and calibrator.converged():
+            break
+    return calibrator
+
+
+def correlated_noise(nb_reads, seed=0):
+    rng = np.random.default_rng(seed)
+    noise = np.zeros(nb_reads)
+    for i in range(1, nb_reads):
+        noise[i] = 0.9 * noise[i - 1] + rng.normal(0, 3)
+    return noise
+
+
+def test_warm_sensor_converges_after_one_drift_window():
+    calibrator = run(400 + correlated_noise(7200))
+    assert calibrator.converged()
+    assert calibrator.nb_reads <= nb_readings(300, INTERVAL) + 10
+
+
+def test_warm_up_is_left_out():
+    t = np.arange(7200) * INTERVAL
+    calibrator = run(400 + 80 * np.exp(-t / 120) + correlated_noise(7200))
+    assert calibrator.converged()
+    # The readings of the first minutes of the heater are not used
+    assert calibrator.warm_from[0] * INTERVAL > 120
+
+
+def test_usable_calibration():
+    calibrations = [
+        {'r0': {'mq2': 3.0}, 'converged': True},
+        {'r0': {'mq2': 4.0}, 'converged': True},
+        {'r0': {'mq2': 5.0}, 'converged': False},
+        {'r0': {'mq2': float('nan')}, 'converged': True},
+    ]
+    assert usable_calibration(calibrations)['r0'] == {'mq2': 4.0}
+    assert usable_calibration(calibrations[2:]) is None
+    assert usable_calibration([]) is None
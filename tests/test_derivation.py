@@ -0,0 +1,47 @@
+import config as cfg
+from conversion import ConversionTable
+from derivation import Deriver, calibration_collection, calibration_doc
+from encoding import SampleSchema, SchemaRegistry, schema_collection
+from storage import MemoryStorage
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.nb_newer = 0
+
+    def newer(self, collection, date):
+        self.nb_newer += 1
+        return super().newer(collection, date)
+
+
+def test_unknown_calibration_is_read_once_per_interval():
+    storage = CountingStorage()
+    deriver = Deriver(storage, 'samples', cfg.MQ_SENSORS, cfg.CURVES, retry_interval=3600)
+    assert all(deriver.table('unknown') is None for _ in range(100))
+    assert storage.nb_newer == 1
+
+    table = ConversionTable(cfg.MQ_SENSORS, cfg.CURVES)
+    doc_id, doc = calibration_doc(table, 'kitchen')
+    storage.append([(calibration_collection('samples'), doc_id, doc)])
+    assert deriver.table(table.version) is not None
+    assert storage.nb_newer == 2
+
+    deriver.retry_interval = 0
+    assert deriver.table('unknown') is None
+    assert storage.nb_newer == 3
+
+
+def test_unknown_schema_is_read_once_per_interval():
+    storage = CountingStorage()
+    schemas = SchemaRegistry(storage, 'samples', retry_interval=3600)
+    assert all(schemas.schema('unknown') is None for _ in range(100))
+    assert storage.nb_newer == 1
+
+    schema = SampleSchema(['temperature', 'humidity'])
+    doc_id, doc = schema.doc()
+    storage.append([(schema_collection('samples'), doc_id, doc)])
+    assert schemas.schema(schema.version).fields == schema.fields
+    assert storage.nb_newer == 2
+    assert schemas.schema(schema.version) is not None
+    assert storage.nb_newer == 2
@@ -0,0 +1,22 @@
+import random
+
+from health import SensorHealth
+
+
+def test_steady_quantized_readings_are_not_stuck():
+    """A steady sensor with less noise than one ADC count repeats the same reading"""
+    rng = random.Random(0)
+    health = SensorHealth(1023)
+    statuses = {health.update(float(round(400 + rng.gauss(0, 0.2)))) for _ in range(5000)}
+    assert 'stuck' not in statuses
+
+
+def test_frozen_noisy_sensor_is_stuck():
+    rng = random.Random(0)
+    health = SensorHealth(1023, stuck_count=60)
+    for _ in range(200):
+        assert health.update(float(round(400 + rng.gauss(0, 5)))) != 'stuck'
+    statuses = [health.update(412.0) for _ in range(60)]
+    assert statuses[58] != 'stuck'
+    assert statuses[59] == 'stuck'
+    assert health.update(413.0) != 'stuck'
@@ -0,0 +1,53 @@
+from datetime import datetime
+from datetime import timedelta
+
+import config as cfg
+from archive import SampleArchive
+from conversion import ConversionTable
+from ingest import SampleStore
+from rollups import RollupAggregator
+from sample_buffer import SampleBuffer
+
+START = datetime(2026, 10, 18, 12, 0)
+
+
+def create_store(path, **params):
+    table = ConversionTable(cfg.MQ_SENSORS, cfg.CURVES)
+    rollup_aggregator = RollupAggregator(table.keys + ['temperature', 'pressure', 'humidity'])
+    archive = SampleArchive(path / 'archive', table.raw_keys + rollup_aggregator.fields)
+    store = SampleStore(table, SampleBuffer(path / 'buffer.db'), rollup_aggregator, archive,
+                        device='kitchen', collection_name='samples', **params)
+    return store
+
+
+def reading(table, date, raw=400.0):
+    sample = {'date': date, 'temperature': 20.0, 'pressure': 1000.0, 'humidity': 50.0}
+    sample.update((key, raw) for key in table.raw_keys)
+    return sample
+
+
+def test_sample_dated_backwards(tmp_path):
+    """The clock is set back: the sample is buffered, the archive stays in chronological order"""
+    store = create_store(tmp_path, ingest_mode='ppm', encoding='keyed')
+    table = store.conversion_table
+    for minutes in [0, 1, 2]:
+        store.store(reading(table, START + timedelta(minutes=minutes)))
+    store.store(reading(table, START + timedelta(seconds=30)))
+    store.store(reading(table, START + timedelta(minutes=3)))
+
+    timestamps, _ = store.archive.range(START)
+    assert len(timestamps) == 4
+    assert list(timestamps) == sorted(timestamps)
+    # The readings are kept in the buffer
+    assert len(store.sample_buffer.samples_since(START)) == 5
+
+
+def test_sample_dated_before_the_archive(tmp_path):
+    """After a restart the clock is behind the samples archived before it"""
+    store = create_store(tmp_path, ingest_mode='ppm', encoding='keyed')
+    store.store(reading(store.conversion_table, START + timedelta(minutes=5)))
+
+    restarted = create_store(tmp_path, ingest_mode='ppm', encoding='keyed')
+    restarted.store(reading(restarted.conversion_table, START))
+    timestamps, _ = restarted.archive.range(START)
+    assert len(timestamps) == 1
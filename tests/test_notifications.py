@@ -0,0 +1,89 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from conftest import ROOT, config_source
+from notifications import NotificationDispatcher
+from storage import SQLiteStorage
+
+
+class RecordingChannel:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, subject, text):
+        self.messages.append(text)
+
+    def close(self):
+        pass
+
+
+def test_pending_alert_is_replaced():
+    channel = RecordingChannel()
+    dispatcher = NotificationDispatcher([channel], cooldown=3600, coalesce=0.2, queue_size=2)
+    assert all(dispatcher.notify('kitchen', 'co', 'co {}'.format(i)) for i in range(100))
+    assert dispatcher.notify('bedroom', 'lpg', 'lpg')
+    assert dispatcher.pending_count() == 2
+    # Other rooms and gases are only dropped when the pending alerts are full
+    assert not dispatcher.notify('hall', 'ch4', 'ch4')
+
+    dispatcher.start()
+    dispatcher.stop()
+    assert channel.messages == ['\nco 99\nlpg']
+    assert dispatcher.pending_count() == 0
+    # The cooldown started when the alert was accepted
+    assert not dispatcher.notify('kitchen', 'co', 'co again')
+
+
+def start_alert_command(path, extra=''):
+    (path / 'config.py').write_text(config_source(extra))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(path), str(ROOT)]))
+    return subprocess.Popen([sys.executable, str(ROOT / 'air_quality.py'), 'alert'], cwd=str(path),
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def critical_docs(dates):
+    return [('test', 'living_room_' + date.isoformat(), {'date': date, 'device': 'living_room', 'mq2_co_ppm': 5000.0})
+            for date in dates]
+
+
+def test_alert_command_starts(tmp_path):
+    """The alert command builds its dispatcher, listener and gauges and keeps running"""
+    process = start_alert_command(tmp_path)
+    time.sleep(3)
+    running = process.poll() is None
+    process.send_signal(signal.SIGINT)
+    stdout, stderr = process.communicate(timeout=30)
+    assert running, stderr
+    assert 'Traceback' not in stderr, stderr
+    assert 'Program stopped' in stdout
+
+
+def test_alert_command_restart(tmp_path):
+    """The samples before a restart fill the windows of the rules but aren't notified again"""
+    storage = SQLiteStorage(tmp_path / 'storage.db')
+    now = datetime.now()
+    storage.append(critical_docs([now - timedelta(minutes=minutes) for minutes in range(10, 5, -1)]))
+    log_path = tmp_path / 'alerts.log'
+    process = start_alert_command(tmp_path, """
+STORAGE_BACKEND = 'sqlite'
+NOTIFICATION_COALESCE = 0
+NOTIFICATION_LOG_PATH = {!r}
+""".format(str(log_path)))
+    time.sleep(3)
+    assert not log_path.exists()
+
+    # The window of the rule was filled before the restart, only the new sample is notified
+    late, new = now - timedelta(minutes=5), datetime.now()
+    storage.append(critical_docs([late, new]))
+    time.sleep(3)
+    process.send_signal(signal.SIGINT)
+    stdout, stderr = process.communicate(timeout=30)
+    assert 'Traceback' not in stderr, stderr
+    alerts = log_path.read_text()
+    assert alerts.count('Critical') == 1
+    assert 'for co of 5000.0ppm in living_room at ' + new.strftime('%H:%M:%S') in alerts
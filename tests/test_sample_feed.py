@@ -0,0 +1,53 @@
+import time
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from sample_feed import SampleFeed
+from storage import MemoryStorage, SQLiteStorage
+
+START = datetime(2026, 10, 18, 12, 0)
+
+
+def samples(device, minutes):
+    return [('samples', '{}_{}'.format(device, minute),
+             {'date': START + timedelta(minutes=minute), 'device': device, 'co': float(minute)})
+            for minute in minutes]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def storage(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(tmp_path / 'samples.db', poll_interval=0.05)
+
+
+def test_late_room_is_not_skipped(storage):
+    """A room of which the batch is stored after the newer samples of another room"""
+    storage.append(samples('kitchen', [0, 1]))
+    feed = SampleFeed(storage, 'samples', ['co'], maxlen=100)
+    assert feed.poll() == 2
+
+    storage.append(samples('kitchen', [5, 6]))
+    assert feed.poll() == 2
+    storage.append(samples('bedroom', [2, 3, 4]))
+    assert feed.poll() == 3
+    assert feed.poll() == 0
+
+    dates, values = feed.since(device='bedroom')
+    assert values['co'] == [2.0, 3.0, 4.0]
+    dates, _ = feed.since()
+    assert dates == sorted(dates) and len(dates) == 7
+
+
+def test_subscription_receives_late_room(tmp_path):
+    storage = SQLiteStorage(tmp_path / 'samples.db', poll_interval=0.05)
+    received = []
+    subscription = storage.subscribe('samples', START, received.append)
+    storage.append(samples('kitchen', [0, 5, 6]))
+    time.sleep(0.3)
+    storage.append(samples('bedroom', [2, 3, 4]))
+    time.sleep(0.3)
+    subscription.unsubscribe()
+    assert sorted(sample['co'] for sample in received) == [0.0, 2.0, 3.0, 4.0, 5.0, 6.0]
@@ -0,0 +1,53 @@
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+from sampler import Clock, Sampler
+
+
+def test_clock_follows_wall_clock_set_after_start():
+    clock = Clock()
+    # The wall clock was an hour behind when the sampler started, NTP set it since
+    clock.start_date -= timedelta(hours=1)
+    assert abs((clock.to_date(clock.monotonic()) - datetime.now()).total_seconds()) < 1
+
+
+def test_clock_keeps_monotonic_intervals():
+    clock = Clock()
+    tick = clock.monotonic()
+    assert (clock.to_date(tick + 60) - clock.to_date(tick)).total_seconds() == 60
+
+
+def test_producer_survives_a_failing_read():
+    calls = []
+
+    def read_mq():
+        calls.append(None)
+        if len(calls) == 1:
+            raise ValueError('bad reading')
+        return {'mq2_raw': 400.0}
+
+    sampler = Sampler(read_mq, lambda: {'temperature': 20.0}, mq_interval=0.01, bme680_interval=0.01)
+    sampler.start()
+    samples = sampler.samples(timeout=0.1)
+    sample = next(samples)
+    sampler.stop()
+    assert sample['mq2_raw'] == 400.0
+    assert len(calls) >= 2
+
+
+def test_held_back_readings_are_bounded():
+    """MQ readings without a BME680 reading yet are held back, at most queue_size of them"""
+    sampler = Sampler(None, None, mq_interval=1, bme680_interval=1, queue_size=5)
+
+    def produce():
+        for i in range(12):
+            sampler.sample_queue.put({'source': 'mq', 'date': datetime(2026, 10, 18, 0, i), 'values': {'i': i}})
+        sampler.sample_queue.put({'source': 'bme680', 'values': {'temperature': 20.0}})
+        sampler.stop_event.set()
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    samples = list(sampler.samples(timeout=0.01))
+    producer.join()
+    assert [sample['i'] for sample in samples] == list(range(7, 12))
@@ -0,0 +1,61 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from types import SimpleNamespace
+
+from storage import FirestoreSubscription
+
+
+class FakeQuery:
+    def __init__(self, db, start):
+        self.db = db
+        self.start = start
+
+    def where(self, field, op, value):
+        return FakeQuery(self.db, value)
+
+    def on_snapshot(self, callback):
+        self.db.listeners.append((self.start, callback))
+        return SimpleNamespace(unsubscribe=lambda: None)
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.listeners = []
+
+    def collection(self, name):
+        return FakeQuery(self, None)
+
+
+def added(doc_id, sample):
+    return SimpleNamespace(type=SimpleNamespace(name='ADDED'),
+                           document=SimpleNamespace(id=doc_id, to_dict=lambda: dict(sample)))
+
+
+def test_subscription_with_aware_dates():
+    """Firestore returns aware UTC dates, the subscription starts from a naive date"""
+    db = FakeFirestore()
+    received = []
+    start = datetime(2026, 10, 18, 12, 0)
+    subscription = FirestoreSubscription(db, 'samples', start, received.append, interval=3600)
+    _, on_snapshot = db.listeners[0]
+
+    dates = [datetime(2026, 10, 18, 12, minute, tzinfo=timezone.utc) for minute in range(3)]
+    on_snapshot(None, [added('id{}'.format(i), {'date': date}) for i, date in enumerate(dates)], None)
+    # A reconnecting listener reads the samples from the last date again
+    on_snapshot(None, [added('id2', {'date': dates[2]}), added('id3', {'date': dates[2] + timedelta(minutes=1)})],
+                None)
+    subscription.unsubscribe()
+
+    assert [sample['date'] for sample in received] == dates + [dates[2] + timedelta(minutes=1)]
+    assert subscription.last_date == dates[2] + timedelta(minutes=1)
+
+
+def test_subscription_survives_a_bad_sample():
+    db = FakeFirestore()
+    received = []
+    subscription = FirestoreSubscription(db, 'samples', datetime(2026, 10, 18), received.append, interval=3600)
+    _, on_snapshot = db.listeners[0]
+    on_snapshot(None, [added('bad', {'value': 1}), added('good', {'date': datetime(2026, 10, 18, 1)})], None)
+    subscription.unsubscribe()
+    assert len(received) == 1
@@ -0,0 +1,179 @@
+# ------------------------------------------------------------------
+#                  Control loop of the ventilation units
+# ------------------------------------------------------------------
+# Every ventilation unit is an Energenie socket, controlled by the
+# gas concentrations of one room. A unit has a state machine with
+# the states 'off' and 'on':
+# - it is requested on as soon as an alert rule of one of its gases
+#   is triggered (see alert_engine.py)
+# - it is requested off when all its gases are below their off
+#   thresholds, which are lower than the upper bounds (hysteresis)
+# - in between, the request doesn't change
+#
+# A thread checks the requests every few seconds and switches a
+# socket once it has been in its current state for at least the
+# minimum on or off time, so the relay doesn't chatter. Every
+# transition is logged with the time spent in the previous state.
+# ------------------------------------------------------------------
+# THIS SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPLICIT OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE SCRIPT.
+# ------------------------------------------------------------------
+
+import threading
+import time
+from datetime import datetime
+
+
+class VentilationUnit:
+    """State machine of the Energenie socket of one ventilation unit
+
+    Parameters
+    ----------
+    socket : int
+        Energenie socket number
+    device : str
+        room of which the samples control the unit
+    gases : list
+        gases of which a triggered alert rule turns on the unit
+    off_thresholds : dict
+        ppm value per field (e.g. 'mq2_co_ppm') below which the unit may be turned off
+    min_on : float
+        minimum number of seconds the unit stays on
+    min_off : float
+        minimum number of seconds the unit stays off
+    switch_on : callable
+        function turning on a socket
+    switch_off : callable
+        function turning off a socket
+    """
+
+    def __init__(self, socket, device, gases, off_thresholds, min_on, min_off, switch_on, switch_off):
+        self.socket = socket
+        self.device = device
+        self.off_thresholds = off_thresholds
+        self.gases = set(gases)
+        self.min_on = min_on
+        self.min_off = min_off
+        self.switch_on = switch_on
+        self.switch_off = switch_off
+        self.state = 'off'
+        self.since = None  # monotonic time of the last transition, None before the first one
+        self.requested = False
+        self.reason = None
+
+    def update(self, sample, critical):
+        """Update the requested state with a sample of the room
+        Parameters
+        ----------
+        sample : dict
+            ppm values of the room
+        critical : dict
+            gases of which an alert rule is triggered
+        """
+        triggered = [gas for gas in critical if gas in self.gases]
+        if triggered:
+            self.requested = True
+            self.reason = 'critical ' + ', '.join(triggered)
+        elif self.requested and all(sample.get(key) is not None and sample[key] < threshold
+                                    for key, threshold in self.off_thresholds.items()):
+            self.requested = False
+            self.reason = 'all gases below their off threshold'
+
+    def tick(self, now):
+        """Switch the socket when the requested state differs and the minimum time has passed
+        Returns
+        -------
+        bool
+            True when the socket was switched
+        """
+        requested = 'on' if self.requested else 'off'
+        if requested == self.state:
+            return False
+        dwell = self.min_on if self.state == 'on' else self.min_off
+        elapsed = None if self.since is None else now - self.since
+        if elapsed is not None and elapsed < dwell:
+            return False
+
+        (self.switch_on if requested == 'on' else self.switch_off)(self.socket)
+        print('{} ventilation socket {} ({}): {} -> {} after {}, {}'.format(
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.socket, self.device, self.state, requested,
+            'startup' if elapsed is None else '{:.0f}s'.format(elapsed), self.reason))
+        self.state = requested
+        self.since = now
+        return True
+
+
+class VentilationController(threading.Thread):
+    """Thread running the state machines of all ventilation units on a short tick
+
+    Parameters
+    ----------
+    units : list
+        VentilationUnit objects
+    tick : float
+        number of seconds between two checks of the requested states
+    """
+
+    def __init__(self, units, tick=1):
+        super().__init__(name='ventilation', daemon=True)
+        self.units = units
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def update(self, device, sample, critical):
+        """Pass a sample of a room and its critical gases to the units of the room
+        The units are switched right away when allowed, without waiting for the next tick.
+        """
+        with self.lock:
+            for unit in self.units:
+                if unit.device == device:
+                    unit.update(sample, critical)
+                    unit.tick(time.monotonic())
+
+    def run(self):
+        while not self.stop_event.wait(self.tick):
+            with self.lock:
+                for unit in self.units:
+                    unit.tick(time.monotonic())
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.join(timeout)
+
+
+def create_units(configs, mq_sensor, upperbounds, off_ratio, min_on, min_off, switch_on, switch_off):
+    """Create the ventilation units of the config
+    Parameters
+    ----------
+    configs : list
+        dict per unit with 'socket', 'device' and 'gases' (see cfg.VENTILATION_UNITS), and optionally
+        'off_thresholds' (ppm per gas), 'min_on' and 'min_off' (seconds)
+    mq_sensor : str
+        sensor of which the values are used
+    upperbounds : dict
+        upper bound of the ppm value per gas
+    off_ratio : float
+        default off threshold as a fraction of the upper bound
+    min_on, min_off : float
+        default minimum number of seconds a unit stays on and off
+    switch_on, switch_off : callable
+        functions switching a socket
+    Returns
+    -------
+    list
+        VentilationUnit objects
+    """
+    units = []
+    for config in configs:
+        thresholds = config.get('off_thresholds', {})
+        off_thresholds = {mq_sensor + '_' + gas + '_ppm': thresholds.get(gas, upperbounds[gas] * off_ratio)
+                          for gas in config['gases']}
+        units.append(VentilationUnit(config['socket'], config['device'], config['gases'], off_thresholds,
+                                     config.get('min_on', min_on), config.get('min_off', min_off),
+                                     switch_on, switch_off))
+    return units